@@ -0,0 +1,147 @@
+"""Packing of room lightmaps into a few large lightmaps.
+
+Every room's floor, ceiling and wall lightmaps are placed on atlas pages with
+a shelf packer. Each room then gets LightmapRegions instead of lightmaps of its
+own, which cuts texture binds and the padding wasted by power-of-two sizes.
+
+"""
+from lightmap import Lightmap, get_lightmap_bytes
+
+# Largest atlas page (must be a power of two)
+MAX_PAGE_SIZE = 2048
+
+# Smallest page size tried when everything fits on one page
+MIN_PAGE_SIZE = 128
+
+# Gutter texels around each region, filled with copies of its edge texels so
+# filtering doesn't pick up neighbours
+PADDING = 1
+
+# Lightmaps each room has (keys of Room.get_lightmap_layout)
+LIGHTMAP_NAMES = ("floor", "ceiling", "wall")
+
+def pack(sizes, page_size, padding=PADDING):
+    """Place rectangles on square pages, using as few pages as possible.
+
+    sizes: List of (width, height) tuples
+
+    Returns a list of (page index, x, y) tuples in the same order as the
+    sizes. Raises ValueError if a rectangle doesn't fit on a page.
+
+    """
+    # Tallest first, so shelves are filled with rectangles of similar heights
+    order = sorted(range(len(sizes)),
+                   key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    placements = [None] * len(sizes)
+    shelves = []  # Lists of page index, y, height and used width
+    page_heights = []  # Height used on each page
+
+    for i in order:
+        width = sizes[i][0] + 2 * padding
+        height = sizes[i][1] + 2 * padding
+        if width > page_size or height > page_size:
+            raise ValueError("%ix%i won't fit on a %i page" %
+                             (sizes[i][0], sizes[i][1], page_size))
+
+        # Use the shortest shelf that has space
+        best_shelf = None
+        for shelf in shelves:
+            if shelf[2] < height or shelf[3] + width > page_size:
+                continue
+            if best_shelf is None or shelf[2] < best_shelf[2]:
+                best_shelf = shelf
+
+        if best_shelf is None:
+            # Start a new shelf, on a new page if necessary
+            for page, used_height in enumerate(page_heights):
+                if used_height + height <= page_size:
+                    break
+            else:
+                page = len(page_heights)
+                page_heights.append(0)
+            best_shelf = [page, page_heights[page], height, 0]
+            page_heights[page] += height
+            shelves.append(best_shelf)
+
+        placements[i] = (best_shelf[0], best_shelf[3] + padding,
+                         best_shelf[1] + padding)
+        best_shelf[3] += width
+    return placements
+
+class LightmapAtlas(object):
+    def __init__(self, rooms, max_page_size=MAX_PAGE_SIZE,
+                 gpu_resident=False):
+        """Work out where every room's lightmaps go. Pages are only created
+        when a room asks for one of its lightmaps.
+
+        gpu_resident: Whether the pages keep their data only on the GPU (see
+                      Lightmap)
+
+        """
+        self.gpu_resident = gpu_resident
+        keys = []
+        sizes = []
+        for room in rooms:
+            layout = room.get_lightmap_layout()
+            for name in LIGHTMAP_NAMES:
+                width, height = layout[name]
+                keys.append((room, name))
+                sizes.append((int(round(width)), int(round(height))))
+
+        # Use the smallest page that fits everything, or as many of the
+        # largest pages as it takes
+        page_size = MIN_PAGE_SIZE
+        while True:
+            try:
+                placements = pack(sizes, page_size)
+            except ValueError:
+                placements = None
+            if page_size >= max_page_size:
+                if placements is None:
+                    raise ValueError("Lightmap too big for the atlas")
+                break
+            if placements and max([p[0] for p in placements]) == 0:
+                break
+            page_size *= 2
+        self.page_size = page_size
+
+        # Key: (room, lightmap name), value: (page, origin, size)
+        self._placements = {}
+        for key, placement, size in zip(keys, placements, sizes):
+            page, x, y = placement
+            self._placements[key] = (page, (x, y), size)
+
+        page_count = max([p[0] for p in placements]) + 1 if placements else 0
+        self._pages = [None] * page_count
+        # Rooms using each page
+        self._page_users = [set() for page in range(page_count)]
+
+    def get_lightmap(self, room, name):
+        """The region of the atlas for one of the room's lightmaps.
+
+        """
+        page, origin, size = self._placements[(room, name)]
+        if self._pages[page] is None:
+            self._pages[page] = Lightmap(self.page_size, self.page_size,
+                                         gpu_resident=self.gpu_resident)
+        self._page_users[page].add(room)
+        return self._pages[page].get_region(origin[0], origin[1],
+                                            size[0], size[1], PADDING)
+
+    def get_bytes(self):
+        """GPU memory used by the pages once they've all been created.
+
+        """
+        return len(self._pages) * get_lightmap_bytes(self.page_size,
+                                                     self.page_size)
+
+    def release(self, room):
+        """The room no longer needs its lightmaps. Pages that no rooms are
+        using get deleted.
+
+        """
+        for page, users in enumerate(self._page_users):
+            users.discard(room)
+            if not users and self._pages[page] is not None:
+                self._pages[page].delete()
+                self._pages[page] = None
@@ -0,0 +1,310 @@
+"""Level-wide batching of static room geometry.
+
+Room surfaces (floors, ceilings and walls) that use the same texture and the
+same lightmap texture (e.g. an atlas page) share one vertex buffer. Each batch
+remembers the range of vertices belonging to each room, so culled rooms can
+still be skipped, and the rest of a batch is drawn with one glMultiDrawArrays
+call. Batches are drawn sorted by texture and lightmap, so textures are only
+bound when they change. Adding a room only writes that room's range of each
+buffer it's in, so rooms can be streamed in and out cheaply.
+
+Batches can be drawn with fixed-function client state, or with vertex array
+objects for the shader renderer (see renderer.py).
+
+"""
+import bisect
+
+import numpy
+
+from pyglet.gl import *
+
+from shaders import POSITION_ATTRIBUTE, TEX_COORD_ATTRIBUTE
+from shaders import LIGHTMAP_COORD_ATTRIBUTE
+from renderstats import frame_stats
+from gpumemory import gpu_memory, ROOM
+
+# Floats per vertex: xyz position, texture coords and lightmap coords
+VERTEX_SIZE = 7
+
+# Room for more vertices that a batch's buffer gets whenever it grows, as a
+# multiple of the vertices it needs, so rooms streamed in later can usually be
+# written into the existing buffer
+GROWTH_FACTOR = 1.5
+
+class GeometryBatch(object):
+    """Vertex data for every surface with a particular texture and lightmap.
+
+    Each room has a range of the buffer, which is written on its own when the
+    room is added. Ranges freed by removed rooms are reused, and the buffer is
+    only rebuilt when it runs out of space.
+
+    """
+    def __init__(self, texture, lightmap):
+        self.texture = texture
+        # Whole lightmap (not a region of it)
+        self.lightmap = lightmap
+
+        self.vbo = None
+        # Vertex array object, only made if the shader renderer is used
+        self.vao = None
+        # Vertices the buffer has space for
+        self.capacity = 0
+        # Key: room, value: (first vertex, vertex count)
+        self.ranges = {}
+        # Unused ranges below self._end, as sorted (first vertex, vertex
+        # count) tuples, with no two next to each other
+        self._free_ranges = []
+        # Vertices up to the end of the last range in use
+        self._end = 0
+        # Whether the buffer needs updating
+        self.dirty = True
+
+        # Key: room, value: interleaved float32 vertex array
+        self._room_data = {}
+        # Rooms whose data hasn't been written to the buffer yet
+        self._unwritten_rooms = set()
+
+    @property
+    def empty(self):
+        return not self._room_data
+
+    def add(self, room, data):
+        """Give the room a range of the buffer for its surfaces (all of them
+        at once, so it has one range). The data is written by upload().
+
+        """
+        self.remove(room)
+        data = numpy.ascontiguousarray(data, dtype=numpy.float32)
+        self._room_data[room] = data
+        self.ranges[room] = (self._allocate(len(data)), len(data))
+        self._unwritten_rooms.add(room)
+        self.dirty = True
+
+    def remove(self, room):
+        if room not in self._room_data:
+            return
+        del self._room_data[room]
+        self._unwritten_rooms.discard(room)
+        self._free(*self.ranges.pop(room))
+
+    def _allocate(self, count):
+        """First vertex of a range of the given size, from the first free
+        range it fits in, or the end.
+
+        """
+        for i, (first, free_count) in enumerate(self._free_ranges):
+            if free_count >= count:
+                if free_count == count:
+                    del self._free_ranges[i]
+                else:
+                    self._free_ranges[i] = (first + count, free_count - count)
+                return first
+        first = self._end
+        self._end += count
+        return first
+
+    def _free(self, first, count):
+        """Make a range available again, merging it with its neighbours.
+
+        """
+        ranges = self._free_ranges
+        i = bisect.bisect(ranges, (first, count))
+        end = first + count
+        if i < len(ranges) and ranges[i][0] == end:
+            end += ranges.pop(i)[1]
+        if i > 0 and sum(ranges[i - 1]) == first:
+            i -= 1
+            first = ranges.pop(i)[0]
+        if end == self._end:
+            # Nothing after it is in use
+            self._end = first
+        else:
+            ranges.insert(i, (first, end - first))
+
+    def upload(self):
+        """Write the data of rooms added since the last upload to the
+        buffer, rebuilding it with space to spare if it's too small.
+
+        """
+        if self.vbo is None:
+            self.vbo = GLuint()
+            glGenBuffers(1, self.vbo)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+
+        if self._end > self.capacity:
+            # Lay the rooms out again with no gaps, and write all of them
+            # to a new, bigger buffer
+            self.ranges = {}
+            self._free_ranges = []
+            self._end = 0
+            for room, data in self._room_data.items():
+                self.ranges[room] = (self._allocate(len(data)), len(data))
+            self._unwritten_rooms = set(self._room_data)
+            self.capacity = int(self._end * GROWTH_FACTOR)
+            size = self.capacity * VERTEX_SIZE * sizeof(GLfloat)
+            glBufferData(GL_ARRAY_BUFFER, size, None, GL_STATIC_DRAW)
+            gpu_memory.add(ROOM, self, ("buffer", self.vbo.value), size)
+
+        for room in self._unwritten_rooms:
+            data = self._room_data[room]
+            offset = self.ranges[room][0] * VERTEX_SIZE * sizeof(GLfloat)
+            glBufferSubData(GL_ARRAY_BUFFER, offset, data.nbytes,
+                            data.ctypes.data)
+        self._unwritten_rooms = set()
+        self.dirty = False
+
+    def bind_vao(self):
+        """Bind the vertex array object, creating it the first time. It
+        keeps pointing at the vertex buffer when that's rebuilt.
+
+        """
+        if self.vao is None:
+            self.vao = GLuint()
+            glGenVertexArrays(1, self.vao)
+            glBindVertexArray(self.vao)
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            stride = VERTEX_SIZE * sizeof(GLfloat)
+            for attribute, size, offset in (
+                                (POSITION_ATTRIBUTE, 3, 0),
+                                (TEX_COORD_ATTRIBUTE, 2, 3),
+                                (LIGHTMAP_COORD_ATTRIBUTE, 2, 5)):
+                glEnableVertexAttribArray(attribute)
+                glVertexAttribPointer(attribute, size, GL_FLOAT, GL_FALSE,
+                                      stride, offset * sizeof(GLfloat))
+        else:
+            glBindVertexArray(self.vao)
+
+    def delete(self):
+        if self.vao is not None:
+            glDeleteVertexArrays(1, self.vao)
+            self.vao = None
+        if self.vbo is not None:
+            glDeleteBuffers(1, self.vbo)
+            gpu_memory.remove(ROOM, self)
+            self.vbo = None
+
+class StaticGeometry(object):
+    def __init__(self):
+        # Key: (texture ID, lightmap), value: GeometryBatch
+        self._batches = {}
+        # Key: room, value: keys of the batches it's in
+        self._room_keys = {}
+
+    def add_room(self, room):
+        """Put the room's surfaces (see Room.surfaces) in the batches. The
+        buffers are updated when they're next drawn.
+
+        """
+        self.remove_room(room)
+        # Key: batch key, value: list of vertex arrays
+        surfaces = {}
+        for texture, lightmap, data in room.surfaces:
+            if not len(data):
+                continue
+            lightmap = lightmap.base_lightmap
+            key = (texture.id, lightmap)
+            if key not in self._batches:
+                self._batches[key] = GeometryBatch(texture, lightmap)
+            surfaces.setdefault(key, []).append(data)
+        for key, arrays in surfaces.items():
+            self._batches[key].add(room, numpy.concatenate(arrays))
+        self._room_keys[room] = set(surfaces)
+
+    def remove_room(self, room):
+        for key in self._room_keys.pop(room, ()):
+            self._batches[key].remove(room)
+
+    def update(self):
+        """Update batches that have changed, and delete empty ones.
+
+        """
+        for key, batch in self._batches.items():
+            if batch.empty:
+                batch.delete()
+                del self._batches[key]
+            elif batch.dirty:
+                batch.upload()
+
+    def delete(self):
+        for batch in self._batches.values():
+            batch.delete()
+        self._batches = {}
+        self._room_keys = {}
+
+    def draw(self, rooms, in_progress_lightmaps=True, use_vaos=False):
+        """Draw the static geometry of the given rooms.
+
+        use_vaos: Whether to use vertex array objects and generic attributes
+                  (for the shader renderer, with its program in use) instead
+                  of fixed-function client state. For fixed-function drawing,
+                  texture unit 0 must have texturing enabled.
+
+        """
+        self.update()
+        rooms = set(rooms)
+
+        # Set up the state once for every batch
+        if not use_vaos:
+            glEnableClientState(GL_VERTEX_ARRAY)
+            for texture_unit in GL_TEXTURE0_ARB, GL_TEXTURE1_ARB:
+                glClientActiveTexture(texture_unit)
+                glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+            glActiveTexture(GL_TEXTURE1_ARB)
+            glEnable(GL_TEXTURE_2D)
+
+        bound_texture = None
+        bound_lightmap = None
+        stride = VERTEX_SIZE * sizeof(GLfloat)
+        for key in sorted(self._batches, key=lambda k: (k[0], id(k[1]))):
+            batch = self._batches[key]
+            ranges = [batch.ranges[room] for room in rooms
+                      if room in batch.ranges]
+            if not ranges:
+                continue
+
+            # Only change textures when they're different
+            if batch.texture.id != bound_texture:
+                glActiveTexture(GL_TEXTURE0_ARB)
+                glBindTexture(GL_TEXTURE_2D, batch.texture.id)
+                bound_texture = batch.texture.id
+                frame_stats.state_changes += 1
+            if in_progress_lightmaps:
+                lightmap_texture = batch.lightmap.in_progress_texture
+            else:
+                lightmap_texture = batch.lightmap.texture
+            if lightmap_texture.id != bound_lightmap:
+                glActiveTexture(GL_TEXTURE1_ARB)
+                glBindTexture(GL_TEXTURE_2D, lightmap_texture.id)
+                bound_lightmap = lightmap_texture.id
+                frame_stats.state_changes += 1
+
+            if use_vaos:
+                batch.bind_vao()
+            else:
+                glBindBuffer(GL_ARRAY_BUFFER, batch.vbo)
+                glVertexPointer(3, GL_FLOAT, stride, 0)
+                glClientActiveTexture(GL_TEXTURE0_ARB)
+                glTexCoordPointer(2, GL_FLOAT, stride, 3 * sizeof(GLfloat))
+                glClientActiveTexture(GL_TEXTURE1_ARB)
+                glTexCoordPointer(2, GL_FLOAT, stride, 5 * sizeof(GLfloat))
+            frame_stats.state_changes += 1
+
+            # Draw the visible rooms' ranges in one call
+            firsts = (GLint * len(ranges))(*[r[0] for r in ranges])
+            counts = (GLsizei * len(ranges))(*[r[1] for r in ranges])
+            glMultiDrawArrays(GL_TRIANGLES, firsts, counts, len(ranges))
+            frame_stats.draw_calls += 1
+
+        # Reset the state
+        if use_vaos:
+            glBindVertexArray(0)
+            glActiveTexture(GL_TEXTURE0_ARB)
+            return
+        glActiveTexture(GL_TEXTURE1_ARB)
+        glDisable(GL_TEXTURE_2D)
+        glClientActiveTexture(GL_TEXTURE1_ARB)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glClientActiveTexture(GL_TEXTURE0_ARB)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glActiveTexture(GL_TEXTURE0_ARB)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""Headless rendering benchmark.
+
+Loads a level into an offscreen EGL context, moves the camera along a
+scripted path through View.project_3d and View.draw_3d, and records each
+frame's CPU time, GPU time, draw calls and state changes. The results are
+written as JSON, and compared against a stored baseline if there is one.
+
+Needs a pyglet with headless (EGL) support. Runs without a GPU using Mesa's
+software renderer, e.g.:
+
+    python benchmark.py --software --output results.json
+
+A camera path is a JSON file with a list of [x, y, heading, pitch]
+keyframes (heading and pitch in radians):
+
+    {"keyframes": [[2.0, 2.0, 0.0, 0.0], [10.0, 2.0, 1.57, 0.0]]}
+
+Frames are spread evenly between the keyframes. Without a path, the camera
+tours the level through the portals, starting where the player starts.
+
+"""
+import os
+import sys
+import json
+import math
+import argparse
+import timeit
+
+# Where results are compared against by default
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark_baseline.json")
+
+# Frames drawn before measuring (buffers are built on first use)
+WARMUP_FRAMES = 10
+
+# Fractional increase in a summary value that counts as a regression
+DEFAULT_TOLERANCE = 0.1
+
+# Summary values compared against the baseline
+COMPARED_VALUES = (("cpu_time", "median"), ("cpu_time", "p95"),
+                   ("gpu_time", "median"), ("gpu_time", "p95"),
+                   ("draw_calls", "mean"), ("state_changes", "mean"))
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Headless render benchmark")
+    parser.add_argument("--path", help="camera path JSON file")
+    parser.add_argument("--frames", type=int, default=600,
+                        help="frames to measure (default: %(default)s)")
+    parser.add_argument("--size", type=int, nargs=2, default=(800, 500),
+                        metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--shaders", action="store_true",
+                        help="use the shader renderer")
+    parser.add_argument("--occlusion", action="store_true",
+                        help="use occlusion culling")
+    parser.add_argument("--gpu-budget", type=float, metavar="MB",
+                        help="GPU memory budget in megabytes")
+    parser.add_argument("--software", action="store_true",
+                        help="use Mesa's software renderer (no GPU needed)")
+    parser.add_argument("--resources",
+                        default=os.path.join(os.path.dirname(
+                                    os.path.abspath(__file__)), "resources"),
+                        help="resources directory to load the level from")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="results to compare against "
+                             "(default: %(default)s)")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed fractional increase before a value "
+                             "counts as a regression (default: %(default)s)")
+    return parser.parse_args(args)
+
+def get_tour_keyframes(game):
+    """Keyframes visiting every room reachable from the player's start,
+    walking through the middle of each portal and looking where it's going.
+
+    """
+    start = tuple(game.player.position)
+    start_room = game.room_index.find_room(start)
+    if start_room is None:
+        return [start + (game.player.heading, 0.0)]
+
+    # Depth first walk through the portals, including the way back
+    points = [start]
+    visited = set([start_room])
+    def visit(room):
+        for portal in game.portals.get_portals(room):
+            if portal.other_room in visited:
+                continue
+            visited.add(portal.other_room)
+            (start_x, start_y), (end_x, end_y) = portal.wall
+            middle = ((start_x + end_x) / 2.0, (start_y + end_y) / 2.0)
+            points.append(middle)
+            visit(portal.other_room)
+            points.append(middle)
+    visit(start_room)
+
+    # Look towards the next point
+    keyframes = []
+    heading = game.player.heading
+    for i, point in enumerate(points):
+        if i + 1 < len(points) and points[i + 1] != point:
+            heading = math.atan2(points[i + 1][1] - point[1],
+                                 points[i + 1][0] - point[0])
+        keyframes.append((point[0], point[1], heading, 0.0))
+    return keyframes
+
+def get_camera(keyframes, ratio):
+    """Camera (x, y, heading, pitch) the given ratio (0.0 - 1.0) of the way
+    along the keyframes.
+
+    """
+    if len(keyframes) == 1:
+        return tuple(keyframes[0])
+    position = ratio * (len(keyframes) - 1)
+    index = min(int(position), len(keyframes) - 2)
+    part = position - index
+    start, end = keyframes[index], keyframes[index + 1]
+    # Turn the short way round
+    turn = (end[2] - start[2] + math.pi) % (2.0 * math.pi) - math.pi
+    return (start[0] + (end[0] - start[0]) * part,
+            start[1] + (end[1] - start[1]) * part,
+            start[2] + turn * part,
+            start[3] + (end[3] - start[3]) * part)
+
+def summarize(values):
+    """Mean, median, 95th percentile and maximum of the values, skipping
+    missing ones. None if there aren't any.
+
+    """
+    values = sorted([value for value in values if value is not None])
+    if not values:
+        return None
+    return {"mean": sum(values) / float(len(values)),
+            "median": values[len(values) // 2],
+            "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+            "max": values[-1]}
+
+def compare(results, baseline, tolerance):
+    """Print how the results compare to the baseline. Returns the names of
+    the values that got worse by more than the tolerance.
+
+    """
+    regressions = []
+    print "%-28s %12s %12s %8s" % ("", "baseline", "now", "change")
+    for name, statistic in COMPARED_VALUES:
+        old = (baseline["summary"].get(name) or {}).get(statistic)
+        new = (results["summary"].get(name) or {}).get(statistic)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        label = "%s %s" % (name, statistic)
+        flag = ""
+        if change > tolerance:
+            regressions.append(label)
+            flag = "  REGRESSION"
+        print "%-28s %12.4f %12.4f %+7.1f%%%s" % (label, old, new,
+                                                  change * 100.0, flag)
+    return regressions
+
+def main(args=None):
+    options = parse_args(sys.argv[1:] if args is None else args)
+
+    # The context has to be set up before anything imports pyglet.gl
+    if options.software:
+        os.environ["EGL_PLATFORM"] = "surfaceless"
+        os.environ["LIBGL_ALWAYS_SOFTWARE"] = "1"
+    # ...and so do the loader's workers (see workers.py)
+    import workers
+    process_pool = workers.create_pool()
+    import pyglet
+    pyglet.options["headless"] = True
+    pyglet.options["shadow_window"] = False
+    import pyglet.window
+    from pyglet.gl import gl_info, GLuint, GLuint64
+    from pyglet.gl import GL_TIME_ELAPSED, GL_QUERY_RESULT
+    from pyglet.gl import glGenQueries, glBeginQuery, glEndQuery
+    from pyglet.gl import glGetQueryObjectui64v, glFinish
+    from game import Game
+    from view import View, VIEW_3D, RENDERER_FIXED, RENDERER_SHADER
+    from renderstats import frame_stats
+    from gpumemory import gpu_memory
+    import loader
+    loader.use_process_pool(process_pool)
+
+    keyframes = None
+    if options.path:
+        keyframes = json.load(open(options.path, "r"))["keyframes"]
+
+    window = pyglet.window.Window(width=options.size[0],
+                                  height=options.size[1], visible=False)
+    window.switch_to()
+
+    os.chdir(options.resources)
+    game = Game()
+    if options.gpu_budget is not None:
+        game.gpu_budget = int(options.gpu_budget * 1024 * 1024)
+    renderer = RENDERER_SHADER if options.shaders else RENDERER_FIXED
+    view = View(game, renderer)
+    view.occlusion_culling = options.occlusion
+    game.view = view
+    view.size = tuple(options.size)
+    view.view_mode = VIEW_3D
+    game.refresh_from_files()
+    process_pool.close()
+    process_pool.join()
+    loader.use_process_pool(None)
+    if keyframes is None:
+        keyframes = get_tour_keyframes(game)
+
+    # GPU time comes from timer queries, where they're supported
+    query = None
+    if gl_info.have_version(3, 3) or \
+            gl_info.have_extension("GL_ARB_timer_query"):
+        query = GLuint()
+        glGenQueries(1, query)
+
+    frames = []
+    for frame in xrange(-WARMUP_FRAMES, options.frames):
+        ratio = max(frame, 0) / float(max(options.frames - 1, 1))
+        x, y, heading, pitch = get_camera(keyframes, ratio)
+        game.player.place((x, y), heading, pitch)
+
+        frame_stats.reset()
+        if query is not None:
+            glBeginQuery(GL_TIME_ELAPSED, query)
+        start = timeit.default_timer()
+        view.draw()
+        cpu_time = timeit.default_timer() - start
+        if query is not None:
+            glEndQuery(GL_TIME_ELAPSED)
+        glFinish()
+        frame_time = timeit.default_timer() - start
+
+        gpu_time = None
+        if query is not None:
+            elapsed = GLuint64()
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, elapsed)
+            gpu_time = elapsed.value / 1e9
+        if frame < 0:
+            continue
+        frames.append({"cpu_time": cpu_time,
+                       "frame_time": frame_time,
+                       "gpu_time": gpu_time,
+                       "draw_calls": frame_stats.draw_calls,
+                       "state_changes": frame_stats.state_changes})
+
+    results = {"renderer": renderer,
+               "occlusion_culling": options.occlusion,
+               "gl_renderer": gl_info.get_renderer(),
+               "gl_version": gl_info.get_version(),
+               "size": list(options.size),
+               "room_count": len(game.rooms),
+               "gpu_memory": gpu_memory.get_totals(),
+               "frames": frames,
+               "summary": dict([(name, summarize([frame[name]
+                                                  for frame in frames]))
+                                for name in ("cpu_time", "frame_time",
+                                             "gpu_time", "draw_calls",
+                                             "state_changes")])}
+    window.close()
+
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    regressions = []
+    if options.update_baseline:
+        with open(options.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    elif os.path.exists(options.baseline):
+        baseline = json.load(open(options.baseline, "r"))
+        regressions = compare(results, baseline, options.tolerance)
+    else:
+        for name, statistic in COMPARED_VALUES:
+            summary = results["summary"][name]
+            if summary is not None:
+                print "%-28s %12.4f" % ("%s %s" % (name, statistic),
+                                        summary[statistic])
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Camera matrices, worked out on the CPU.
+
+These match what gluPerspective, glOrtho, glRotatef and glTranslatef would put
+on the matrix stack, as 4x4 arrays that transform column vectors. They can be
+loaded into the fixed-function pipeline with load_matrices, or given to
+shaders as uniforms.
+
+"""
+import math
+
+import numpy
+
+from pyglet.gl import *
+
+def perspective(field_of_view, aspect, near, far):
+    """Same as gluPerspective. The field of view is vertical, in degrees.
+
+    """
+    f = 1.0 / math.tan(math.radians(field_of_view) / 2.0)
+    return numpy.array([[f / aspect, 0.0, 0.0, 0.0],
+                        [0.0, f, 0.0, 0.0],
+                        [0.0, 0.0, (far + near) / (near - far),
+                         2.0 * far * near / (near - far)],
+                        [0.0, 0.0, -1.0, 0.0]])
+
+def orthographic(left, right, bottom, top, near, far):
+    """Same as glOrtho.
+
+    """
+    return numpy.array([[2.0 / (right - left), 0.0, 0.0,
+                         -(right + left) / (right - left)],
+                        [0.0, 2.0 / (top - bottom), 0.0,
+                         -(top + bottom) / (top - bottom)],
+                        [0.0, 0.0, -2.0 / (far - near),
+                         -(far + near) / (far - near)],
+                        [0.0, 0.0, 0.0, 1.0]])
+
+def rotation(angle, axis):
+    """Same as glRotatef. The angle is in degrees.
+
+    """
+    x, y, z = numpy.asarray(axis, dtype=numpy.float64) / numpy.linalg.norm(axis)
+    c = math.cos(math.radians(angle))
+    s = math.sin(math.radians(angle))
+    matrix = numpy.identity(4)
+    matrix[:3, :3] = [[x * x * (1 - c) + c, x * y * (1 - c) - z * s,
+                       x * z * (1 - c) + y * s],
+                      [y * x * (1 - c) + z * s, y * y * (1 - c) + c,
+                       y * z * (1 - c) - x * s],
+                      [x * z * (1 - c) - y * s, y * z * (1 - c) + x * s,
+                       z * z * (1 - c) + c]]
+    return matrix
+
+def translation(offset):
+    """Same as glTranslatef.
+
+    """
+    matrix = numpy.identity(4)
+    matrix[:3, 3] = offset
+    return matrix
+
+def get_view_matrix(position, heading, pitch):
+    """Matrix for a camera at the given 3D position. Heading and pitch are in
+    radians; a heading of 0 looks along +x with z up.
+
+    """
+    matrices = [rotation(90.0, (0.0, 1.0, 0.0)),
+                rotation(-90.0, (1.0, 0.0, 0.0)),
+                rotation(math.degrees(pitch), (0.0, 1.0, 0.0)),
+                rotation(math.degrees(heading), (0.0, 0.0, -1.0)),
+                translation([-component for component in position])]
+    return reduce(numpy.dot, matrices)
+
+def load_matrices(projection, view):
+    """Replace the fixed-function projection and modelview matrices.
+
+    """
+    for matrix_mode, matrix in ((GL_PROJECTION, projection),
+                                (GL_MODELVIEW, view)):
+        glMatrixMode(matrix_mode)
+        # OpenGL matrices are column major
+        glLoadMatrixd((GLdouble * 16)(*numpy.asarray(matrix).T.ravel()))
@@ -1,70 +1,273 @@
 import json
-import itertools
 
 import pymunk
 
+import loader
+import levelfile
 from radiosity import Radiosity
-from room import Room
-from player import Player, on_player_hit_wall
+from room import Room, update_shared_walls, set_lightmap_densities
+from atlas import LightmapAtlas
+from batching import StaticGeometry
+from levelmap import LevelMap
+from portals import PortalGraph
+from roomindex import RoomIndex
+from streaming import RoomStreamer
+from player import Player, on_player_touch_wall, on_player_leave_wall
+from player import MIN_SOLVER_ITERATIONS
 
 from utils import WALL_COLLISION_TYPE, PLAYER_COLLISION_TYPE
+from profiler import profiler
+from gpumemory import gpu_memory
 
-class Game(object):        
+# Simulation steps per second, independent of the frame rate
+STEP_RATE = 60.0
+STEP_TIME = 1.0 / STEP_RATE
+
+# Most simulation steps to run in one update. If the game falls further behind
+# than this, it slows down rather than spending ever longer catching up.
+MAX_STEPS_PER_UPDATE = 5
+
+# Seconds of radiosity work to do each frame
+RADIOSITY_TIME_BUDGET = 0.004
+
+# Fraction of the GPU memory budget the lightmaps may use. Their sizes are
+# decided before anything's loaded, so they get a fixed share; meshes lose
+# levels of detail if everything together is still over the budget.
+LIGHTMAP_BUDGET_SHARE = 0.5
+
+class Game(object):
+    def __init__(self):
+        # Time not yet simulated (less than a step after each update)
+        self._accumulator = 0.0
+        # Level-wide vertex buffers for room surfaces
+        self.static_geometry = None
+        # Line buffer for the 2D map
+        self.level_map = None
+        self.rooms = []
+        self.radiosity = None
+        # Loads rooms near the player, if the level is streamed
+        self.streamer = None
+        # Set by whoever creates the view
+        self.view = None
+        # Bytes of GPU memory to stay within, or None for no limit (see
+        # gpumemory.py)
+        self.gpu_budget = None
+    
     def update_shared_walls(self):
-        if len(self.rooms) <2:
-            return
-        shared_walls = []
-        # Loop over every pair of rooms
-        for room_a, room_b in itertools.combinations(self.rooms, 2):
-            for index_a, wall_a in enumerate(room_a.walls):
-                for index_b, wall_b in enumerate(room_b.walls):
-                    # We know they're both wound the same way, so the walls 
-                    # will be in opposite directions
-                    if wall_a[0] == wall_b[1] and wall_a[1] == wall_b[0]:
-                        # The walls are shared; record the shared rooms
-                        room_a.shared_walls[index_a] = room_b
-                        room_b.shared_walls[index_b] = room_a
+        self.portals = update_shared_walls(self.rooms)
 
-    def refresh_from_files(self):
-        data = json.load(open("levels/level.json", "r"))
+    def refresh_from_files(self, stream_hops=None, atlas_lightmaps=True,
+                           gpu_resident_lightmaps=True):
+        """Build the level from the level file.
+        
+        stream_hops: If set, only keep rooms within this many portal hops of
+                     the player loaded (see streaming.RoomStreamer).
+                     Otherwise everything is loaded up front.
+        atlas_lightmaps: Whether to pack the rooms' lightmaps into a few
+                         large textures (see atlas.LightmapAtlas)
+        gpu_resident_lightmaps: Whether lightmaps keep their data only in
+                                their textures, rather than in CPU memory
+                                as well (see lightmap.Lightmap)
+        
+        """
+        # Free the GL objects of the previous level
+        self.release()
+        
+        # Use the compiled level if it's up to date
+        compiled = levelfile.load_compiled()
+        if compiled:
+            data = compiled["level"]
+        else:
+            data = json.load(open(levelfile.LEVEL_PATH, "r"))
         
         # Lightmaps that will have radiosity calculated, along with their 
         # sample camera function
         lightmaps = []
         
+        # Start from scratch, so changed files get reloaded
+        loader.clear_caches()
+        
         # Add rooms from data
         self.rooms = []
-        for room_data in data["rooms"]:
-            self.rooms.append(Room(room_data))
-        self.update_shared_walls()
+        if compiled:
+            for room_data, compiled_room in zip(data["rooms"],
+                                                compiled["rooms"]):
+                self.rooms.append(Room(room_data, compiled_room))
+            levelfile.apply_shared_walls(self.rooms, compiled["shared_walls"])
+            self.portals = PortalGraph(self.rooms)
+        else:
+            for room_data in data["rooms"]:
+                self.rooms.append(Room(room_data))
+            self.update_shared_walls()
+            set_lightmap_densities(self.rooms, data.get("lightmap_density"),
+                                   data.get("lightmap_budget"))
+        
+        if stream_hops is None:
+            # Decode, parse, triangulate and build vertex data for everything
+            # in parallel first; the rooms and meshes then only have to
+            # upload it. Rooms that are streamed in are prepared as they're
+            # needed.
+            loader.preload(data, None if compiled else self.rooms)
+        
+        # For finding which room things are in
+        self.room_index = RoomIndex(self.rooms, self.portals)
+        
+        # Decide how big each room's lightmaps are and where they go
+        self.lightmap_atlas = self.plan_lightmaps(atlas_lightmaps,
+                                                  gpu_resident_lightmaps)
+        for room in self.rooms:
+            room.lightmap_atlas = self.lightmap_atlas
+            room.gpu_resident_lightmaps = gpu_resident_lightmaps
+        
+        # Room surfaces are drawn from shared, level-wide vertex buffers
+        self.static_geometry = StaticGeometry()
         for room in self.rooms:
-            room.generate_triangulated_data()
-            lightmaps.extend(room.lightmaps)    
+            room.static_geometry = self.static_geometry
+        
+        # The 2D map is built once per level
+        self.level_map = LevelMap(self.rooms)
+        
+        if stream_hops is None:
+            for room in self.rooms:
+                room.load()
+                lightmaps.extend(room.lightmaps)    
         
         self.player = Player(data["player"])
         self.player.game = self
         
         # Setup physics objects
         self.space = pymunk.Space()
-        self.space.iterations = 100
+        self.space.iterations = MIN_SOLVER_ITERATIONS
     	
         # Let each object add themselves
         for room in self.rooms:
             room.add_to_space(self.space)
         self.player.add_to_space(self.space)
         
-        # Add handler for collisions between player and walls
+        # Count the walls the player touches. Which walls they collide with
+        # at all is decided by collision layers (see
+        # Player.update_wall_layers).
         self.space.add_collision_handler(PLAYER_COLLISION_TYPE,
                                          WALL_COLLISION_TYPE,
-                                         pre_solve=on_player_hit_wall)
+                                         begin=on_player_touch_wall,
+                                         separate=on_player_leave_wall)
         
         # Object for managing radiosity
         self.radiosity = Radiosity(self.view.draw_for_lightmap, lightmaps)
         
+        # Load the rooms around the player
+        if stream_hops is not None:
+            self.streamer = RoomStreamer(self, stream_hops)
+            start_room = self.player.get_current_room()
+            if start_room is not None:
+                self.streamer.load_now(start_room)
+        
+        self.enforce_gpu_budget()
+    
+    def release(self):
+        """Delete the GL objects belonging to the current level. Textures
+        stay cached until the loader's caches are cleared.
+        
+        """
+        if self.streamer is not None:
+            self.streamer.close()
+            self.streamer = None
+        for room in self.rooms:
+            room.unload()
+        if self.static_geometry is not None:
+            self.static_geometry.delete()
+            self.static_geometry = None
+        if self.level_map is not None:
+            self.level_map.delete()
+            self.level_map = None
+        if self.radiosity is not None:
+            self.radiosity.delete()
+            self.radiosity = None
+        # Occlusion results refer to the old rooms
+        if self.view is not None:
+            self.view.delete()
+    
+    def plan_lightmaps(self, atlas_lightmaps, gpu_resident_lightmaps=False):
+        """Work out the rooms' lightmap sizes, halving them until they fit in
+        their share of the GPU memory budget. Returns the atlas if the
+        lightmaps are packed into one.
+        
+        """
+        previous_size = None
+        while True:
+            atlas = None
+            if atlas_lightmaps:
+                atlas = LightmapAtlas(self.rooms,
+                                      gpu_resident=gpu_resident_lightmaps)
+                size = atlas.get_bytes()
+            else:
+                size = sum([room.get_lightmap_bytes() for room in self.rooms])
+            if (self.gpu_budget is None or
+                    size <= self.gpu_budget * LIGHTMAP_BUDGET_SHARE or
+                    (previous_size is not None and size >= previous_size)):
+                # Fits, or can't get any smaller
+                return atlas
+            previous_size = size
+            for room in self.rooms:
+                room.lightmap_downscale += 1
+    
+    def enforce_gpu_budget(self):
+        """Drop the most detailed levels of detail of the loaded meshes,
+        biggest first, until everything fits in the GPU memory budget or only
+        the coarsest levels are left.
+        
+        """
+        if self.gpu_budget is None or gpu_memory.total <= self.gpu_budget:
+            return
+        meshes = [room_mesh for room in self.rooms
+                  for room_mesh in room.meshes if room_mesh.can_drop_lod]
+        while meshes and gpu_memory.total > self.gpu_budget:
+            room_mesh = max(meshes, key=lambda m: m.lod_bytes[m.min_lod])
+            room_mesh.drop_lod()
+            if not room_mesh.can_drop_lod:
+                meshes.remove(room_mesh)
 
     def update(self, dt):
-        self.radiosity.do_work()
-        self.player.update(1.0 / 60.0)
+        """Advance the simulation by the time since the last update, in fixed
+        steps. Call once per frame.
+        
+        """
+        self._accumulator += dt
+        step_count = 0
+        while self._accumulator >= STEP_TIME:
+            if step_count >= MAX_STEPS_PER_UPDATE:
+                # Too far behind; drop the rest
+                self._accumulator %= STEP_TIME
+                break
+            self.step(STEP_TIME)
+            self._accumulator -= STEP_TIME
+            step_count += 1
+        
+        # How far the frame is between the last step and the next one
+        self.player.interpolation = self._accumulator / STEP_TIME
+        
+        if self.streamer:
+            self.streamer.update()
+            # Newly loaded rooms may have gone over the budget
+            self.enforce_gpu_budget()
+    
+    def step(self, dt):
+        """Advance the simulation by one fixed step.
+        
+        """
+        self.player.store_previous_state()
+        with profiler.scope("Player.update"):
+            self.player.update(dt)
+            self.player.update_wall_layers()
         for room in self.rooms:
             room.update(dt)
-        self.space.step(1.0 / 60.0)
+        self.space.iterations = self.player.solver_iterations
+        with profiler.scope("space.step"):
+            self.space.step(dt)
+    
+    def update_radiosity(self, dt):
+        """Do a frame's share of the radiosity work.
+        
+        """
+        with profiler.gpu_scope("radiosity"):
+            self.radiosity.do_work_for(RADIOSITY_TIME_BUDGET)
@@ -0,0 +1,91 @@
+"""Accounting of the GPU memory used by buffers and textures.
+
+Whoever creates a GL buffer or texture adds its size here, under the kind of
+thing that owns it (ROOM, MESH, LIGHTMAP, RADIOSITY or VIEW) and the owner
+itself,
+and removes it again when the object is deleted. Sizes are worked out from
+the data uploaded, so they're estimates of what the driver really allocates
+(no padding or alignment), but they're good enough to compare against a
+budget.
+
+"""
+
+# Kinds of owner
+ROOM = "room"
+MESH = "mesh"
+LIGHTMAP = "lightmap"
+RADIOSITY = "radiosity"
+# Objects the view draws with, such as the shader renderer and occlusion culler
+VIEW = "view"
+OWNER_KINDS = (ROOM, MESH, LIGHTMAP, RADIOSITY, VIEW)
+
+# Bytes per texel of an RGBA texture or a depth buffer
+TEXEL_BYTES = 4
+
+def get_texture_bytes(width, height, mipmapped=False,
+                      texel_bytes=TEXEL_BYTES):
+    """Estimated size of a texture. A full set of mipmaps adds a third.
+
+    """
+    size = width * height * texel_bytes
+    if mipmapped:
+        size = size * 4 // 3
+    return size
+
+def format_bytes(size):
+    return "%.1f MB" % (size / (1024.0 * 1024.0))
+
+class GPUMemoryTracker(object):
+    def __init__(self):
+        # Key: (owner kind, owner), value: {GL object: bytes}. GL objects
+        # are keys such as ("buffer", ID) or ("texture", ID).
+        self._owners = {}
+        # Key: owner kind, value: bytes
+        self._totals = dict.fromkeys(OWNER_KINDS, 0)
+
+    def add(self, kind, owner, gl_object, size):
+        """Record the size of a buffer or texture. Adding the same object
+        again replaces its size (e.g. when a buffer's data is replaced).
+
+        """
+        objects = self._owners.setdefault((kind, owner), {})
+        self._totals[kind] += size - objects.get(gl_object, 0)
+        objects[gl_object] = size
+
+    def remove(self, kind, owner, gl_object=None):
+        """Forget a deleted buffer or texture, or everything the owner has if
+        no object is given.
+
+        """
+        objects = self._owners.get((kind, owner))
+        if objects is None:
+            return
+        if gl_object is None:
+            self._totals[kind] -= sum(objects.values())
+            del self._owners[(kind, owner)]
+        elif gl_object in objects:
+            self._totals[kind] -= objects.pop(gl_object)
+            if not objects:
+                del self._owners[(kind, owner)]
+
+    def get_owner_bytes(self, kind, owner):
+        return sum(self._owners.get((kind, owner), {}).values())
+
+    def get_totals(self):
+        """Bytes used by each kind of owner.
+
+        """
+        return dict(self._totals)
+
+    @property
+    def total(self):
+        return sum(self._totals.values())
+
+    def get_report(self):
+        lines = ["%-10s %10s" % (kind, format_bytes(self._totals[kind]))
+                 for kind in OWNER_KINDS]
+        lines.append("%-10s %10s" % ("total", format_bytes(self.total)))
+        return "\n".join(lines)
+
+# GPU memory used by the game
+gpu_memory = GPUMemoryTracker()
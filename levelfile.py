@@ -0,0 +1,109 @@
+"""Compiled level files.
+
+Compiling a level does the room validation, shared wall detection,
+triangulation, texture coordinate generation and lightmap layout up front and
+saves the results, so they don't have to be repeated on every launch. A
+compiled file records the modification times of the files it was made from,
+and is ignored if any of them have changed.
+
+Run this module from the resources directory to compile the level:
+
+    python ../levelfile.py
+
+"""
+import os
+import json
+import cPickle as pickle
+
+import room
+from room import Room
+
+LEVEL_PATH = "levels/level.json"
+COMPILED_LEVEL_PATH = "levels/level.compiled"
+
+# Increase whenever the compiled data changes
+FORMAT_VERSION = 2
+
+def get_source_paths(level_data, level_path):
+    """Paths of every file that the compiled data depends on.
+
+    """
+    paths = set([level_path])
+    for room_data in level_data["rooms"]:
+        for key in "floor_texture", "ceiling_texture", "wall_texture":
+            paths.add(room_data.get(key, "textures/default.png"))
+    return sorted(paths)
+
+def get_modification_times(paths):
+    times = {}
+    for path in paths:
+        times[path] = os.path.getmtime(path)
+    return times
+
+def compile_level(level_path=LEVEL_PATH, compiled_path=COMPILED_LEVEL_PATH):
+    """Build the rooms in the given level file and save everything that can
+    be worked out in advance.
+
+    """
+    level_data = json.load(open(level_path, "r"))
+    rooms = [Room(room_data) for room_data in level_data["rooms"]]
+    room.update_shared_walls(rooms)
+    room.set_lightmap_densities(rooms, level_data.get("lightmap_density"),
+                                level_data.get("lightmap_budget"))
+
+    # Shared walls as indexes: for each room, (wall index, other room index)
+    room_indexes = dict([(r, i) for i, r in enumerate(rooms)])
+    shared_walls = []
+    for r in rooms:
+        shared_walls.append([(wall_index, room_indexes[other])
+                             for wall_index, other in r.shared_walls.items()])
+
+    source_paths = get_source_paths(level_data, level_path)
+    compiled = {"version": FORMAT_VERSION,
+                "sources": get_modification_times(source_paths),
+                "level": level_data,
+                "rooms": [r.get_compiled_data() for r in rooms],
+                "shared_walls": shared_walls}
+
+    # Write to a temporary file first so a failure can't leave a broken file
+    temp_path = compiled_path + ".tmp"
+    with open(temp_path, "wb") as compiled_file:
+        pickle.dump(compiled, compiled_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, compiled_path)
+
+def load_compiled(level_path=LEVEL_PATH, compiled_path=COMPILED_LEVEL_PATH):
+    """Data saved by compile_level, or None if there isn't a compiled file or
+    it's out of date.
+
+    """
+    if not os.path.exists(compiled_path):
+        return None
+    try:
+        with open(compiled_path, "rb") as compiled_file:
+            compiled = pickle.load(compiled_file)
+    except (pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    if compiled.get("version") != FORMAT_VERSION:
+        return None
+
+    # Check that nothing it was made from has changed
+    sources = compiled["sources"]
+    if level_path not in sources:
+        return None
+    try:
+        if get_modification_times(sources.keys()) != sources:
+            return None
+    except OSError:
+        return None
+    return compiled
+
+def apply_shared_walls(rooms, shared_walls):
+    """Set up each room's shared walls from the compiled table.
+
+    """
+    for r, room_shared_walls in zip(rooms, shared_walls):
+        for wall_index, other_index in room_shared_walls:
+            r.shared_walls[wall_index] = rooms[other_index]
+
+if __name__ == "__main__":
+    compile_level()
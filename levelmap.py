@@ -0,0 +1,139 @@
+"""Line buffers for the 2D map view.
+
+The outlines of the rooms' floor triangles and their walls are put in one
+vertex buffer when the level is loaded, with a colour per vertex, so the whole
+map is drawn in one call. Each room's lines are kept together, so rooms
+outside the view can be skipped when it's zoomed in.
+
+"""
+import numpy
+
+from pyglet.gl import *
+
+import loader
+from renderstats import frame_stats
+from gpumemory import gpu_memory, ROOM
+
+FLOOR_COLOR = 0.8, 1.0, 0.9, 1.0
+SHARED_WALL_COLOR = 0.7, 0.7, 0.7, 1.0
+WALL_COLOR = 0.0, 0.0, 0.0, 1.0
+
+# Floats per vertex: xy position and RGBA colour
+VERTEX_SIZE = 6
+
+def _get_line_data(points, color):
+    """Interleaved vertex data for lines between pairs of 2D points.
+
+    """
+    data = numpy.empty((len(points), VERTEX_SIZE), dtype=numpy.float32)
+    data[:, :2] = points
+    data[:, 2:] = color
+    return data
+
+def get_room_line_data(room):
+    """Vertex data for a room's floor triangles and walls, as GL_LINES. The
+    walls come after the triangles, so they're drawn on top.
+
+    """
+    triangles = room.triangles
+    if not triangles:
+        # Streamed out rooms are still shown
+        triangles = loader.get_triangles(room.vertices,
+                                         room.floor_triangulation == "delaunay")
+    triangles = numpy.array(triangles, dtype=numpy.float64).reshape(-1, 3, 2)
+    # Each triangle's three edges
+    triangle_points = triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+
+    walls = numpy.array(room.walls, dtype=numpy.float64).reshape(-1, 2, 2)
+    shared = numpy.zeros(len(walls), dtype=bool)
+    shared[list(room.shared_walls)] = True
+
+    return numpy.concatenate([
+                    _get_line_data(triangle_points, FLOOR_COLOR),
+                    _get_line_data(walls[shared].reshape(-1, 2),
+                                   SHARED_WALL_COLOR),
+                    _get_line_data(walls[~shared].reshape(-1, 2), WALL_COLOR)])
+
+class LevelMap(object):
+    def __init__(self, rooms):
+        """Build the line buffer for the given rooms. Shared walls must have
+        been set.
+
+        """
+        self.rooms = list(rooms)
+
+        # Each room's range of vertices, and its 2D bounding box
+        room_data = [get_room_line_data(room) for room in self.rooms]
+        self._counts = numpy.array([len(data) for data in room_data],
+                                   dtype=numpy.int32)
+        self._firsts = numpy.zeros(len(self.rooms), dtype=numpy.int32)
+        self._firsts[1:] = numpy.cumsum(self._counts)[:-1]
+        boxes = numpy.array([room.bounding_box for room in self.rooms],
+                            dtype=numpy.float64).reshape(-1, 4)
+        self._box_mins = boxes[:, [0, 2]]
+        self._box_maxes = boxes[:, [1, 3]]
+
+        if room_data:
+            data = numpy.concatenate(room_data)
+        else:
+            data = numpy.zeros((0, VERTEX_SIZE), dtype=numpy.float32)
+        data = numpy.ascontiguousarray(data, dtype=numpy.float32)
+        self.vertex_count = len(data)
+        self.vbo = GLuint()
+        glGenBuffers(1, self.vbo)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data,
+                     GL_STATIC_DRAW)
+        gpu_memory.add(ROOM, self, ("buffer", self.vbo.value), data.nbytes)
+
+    def get_ranges(self, rect=None):
+        """First vertices and vertex counts of the rooms overlapping the rect
+        (min x, min y, max x, max y), or of every room if it's None. Rooms
+        next to each other in the buffer are merged into one range.
+
+        """
+        visible = self._counts > 0
+        if rect is not None:
+            visible &= ((self._box_maxes[:, 0] >= rect[0]) &
+                        (self._box_maxes[:, 1] >= rect[1]) &
+                        (self._box_mins[:, 0] <= rect[2]) &
+                        (self._box_mins[:, 1] <= rect[3]))
+        indexes = numpy.flatnonzero(visible)
+        if not len(indexes):
+            return [], []
+
+        # Split into runs of consecutive rooms
+        run_starts = numpy.concatenate(
+                        ([0], numpy.flatnonzero(numpy.diff(indexes) > 1) + 1))
+        run_ends = numpy.concatenate((run_starts[1:], [len(indexes)])) - 1
+        firsts = self._firsts[indexes[run_starts]]
+        lasts = self._firsts[indexes[run_ends]] + self._counts[indexes[run_ends]]
+        return firsts.tolist(), (lasts - firsts).tolist()
+
+    def draw(self, rect=None):
+        """Draw the lines of the rooms overlapping the rect (see
+        get_ranges). Texturing should be disabled.
+
+        """
+        firsts, counts = self.get_ranges(rect)
+        if not firsts:
+            return
+
+        stride = VERTEX_SIZE * sizeof(GLfloat)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, stride, 0)
+        glColorPointer(4, GL_FLOAT, stride, 2 * sizeof(GLfloat))
+        glMultiDrawArrays(GL_LINES, (GLint * len(firsts))(*firsts),
+                          (GLsizei * len(counts))(*counts), len(firsts))
+        frame_stats.state_changes += 1
+        frame_stats.draw_calls += 1
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+
+    def delete(self):
+        if self.vbo is not None:
+            glDeleteBuffers(1, self.vbo)
+            gpu_memory.remove(ROOM, self)
+            self.vbo = None
@@ -1,95 +1,262 @@
 import pyglet
 from pyglet.gl import *
 import utils
+from gpumemory import gpu_memory, get_texture_bytes, LIGHTMAP
+
+# Textures each lightmap has on the GPU (finished and in progress)
+TEXTURES_PER_LIGHTMAP = 2
+
+def get_lightmap_bytes(width, height):
+    """GPU memory used by a lightmap of the given size.
+
+    """
+    return TEXTURES_PER_LIGHTMAP * get_texture_bytes(width, height)
+
+def get_gutter_texels(texel, size, padding):
+    """Texels around a region that take the value of one of its edge texels,
+    so linear filtering at the edge doesn't pick up whatever is outside.
+
+    texel: Texel coordinates within the region (tuple of x and y)
+    size: Size of the region (tuple of width and height)
+    padding: Width of the gutter
+
+    Returns a list of texel coordinates relative to the region. Corner texels
+    fill the corners of the gutter too.
+
+    """
+    def extent(value, length):
+        start = value - padding if value == 0 else value
+        end = value + padding if value == length - 1 else value
+        return range(start, end + 1)
+
+    return [(x, y)
+            for y in extent(texel[1], size[1])
+            for x in extent(texel[0], size[0])
+            if (x, y) != tuple(texel)]
 
 class Lightmap(object):
-    def __init__(self, width, height, initial_value=(0, 0, 0)):
+    def __init__(self, width, height, initial_value=(0, 0, 0),
+                 gpu_resident=False):
+        """gpu_resident: Keep the texel data only in the textures. Texels are
+        written straight to the in-progress texture, and the two textures
+        swap roles when a pass is finished, instead of the finished data
+        being copied on the CPU and uploaded again.
+
+        """
         # Check size
         self.size = (int(round(width)), int(round(height)))
         for size_component in self.size:
             if not utils.is_power_of_two(size_component):
                 raise ValueError("Size must be power of two")
-        
-        # Create an image
-        self.image = pyglet.image.create(self.size[0], self.size[1])
-        # Get format and pitch
-        self.format = self.image.format
-        self.pitch = self.image.pitch
-        # Fill it with black
-        initial_value_chr = "".join([chr(v) for v in initial_value])
-        tex_data = (initial_value_chr + chr(255)) * self.size[0] * self.size[1]
-        self.image.set_data(self.format, self.pitch, tex_data)
-        
-        # Create another image to store in-progress data
-        self.in_progress_image = pyglet.image.create(self.size[0], self.size[1])
-        assert self.in_progress_image.format == self.format
-        assert self.in_progress_image.pitch == self.pitch
-        initial_value_chr = chr(255) + chr(0) + chr(255)
-        tex_data = (initial_value_chr + chr(255)) * self.size[0] * self.size[1]
-        self.in_progress_image.set_data(self.format, self.pitch, tex_data)
-        
-        # Get the textures
-        self.texture = self.image.get_texture()
-        self.in_progress_texture = self.in_progress_image.get_texture()
-    
+        self.gpu_resident = gpu_resident
+
+        texel_value = bytearray(list(initial_value) + [255])
+        if gpu_resident:
+            # No texel data on the CPU. Both textures start with the initial
+            # value, as whatever a pass doesn't write (such as texels outside
+            # the room) ends up in the finished texture when they swap.
+            self.data = None
+            self.in_progress_data = None
+            self.texture = self._create_texture(fill_value=texel_value)
+            self.in_progress_texture = self._create_texture(
+                                                    fill_value=texel_value)
+        else:
+            # Texel data (RGBA bytes). The finished data, filled with the
+            # initial value...
+            texel_count = self.size[0] * self.size[1]
+            self.data = texel_value * texel_count
+            # ...and the data being written by the current radiosity pass.
+            self.in_progress_data = bytearray([255, 0, 255, 255]) * texel_count
+
+            # Get the textures. They're kept for the lightmap's lifetime and
+            # updated in place.
+            self.texture = self._create_texture(self.data)
+            self.in_progress_texture = self._create_texture(
+                                                        self.in_progress_data)
+
+        # Offset and scale to apply to 0.0-1.0 lightmap coords
+        self.tex_coord_transform = ((0.0, 0.0), (1.0, 1.0))
+
+    @property
+    def base_lightmap(self):
+        """The whole lightmap that owns the textures (see LightmapRegion).
+
+        """
+        return self
+
+    def _create_texture(self, data=None, fill_value=None):
+        """Create a texture from the given texel data, or filled with a
+        single texel value. Filling uploads the value a row at a time, so no
+        image of the whole texture is built on the CPU.
+
+        """
+        width, height = self.size
+        texture_id = GLuint()
+        glGenTextures(1, texture_id)
+        texture = pyglet.image.Texture(width, height, GL_TEXTURE_2D,
+                                       texture_id.value)
+
+        # Set tex attributes
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, texture.id)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        # glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+
+        if data is not None:
+            data = (GLubyte * len(data)).from_buffer(data)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA,
+                     GL_UNSIGNED_BYTE, data)
+        if fill_value is not None:
+            row_data = fill_value * width
+            row_data = (GLubyte * len(row_data)).from_buffer(row_data)
+            for row in xrange(height):
+                glTexSubImage2D(GL_TEXTURE_2D, 0, 0, row, width, 1, GL_RGBA,
+                                GL_UNSIGNED_BYTE, row_data)
+
+        gpu_memory.add(LIGHTMAP, self, ("texture", texture.id),
+                       get_texture_bytes(width, height))
+        return texture
+
+    def delete(self):
+        """Delete the textures.
+
+        """
+        for texture in self.texture, self.in_progress_texture:
+            utils.delete_texture(texture)
+        gpu_memory.remove(LIGHTMAP, self)
+
+    def _upload(self, texture, data, rect):
+        """Copy the given rectangle (x, y, width, height) of texel data to
+        the texture.
+
+        """
+        x, y, width, height = rect
+        rect_data = bytearray()
+        for row in xrange(y, y + height):
+            start = (row * self.size[0] + x) * 4
+            rect_data += data[start:start + width * 4]
+        rect_data = (GLubyte * len(rect_data)).from_buffer_copy(
+                                                            str(rect_data))
+        glBindTexture(GL_TEXTURE_2D, texture.id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, width, height, GL_RGBA,
+                        GL_UNSIGNED_BYTE, rect_data)
+
     def set_value(self, texel, value):
         """Set the in-progress value at the given texel.
-        
+
         texel: Texel coordinates (tuple of x and y)
         value: New texel colour (tuple of RGB floats 0.0-1.0)
-        
+
         """
         # Get data for given value
-        value_data = ""
+        value_data = bytearray()
         for channel_value in value:
             int_value = int(round(channel_value * 255.0))
             try:
-                value_data += chr(int_value)
+                value_data.append(int_value)
             except ValueError:
                 print value
                 raise
-        value_data += chr(255)  # Alpha
-        
+        value_data.append(255)  # Alpha
+
+        if self.gpu_resident:
+            texel_data = (GLubyte * 4).from_buffer_copy(str(value_data))
+            glBindTexture(GL_TEXTURE_2D, self.in_progress_texture.id)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, texel[0], texel[1], 1, 1,
+                            GL_RGBA, GL_UNSIGNED_BYTE, texel_data)
+            return
+
         # Replace the texel data with the new value
         texel_index = texel[1] * self.size[0] + texel[0]
-        data = self.in_progress_image.get_data(self.format, self.pitch)
-        data_before = data[:texel_index * 4]
-        data_after = data[(texel_index + 1) * 4:]
-        new_data = data_before + value_data + data_after
+        self.in_progress_data[texel_index * 4:(texel_index + 1) * 4] = \
+            value_data
 
-        # Update the image
-        self.in_progress_image.set_data(self.format, self.pitch, new_data)
-        self.in_progress_texture = self.in_progress_image.get_texture()
+        # Update the texture
+        self._upload(self.in_progress_texture, self.in_progress_data,
+                     (texel[0], texel[1], 1, 1))
 
-        # Set tex attributes
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, self.in_progress_texture.id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-        # glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-    
-    def update_from_in_progress(self):
+    def update_from_in_progress(self, rect=None):
         """After setting pixel data using set_value, call this to update the
         main image from the in-progress version.
-        
+
+        rect: Part to update (x, y, width, height); default is everything.
+              GPU resident lightmaps are always updated as a whole, so they
+              should only be updated once per pass.
+
         """
-        # Create a new image
-        self.image = pyglet.image.create(self.size[0], self.size[1])
-        assert self.image.format == self.format
-        assert self.image.pitch == self.pitch
-        
-        # Fill it with the contents of the in-progress image
-        in_progress_data = self.in_progress_image.get_data(self.format,
-                                                           self.pitch) 
-        self.image.set_data(self.format, self.pitch, in_progress_data)
-        self.texture = self.image.get_texture()
-        # Set tex attributes
-        # We'll be scaling it down to average the pixels, so use linear
-        # minification.
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, self.texture.id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+        if self.gpu_resident:
+            # The in-progress texture becomes the finished one. The next pass
+            # writes over the old finished texture, so its in-progress view
+            # starts from the pass before last.
+            self.texture, self.in_progress_texture = \
+                self.in_progress_texture, self.texture
+            return
+        if rect is None:
+            rect = (0, 0, self.size[0], self.size[1])
+        x, y, width, height = rect
+        for row in xrange(y, y + height):
+            start = (row * self.size[0] + x) * 4
+            end = start + width * 4
+            self.data[start:end] = self.in_progress_data[start:end]
+        self._upload(self.texture, self.data, rect)
+
+    def get_region(self, x, y, width, height, padding=0):
+        """Part of the lightmap that can be used as a lightmap on its own.
+
+        padding: Width of the gutter kept clear around the region
+
+        """
+        return LightmapRegion(self, (x, y), (width, height), padding)
+
+class LightmapRegion(object):
+    """Rectangle within a larger lightmap (e.g. an atlas), with the same
+    interface as Lightmap.
 
+    """
+    def __init__(self, lightmap, origin, size, padding=0):
+        """padding: Width of the gutter around the region. Edge texels are
+        copied into it whenever they're written.
+
+        """
+        self.lightmap = lightmap
+        self.origin = origin
+        self.size = size
+        self.padding = padding
 
-        
\ No newline at end of file
+        # Lightmap coords need squashing into the region
+        lightmap_width, lightmap_height = lightmap.size
+        self.tex_coord_transform = (
+               (float(origin[0]) / lightmap_width,
+                float(origin[1]) / lightmap_height),
+               (float(size[0]) / lightmap_width,
+                float(size[1]) / lightmap_height))
+
+    @property
+    def base_lightmap(self):
+        return self.lightmap
+
+    @property
+    def texture(self):
+        return self.lightmap.texture
+
+    @property
+    def in_progress_texture(self):
+        return self.lightmap.in_progress_texture
+
+    def set_value(self, texel, value):
+        texels = [texel]
+        if self.padding:
+            texels += get_gutter_texels(texel, self.size, self.padding)
+        for x, y in texels:
+            self.lightmap.set_value((x + self.origin[0], y + self.origin[1]),
+                                    value)
+
+    def update_from_in_progress(self):
+        # Include the gutter
+        self.lightmap.update_from_in_progress(
+                            (self.origin[0] - self.padding,
+                             self.origin[1] - self.padding,
+                             self.size[0] + 2 * self.padding,
+                             self.size[1] + 2 * self.padding))
@@ -0,0 +1,135 @@
+"""Level asset loading spread over worker threads and processes.
+
+Image decoding runs on a thread pool. Pure Python and NumPy work (.obj parsing
+and simplification, floor triangulation and building each room's vertex data)
+runs on a process pool so it isn't held back by the GIL. The results are
+cached or handed to the rooms, leaving only the OpenGL uploads for the main
+thread.
+
+The process pool should be started before anything imports pyglet.gl (see
+workers.py) and passed to use_process_pool, so the workers don't inherit the
+GL context. Otherwise each preload starts a pool of its own.
+
+"""
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import pyglet
+
+import mesh
+import utils
+
+DEFAULT_TEXTURE_PATH = "textures/default.png"
+
+# Triangulated floor polygons keyed by the (clockwise) vertex tuple and
+# whether they're Delaunay
+_triangle_cache = {}
+
+# Worker processes shared by every preload
+_process_pool = None
+
+# Stand-ins for what a worker needs to know about a room's images and its
+# neighbours, as the real ones can't be sent to another process
+_ImageSize = collections.namedtuple("_ImageSize", ("width", "height"))
+_Neighbour = collections.namedtuple("_Neighbour",
+                                    ("floor_height", "ceiling_height"))
+
+def use_process_pool(pool):
+    """Use the given multiprocessing pool for every preload from now on.
+
+    """
+    global _process_pool
+    _process_pool = pool
+
+def get_triangles(vertices, delaunay=False):
+    """Triangles for the given clockwise polygon, reusing the results of a
+    preload if there are any.
+
+    """
+    key = (tuple(vertices), delaunay)
+    if key not in _triangle_cache:
+        _triangle_cache[key] = utils.triangulate(key[0], delaunay)
+    return _triangle_cache[key]
+
+def _prepare_room(args):
+    """Worker function: the room's prepared data (see Room.prepare) from its
+    level data, its neighbours' heights by shared wall index and the sizes
+    of its images.
+
+    """
+    # The room module imports this one
+    from room import Room
+    room_data, neighbours, image_sizes = args
+    for path, size in image_sizes.items():
+        utils.cache_image(path, _ImageSize(*size))
+    room = Room(room_data)
+    room.shared_walls = dict([(i, _Neighbour(*heights))
+                              for i, heights in neighbours.items()])
+    return room.get_compiled_data()
+
+def clear_caches():
+    """Forget everything loaded so far, so changed files get reloaded.
+
+    """
+    _triangle_cache.clear()
+    utils.clear_image_cache()
+    mesh.clear_lod_cache()
+
+def preload(level_data, rooms=None, processes=None):
+    """Do the CPU-side loading for all the level's rooms and meshes in
+    parallel.
+
+    rooms: The level's rooms, with their shared walls set, if their vertex
+           data needs building (not needed for compiled levels)
+    processes: Number of workers in each pool (default: one per core)
+
+    """
+    clear_caches()
+
+    # Gather up the work
+    image_paths = set()
+    mesh_paths = set()
+    for room_data in level_data["rooms"]:
+        for key in "floor_texture", "ceiling_texture", "wall_texture":
+            image_paths.add(room_data.get(key, DEFAULT_TEXTURE_PATH))
+        for mesh_data in room_data.get("meshes", []):
+            mesh_paths.add(mesh_data["path"])
+            image_paths.add(mesh_data.get("texture", DEFAULT_TEXTURE_PATH))
+    image_paths = sorted(image_paths)
+    mesh_paths = sorted(mesh_paths)
+
+    thread_pool = ThreadPool(processes)
+    process_pool = _process_pool
+    if process_pool is None:
+        process_pool = multiprocessing.Pool(processes)
+    try:
+        images = thread_pool.map_async(pyglet.image.load, image_paths)
+        lod_data = process_pool.map_async(mesh.generate_lod_data, mesh_paths)
+
+        # Rooms need the sizes of their images for texture coords
+        image_sizes = {}
+        for path, image in zip(image_paths, images.get()):
+            utils.cache_image(path, image)
+            image_sizes[path] = (image.width, image.height)
+        room_args = []
+        for room, room_data in zip(rooms or [], level_data["rooms"]):
+            neighbours = dict([(i, (other.floor_height, other.ceiling_height))
+                               for i, other in room.shared_walls.items()])
+            paths = (room.floor_texture_path, room.ceiling_texture_path,
+                     room.wall_texture_path)
+            room_image_sizes = dict([(path, image_sizes[path])
+                                     for path in paths])
+            room_args.append((room_data, neighbours, room_image_sizes))
+        prepared_data = process_pool.map_async(_prepare_room, room_args)
+
+        for path, data in zip(mesh_paths, lod_data.get()):
+            mesh.cache_lod_data(path, data)
+        for room, data in zip(rooms or [], prepared_data.get()):
+            room.prepared_data = data
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+        if process_pool is not _process_pool:
+            process_pool.close()
+            process_pool.join()
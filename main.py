@@ -1,28 +1,52 @@
 #!/usr/bin/env python
 import os
+import sys
 import pyglet
-from game import Game
-from view import View
-from window import Window
+import workers
 
 def main():
+    # Start the loader's workers before pyglet.gl is imported below (see
+    # workers.py)
+    process_pool = workers.create_pool()
+    import loader
+    from game import Game, STEP_TIME
+    from view import View, RENDERER_FIXED, RENDERER_SHADER
+    from window import Window
+    loader.use_process_pool(process_pool)
+    
+    # Draw the 3D view with shaders if asked to
+    renderer = RENDERER_FIXED
+    if "--shaders" in sys.argv[1:]:
+        renderer = RENDERER_SHADER
+    
     # Resources should be loaded relative to the resources dir
     resources_dir = os.path.join(os.path.dirname(__file__), "resources")
     os.chdir(resources_dir)
     game = Game()
-    view = View(game)
+    # GPU memory budget in megabytes, e.g. --gpu-budget=256
+    for arg in sys.argv[1:]:
+        if arg.startswith("--gpu-budget="):
+            game.gpu_budget = int(float(arg.split("=", 1)[1]) * 1024 * 1024)
+    view = View(game, renderer)
+    # Skip rooms and meshes hidden behind others if asked to
+    view.occlusion_culling = "--occlusion" in sys.argv[1:]
     # Retain cycle
     game.view = view
     game.refresh_from_files()
     
     window = Window(view=view, width=800, height=500)
-    pyglet.clock.schedule_interval(game.update, 1.0 / 60.0)
+    # Update once per simulation step rather than as often as possible, so
+    # the main loop sleeps between frames instead of spinning a core
+    pyglet.clock.schedule_interval(game.update, STEP_TIME)
+    pyglet.clock.schedule_interval(game.update_radiosity, STEP_TIME)
     
     # import radiosity
     # map = radiosity.get_shape_compensation_map()
     # map.save("/tmp/map.png")
     
     pyglet.app.run()
+    process_pool.close()
+    process_pool.join()
 
 if __name__ == "__main__":
     main()
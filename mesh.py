@@ -1,5 +1,293 @@
+import math
+import heapq
+import numpy
 import pyglet
-from pyglet.gl import * 
+from pyglet.gl import *
+
+import utils
+from shaders import POSITION_ATTRIBUTE, TEX_COORD_ATTRIBUTE
+from gpumemory import gpu_memory, MESH
+
+# Fraction of the full-detail triangle count kept by each level of detail.
+# Level 0 is always the original mesh.
+LOD_RATIOS = (1.0, 0.5, 0.25, 0.1)
+
+# Minimum projected size (bounding sphere diameter in pixels) for each level
+# of detail except the last, which is used for anything smaller.
+LOD_SCREEN_SIZES = (300.0, 120.0, 40.0)
+
+# Simplified data keyed by .obj path, so meshes used more than once are only
+# parsed and simplified once.
+_lod_cache = {}
+
+def parse_obj(obj_data):
+    """Read .obj data and return indexed triangles.
+
+    Returns a list of corners (tuples of xyz position and uv texture
+    coordinates) and a list of triangles (tuples of three corner indexes).
+    Corners sharing a position but not texture coordinates are kept separate,
+    so texture seams are preserved.
+
+    """
+    # We can't start putting together the actual vertex data until we've
+    # read the whole file, so populate these lists with data from the file
+    vertices = []  # Tuples of xyz coords (always 3 components)
+    tex_coords = []  # Tuples of texture coordinates, 2 components
+    faces = []  # Indexes of vertices making up the faces, 3 or 4
+
+    for line in obj_data.split("\n"):
+        if line.startswith("v "):
+            # Vertex position data; get three floats
+            vertex_components = [float(string_rep) for
+                                 string_rep in line[2:].split(" ")]
+            # Swap y and z because we're using z as up
+            vertex = (vertex_components[0], vertex_components[2],
+                      vertex_components[1])
+
+            vertices.append(vertex)
+        elif line.startswith("f "):
+            face_data = line[2:].split(" ")
+            corners = []  # Three or four items
+            for vertex_data in face_data:  # e.g. 1/2/3
+                # Subtract one from indexes because they start at one
+                vertex_data = [int(string_rep) - 1 for
+                               string_rep in vertex_data.split("/")]
+                # vertex_index, normal_index, tex_coord_index = vertex_data
+                corners.append(tuple(vertex_data))
+            faces.append(tuple(corners))
+        elif line.startswith("vt "):
+            # Vertex position data; get three floats
+            tex_coord_components = [float(string_rep) for
+                                    string_rep in line[3:].split(" ")]
+            tex_coords.append(tuple(tex_coord_components))
+
+    # Now start assembling the indexed data
+    corners = []
+    corner_indexes = {}  # Key: (vertex index, tex coord index)
+    triangles = []
+    for face in faces:
+        face_corners = []
+        for corner in face:
+            key = (corner[0], corner[1])
+            if key not in corner_indexes:
+                corner_indexes[key] = len(corners)
+                corners.append((vertices[corner[0]], tex_coords[corner[1]]))
+            face_corners.append(corner_indexes[key])
+        # Triangulate quads
+        if len(face_corners) == 3:
+            triangles.append(tuple(face_corners))
+        elif len(face_corners) == 4:
+            triangles.append((face_corners[0], face_corners[1],
+                              face_corners[2]))
+            triangles.append((face_corners[0], face_corners[2],
+                              face_corners[3]))
+        else:
+            raise RuntimeError("Invalid .obj data - %i verts in face" %
+                               len(face_corners))
+    return corners, triangles
+
+def _get_normal(a, b, c):
+    """Unnormalised normal of the triangle made by three 3D points.
+
+    """
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+
+def simplify(corners, triangles, target_count):
+    """Reduce the triangle count using half-edge collapses.
+
+    The shortest edges are collapsed first, with one end moved onto the
+    other. Corners that are moved take the texture coordinates of the corner
+    they're merged into, so the texture stays continuous within each texture
+    island. Positions on open edges never move, so holes don't appear.
+
+    Returns new lists of corners and triangles.
+
+    """
+    corners = list(corners)
+    triangles = [list(triangle) for triangle in triangles]
+    live_count = len(triangles)
+
+    # Corners at the same position are one vertex as far as the shape of the
+    # mesh is concerned
+    position_ids = {}
+    corner_positions = []
+    for position, _ in corners:
+        position_ids.setdefault(position, len(position_ids))
+        corner_positions.append(position_ids[position])
+    positions = [None] * len(position_ids)
+    for position, position_id in position_ids.items():
+        positions[position_id] = position
+
+    # Triangles using each position, and edge use counts
+    position_triangles = {}
+    edge_counts = {}
+    for triangle_index, triangle in enumerate(triangles):
+        triangle_positions = [corner_positions[c] for c in triangle]
+        for i in range(3):
+            a = triangle_positions[i]
+            b = triangle_positions[(i + 1) % 3]
+            position_triangles.setdefault(a, set()).add(triangle_index)
+            edge = (min(a, b), max(a, b))
+            edge_counts[edge] = edge_counts.get(edge, 0) + 1
+
+    # Positions on open or non-manifold edges stay where they are
+    locked = set()
+    for edge, count in edge_counts.items():
+        if count != 2:
+            locked.update(edge)
+
+    def get_neighbours(position):
+        neighbours = set()
+        for triangle_index in position_triangles[position]:
+            for corner in triangles[triangle_index]:
+                neighbours.add(corner_positions[corner])
+        neighbours.discard(position)
+        return neighbours
+
+    def get_length(a, b):
+        pos_a = positions[a]
+        pos_b = positions[b]
+        return math.sqrt(sum([(pos_b[i] - pos_a[i]) ** 2 for i in range(3)]))
+
+    # Candidate collapses, shortest first. Positions never change, so
+    # lengths stay valid; stale entries are checked for when popped.
+    heap = []
+    for a, b in edge_counts:
+        length = get_length(a, b)
+        if a not in locked:
+            heap.append((length, a, b))
+        if b not in locked:
+            heap.append((length, b, a))
+    heapq.heapify(heap)
+
+    while live_count > target_count and heap:
+        _, source, dest = heapq.heappop(heap)
+        if source not in position_triangles or dest not in position_triangles:
+            continue
+        source_neighbours = get_neighbours(source)
+        if dest not in source_neighbours:
+            continue
+
+        # Link condition: an interior edge is shared by exactly two
+        # triangles, so the two ends should have exactly two neighbours in
+        # common. Any more would pinch the surface.
+        if len(source_neighbours & get_neighbours(dest)) != 2:
+            continue
+
+        # Split the triangles around the source into those that disappear
+        # and those that get stretched
+        removed = []
+        moved = []
+        for triangle_index in position_triangles[source]:
+            triangle = triangles[triangle_index]
+            triangle_positions = [corner_positions[c] for c in triangle]
+            if dest in triangle_positions:
+                removed.append(triangle_index)
+            else:
+                moved.append(triangle_index)
+
+        # Make sure moving the position doesn't flip any remaining triangle
+        flips = False
+        for triangle_index in moved:
+            triangle_positions = [corner_positions[c]
+                                  for c in triangles[triangle_index]]
+            points = [positions[p] for p in triangle_positions]
+            before = _get_normal(*points)
+            points[triangle_positions.index(source)] = positions[dest]
+            after = _get_normal(*points)
+            if sum([before[i] * after[i] for i in range(3)]) <= 0.0:
+                flips = True
+                break
+        if flips:
+            continue
+
+        # Source corners that touch the collapsed edge merge into the
+        # destination corner of the same texture island
+        replacements = {}
+        for triangle_index in removed:
+            triangle = triangles[triangle_index]
+            triangle_positions = [corner_positions[c] for c in triangle]
+            source_corner = triangle[triangle_positions.index(source)]
+            dest_corner = triangle[triangle_positions.index(dest)]
+            replacements.setdefault(source_corner, dest_corner)
+            for corner in triangle:
+                position = corner_positions[corner]
+                if position != source:
+                    position_triangles[position].discard(triangle_index)
+            triangles[triangle_index] = None
+            live_count -= 1
+
+        # Other source corners keep their texture coordinates
+        for triangle_index in moved:
+            triangle = triangles[triangle_index]
+            for i, corner in enumerate(triangle):
+                if corner_positions[corner] != source:
+                    continue
+                if corner not in replacements:
+                    replacements[corner] = len(corners)
+                    corners.append((positions[dest], corners[corner][1]))
+                    corner_positions.append(dest)
+                triangle[i] = replacements[corner]
+            position_triangles[dest].add(triangle_index)
+        del position_triangles[source]
+
+        # New edges around the destination
+        if dest not in locked:
+            for neighbour in source_neighbours:
+                if neighbour != dest and neighbour in position_triangles:
+                    heapq.heappush(heap, (get_length(dest, neighbour),
+                                          dest, neighbour))
+
+    return corners, [tuple(triangle) for triangle in triangles if triangle]
+
+def get_lod_data(path):
+    """Interleaved vertex data (xyz, uv) for each level of detail of the .obj
+    file at the given path, along with the bounding box of the full mesh.
+
+    """
+    if path not in _lod_cache:
+        _lod_cache[path] = generate_lod_data(path)
+    return _lod_cache[path]
+
+def cache_lod_data(path, lod_data):
+    """Store data generated by generate_lod_data (e.g. in another process) so
+    get_lod_data won't need to generate it again.
+
+    """
+    _lod_cache[path] = lod_data
+
+def clear_lod_cache():
+    _lod_cache.clear()
+
+def generate_lod_data(path):
+    """Uncached version of get_lod_data.
+
+    """
+    corners, triangles = parse_obj(open(path).read())
+
+    # Bounding box of the mesh (min xyz, max xyz)
+    positions = [corner[0] for corner in corners]
+    bounds = (tuple([min([p[i] for p in positions]) for i in range(3)]),
+              tuple([max([p[i] for p in positions]) for i in range(3)]))
+
+    lod_data = []
+    lod_corners = corners
+    lod_triangles = triangles
+    for ratio in LOD_RATIOS:
+        target_count = int(len(triangles) * ratio)
+        if len(lod_triangles) > target_count:
+            lod_corners, lod_triangles = simplify(lod_corners, lod_triangles,
+                                                  target_count)
+        vertex_data = []
+        for triangle in lod_triangles:
+            for corner in triangle:
+                vertex_data.extend(lod_corners[corner][0])
+                vertex_data.extend(lod_corners[corner][1])
+        lod_data.append(vertex_data)
+
+    return lod_data, bounds
 
 class Mesh(object):
     def __init__(self, data, room):
@@ -7,76 +295,126 @@ class Mesh(object):
         self.position = tuple(data["position"])  # 3D coords
         if len(self.position) == 2:
             self.position = (self.position[0], self.position[1], room.floor_height)
-        obj_data = open(path).read()
         texture_path = data.get("texture", "textures/default.png")
-        texture_image = pyglet.image.load(texture_path)
-        self.texture = texture_image.get_texture()
-        
-        # We can't start putting together the actual vertex data until we've
-        # read the whole file, so populate these lists with data from the file
-        vertices = []  # Tuples of xyz coords (always 3 components)
-        tex_coords = []  # Tuples of texture coordinates, 2 components
-        faces = []  # Indexes of vertices making up the faces, 3 or 4
-        
-        for line in obj_data.split("\n"):
-            if line.startswith("v "):
-                # Vertex position data; get three floats
-                vertex_components = [float(string_rep) for
-                                     string_rep in line[2:].split(" ")]
-                # Swap y and z because we're using z as up
-                vertex = (vertex_components[0], vertex_components[2],
-                          vertex_components[1])
-                                     
-                vertices.append(vertex)
-            elif line.startswith("f "):
-                face_data = line[2:].split(" ")
-                corners = []  # Three or four items
-                for vertex_data in face_data:  # e.g. 1/2/3
-                    # Subtract one from indexes because they start at one
-                    vertex_data = [int(string_rep) - 1 for
-                                   string_rep in vertex_data.split("/")]
-                    # vertex_index, normal_index, tex_coord_index = vertex_data
-                    corners.append(tuple(vertex_data))
-                faces.append(tuple(corners))
-            elif line.startswith("vt "):
-                # Vertex position data; get three floats
-                tex_coord_components = [float(string_rep) for
-                                        string_rep in line[3:].split(" ")]
-                tex_coords.append(tuple(tex_coord_components))
-                
-        # Now start assembling the intermediate data structures
-        vertex_data = []
-        for face in faces:
-            face_verts = [vertices[corner[0]] for corner in face]
-            face_tex_coords = [tex_coords[corner[1]] for corner in face]
-            # Triangulate quads
-            if len(face_verts) == 3:
-                for corner_vert, corner_tex_coords in zip(face_verts, face_tex_coords):
-                    vertex_data.extend(corner_vert)
-                    vertex_data.extend(corner_tex_coords)
-            elif len(face_verts) == 4:
-                triangle_indices = (0, 1, 2, 0, 2, 3)
-                for i in triangle_indices:
-                    vertex_data.extend(face_verts[i])
-                    vertex_data.extend(face_tex_coords[i])
-                # vertex_data.extend((face_verts[0], face_verts[1], face_verts[2]))
-                # vertex_data.extend((face_tex_coords[0], face_tex_coords[1], face_tex_coords[2]))
-                # vertex_data.extend((face_verts[0], face_verts[2], face_verts[3]))
-                # vertex_data.extend((face_tex_coords[0], face_tex_coords[2], face_tex_coords[3]))
-            else:
-                raise RuntimeError("Invalid .obj data - %i verts in face" %
-                                   len(face_verts))
-        
-        # Now put together the vertex buffer object
-        self.data_vbo = GLuint()
-        self.data_count = len(vertex_data)
-        glGenBuffers(1, self.data_vbo)
-        
-        # Floor: put it in an array of GLfloats
-        data = (GLfloat*self.data_count)(*vertex_data)
-        # Add the data to the FBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.data_vbo)
-        glBufferData(GL_ARRAY_BUFFER, sizeof(data), data,
-                     GL_STATIC_DRAW)
-        
-        self.data_count /= 5
+        self.texture = utils.load_texture(texture_path, owner_kind=MESH)
+
+        lod_data, bounds = get_lod_data(path)
+
+        # Bounding box in world space (min xyz, max xyz), for culling
+        min_bound, max_bound = bounds
+        self.bounding_volume = (
+                tuple([self.position[i] + min_bound[i] for i in range(3)]),
+                tuple([self.position[i] + max_bound[i] for i in range(3)]))
+
+        # Bounding sphere in world space, used to pick the level of detail
+        self.center = tuple([self.position[i] +
+                             (min_bound[i] + max_bound[i]) / 2.0
+                             for i in range(3)])
+        self.radius = math.sqrt(sum([((max_bound[i] - min_bound[i]) / 2.0) ** 2
+                                     for i in range(3)]))
+
+        # Now put together a vertex buffer object for each level of detail
+        self.lod_vbos = []
+        self.lod_counts = []
+        self.lod_bytes = []
+        for vertex_data in lod_data:
+            data_vbo = GLuint()
+            glGenBuffers(1, data_vbo)
+
+            # Put it in a contiguous float32 array
+            data = numpy.asarray(vertex_data, dtype=numpy.float32)
+            # Add the data to the FBO
+            glBindBuffer(GL_ARRAY_BUFFER, data_vbo)
+            glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data,
+                         GL_STATIC_DRAW)
+            gpu_memory.add(MESH, self, ("buffer", data_vbo.value),
+                           data.nbytes)
+
+            self.lod_vbos.append(data_vbo)
+            self.lod_counts.append(len(vertex_data) // 5)
+            self.lod_bytes.append(data.nbytes)
+
+        # Full detail data
+        self.data_vbo = self.lod_vbos[0]
+        self.data_count = self.lod_counts[0]
+
+        # Vertex array objects for each level of detail, only made if the
+        # shader renderer is used (see bind_lod_vao)
+        self.lod_vaos = {}
+
+        # Most detailed level still on the GPU (see drop_lod)
+        self.min_lod = 0
+
+    def bind_lod_vao(self, lod):
+        """Bind the vertex array object for the level of detail, creating it
+        the first time.
+
+        """
+        if lod not in self.lod_vaos:
+            vao = GLuint()
+            glGenVertexArrays(1, vao)
+            glBindVertexArray(vao)
+            glBindBuffer(GL_ARRAY_BUFFER, self.lod_vbos[lod])
+            stride = 5 * sizeof(GLfloat)
+            glEnableVertexAttribArray(POSITION_ATTRIBUTE)
+            glVertexAttribPointer(POSITION_ATTRIBUTE, 3, GL_FLOAT, GL_FALSE,
+                                  stride, 0)
+            glEnableVertexAttribArray(TEX_COORD_ATTRIBUTE)
+            glVertexAttribPointer(TEX_COORD_ATTRIBUTE, 2, GL_FLOAT, GL_FALSE,
+                                  stride, 3 * sizeof(GLfloat))
+            self.lod_vaos[lod] = vao
+        else:
+            glBindVertexArray(self.lod_vaos[lod])
+
+    @property
+    def can_drop_lod(self):
+        return self.min_lod < len(self.lod_vbos) - 1
+
+    def drop_lod(self):
+        """Delete the most detailed level of detail left, to save GPU memory.
+        The next level is drawn instead. The coarsest level is always kept.
+
+        """
+        if not self.can_drop_lod:
+            return
+        lod = self.min_lod
+        if lod in self.lod_vaos:
+            glDeleteVertexArrays(1, self.lod_vaos.pop(lod))
+        gpu_memory.remove(MESH, self, ("buffer", self.lod_vbos[lod].value))
+        glDeleteBuffers(1, self.lod_vbos[lod])
+        self.lod_vbos[lod] = None
+        self.min_lod += 1
+
+    def delete(self):
+        """Delete the vertex buffers and vertex array objects.
+
+        """
+        for vao in self.lod_vaos.values():
+            glDeleteVertexArrays(1, vao)
+        self.lod_vaos = {}
+        for data_vbo in self.lod_vbos:
+            if data_vbo is not None:
+                glDeleteBuffers(1, data_vbo)
+        gpu_memory.remove(MESH, self)
+        self.lod_vbos = []
+        self.lod_counts = []
+        self.lod_bytes = []
+
+    def get_lod(self, eye, focal_length, lod_bias=0):
+        """Index of the level of detail to draw from the given eye position.
+
+        focal_length: Pixels per unit at a distance of one unit
+        lod_bias: Number of levels coarser than the projected size suggests
+
+        """
+        distance = math.sqrt(sum([(self.center[i] - eye[i]) ** 2
+                                  for i in range(3)]))
+        distance = max(distance - self.radius, 0.001)
+        projected_size = 2.0 * self.radius * focal_length / distance
+
+        for lod, screen_size in enumerate(LOD_SCREEN_SIZES):
+            if projected_size >= screen_size:
+                break
+        else:
+            lod = len(LOD_SCREEN_SIZES)
+        return min(max(lod + lod_bias, self.min_lod), len(self.lod_vbos) - 1)
@@ -0,0 +1,198 @@
+"""Occlusion culling with GPU queries.
+
+After a view has been drawn, the bounding box of every room and mesh that
+might have been drawn is rendered (without writing colour or depth) inside an
+occlusion query. The next time the same view is drawn, anything whose box
+didn't pass a single sample is skipped. Results are only read once the GPU
+says they're ready, so a result is usually a frame old, and nothing waits for
+the GPU.
+
+Anything without a result yet is drawn, and so is anything whose box the
+camera is inside, so the stage can only make mistakes for a frame when
+something suddenly comes into view. Results are kept separately for each
+view. For the radiosity hemicube faces that means they come from the previous
+sample, which is normally the neighbouring lightmap texel; the view forgets
+them when radiosity moves on to another lightmap, as its texels can be in
+another room.
+
+"""
+import numpy
+
+from pyglet.gl import *
+
+import camera
+from renderstats import frame_stats
+from gpumemory import gpu_memory, VIEW
+
+# Bounding boxes are grown by this much, so they aren't hidden by the surfaces
+# lying on them (e.g. a room's own walls)
+BOX_MARGIN = 0.05
+
+# Corners of a box for each of its 12 triangles, as indexes into
+# (min x, min y, min z, max x, max y, max z)
+_CORNERS = [(0, 1, 2), (3, 1, 2), (3, 4, 2), (0, 4, 2),
+            (0, 1, 5), (3, 1, 5), (3, 4, 5), (0, 4, 5)]
+_BOX_TRIANGLES = [(0, 1, 2), (0, 2, 3), (4, 6, 5), (4, 7, 6),
+                  (0, 4, 5), (0, 5, 1), (1, 5, 6), (1, 6, 2),
+                  (2, 6, 7), (2, 7, 3), (3, 7, 4), (3, 4, 0)]
+BOX_VERTEX_INDEXES = numpy.array([_CORNERS[corner]
+                                  for triangle in _BOX_TRIANGLES
+                                  for corner in triangle])
+BOX_VERTEX_COUNT = len(BOX_VERTEX_INDEXES)
+
+def get_box_vertices(boxes):
+    """Triangle vertices for an (N, 6) array of boxes (min xyz, max xyz), as
+    an (N * 36, 3) float32 array.
+
+    """
+    vertices = boxes[:, BOX_VERTEX_INDEXES]
+    return numpy.ascontiguousarray(vertices.reshape(-1, 3),
+                                   dtype=numpy.float32)
+
+class OcclusionCuller(object):
+    def __init__(self):
+        # Key: view key, value: set of objects found to be hidden
+        self._occluded = {}
+        # Key: view key, value: {object: query} waiting for results
+        self._pending = {}
+        self._free_queries = []
+        self.box_vbo = None
+
+    def _get_query(self):
+        if self._free_queries:
+            return self._free_queries.pop()
+        query = GLuint()
+        glGenQueries(1, query)
+        return query
+
+    def collect(self):
+        """Read every query result that's ready, without waiting.
+
+        """
+        for view_key, pending in self._pending.items():
+            occluded = self._occluded.setdefault(view_key, set())
+            for thing, query in pending.items():
+                available = GLint()
+                glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE,
+                                   available)
+                if not available.value:
+                    continue
+                samples = GLuint()
+                glGetQueryObjectuiv(query, GL_QUERY_RESULT, samples)
+                if samples.value:
+                    occluded.discard(thing)
+                else:
+                    occluded.add(thing)
+                del pending[thing]
+                self._free_queries.append(query)
+
+    def _contains_eye(self, thing, eye):
+        box_min, box_max = thing.bounding_volume
+        for i in range(3):
+            if not (box_min[i] - BOX_MARGIN <= eye[i] <=
+                    box_max[i] + BOX_MARGIN):
+                return False
+        return True
+
+    def is_visible(self, view_key, thing, eye):
+        """Whether the room or mesh should be drawn in the view, as far as
+        the last results go.
+
+        """
+        occluded = self._occluded.get(view_key)
+        if not occluded or thing not in occluded:
+            return True
+        return self._contains_eye(thing, eye)
+
+    def issue_queries(self, view_key, things, eye, matrices=None):
+        """Test the bounding boxes of the rooms and meshes against the depth
+        buffer of the view just drawn. Call after drawing the view, with
+        everything that passed the other culling (including anything that
+        is_visible skipped, so it can come back).
+
+        matrices: Projection and view matrices (see camera.py); the current
+                  matrices are used if they aren't given
+
+        """
+        pending = self._pending.setdefault(view_key, {})
+        # Old results for things out of view are stale
+        occluded = self._occluded.setdefault(view_key, set())
+        occluded.intersection_update(things)
+
+        # Things the camera's inside are always visible, and anything with a
+        # query in flight keeps it
+        things = [thing for thing in things if thing not in pending and
+                  not self._contains_eye(thing, eye)]
+        if not things:
+            return
+
+        boxes = numpy.array([thing.bounding_volume[0] +
+                             thing.bounding_volume[1]
+                             for thing in things], dtype=numpy.float64)
+        boxes[:, :3] -= BOX_MARGIN
+        boxes[:, 3:] += BOX_MARGIN
+        vertices = get_box_vertices(boxes)
+        if self.box_vbo is None:
+            self.box_vbo = GLuint()
+            glGenBuffers(1, self.box_vbo)
+        glBindBuffer(GL_ARRAY_BUFFER, self.box_vbo)
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices.ctypes.data,
+                     GL_STREAM_DRAW)
+        gpu_memory.add(VIEW, self, ("buffer", self.box_vbo.value),
+                       vertices.nbytes)
+
+        # Only depth testing; boxes don't change the image
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT |
+                     GL_DEPTH_BUFFER_BIT)
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        glDepthMask(GL_FALSE)
+        glEnable(GL_DEPTH_TEST)
+        glDisable(GL_CULL_FACE)
+        glDisable(GL_TEXTURE_2D)
+        if matrices is not None:
+            for matrix_mode in GL_PROJECTION, GL_MODELVIEW:
+                glMatrixMode(matrix_mode)
+                glPushMatrix()
+            camera.load_matrices(*matrices)
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, 0)
+        for i, thing in enumerate(things):
+            query = self._get_query()
+            glBeginQuery(GL_SAMPLES_PASSED, query)
+            glDrawArrays(GL_TRIANGLES, i * BOX_VERTEX_COUNT, BOX_VERTEX_COUNT)
+            glEndQuery(GL_SAMPLES_PASSED)
+            pending[thing] = query
+        glDisableClientState(GL_VERTEX_ARRAY)
+        frame_stats.draw_calls += len(things)
+        frame_stats.state_changes += 1
+
+        if matrices is not None:
+            for matrix_mode in GL_PROJECTION, GL_MODELVIEW:
+                glMatrixMode(matrix_mode)
+                glPopMatrix()
+        glPopAttrib()
+
+    def forget(self, view_key):
+        """Throw away the view's results, and any queries it's waiting on.
+
+        """
+        self._occluded.pop(view_key, None)
+        self._free_queries.extend(self._pending.pop(view_key, {}).values())
+
+    def delete(self):
+        """Delete the queries and the box buffer.
+
+        """
+        queries = self._free_queries[:]
+        for pending in self._pending.values():
+            queries.extend(pending.values())
+        for query in queries:
+            glDeleteQueries(1, query)
+        self._free_queries = []
+        self._pending = {}
+        self._occluded = {}
+        if self.box_vbo is not None:
+            glDeleteBuffers(1, self.box_vbo)
+            gpu_memory.remove(VIEW, self)
+            self.box_vbo = None
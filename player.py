@@ -3,6 +3,7 @@ import inputstates
 import pymunk
 import utils
 from utils import PLAYER_COLLISION_TYPE
+from utils import SOLID_WALL_LAYER, OPEN_WALL_LAYER
 
 # Movement properties
 WALK_SPEED = 3.0
@@ -20,43 +21,22 @@ MASS = 10.0
 FRICTION = 0.0
 RADIUS = 0.4
 
-def on_player_hit_wall(space, arbiter):
+# Solver iterations: a few when the player isn't touching anything, more for
+# each wall they're pushing against
+MIN_SOLVER_ITERATIONS = 10
+SOLVER_ITERATIONS_PER_CONTACT = 10
+MAX_SOLVER_ITERATIONS = 100
+
+def on_player_touch_wall(space, arbiter):
     player_shape, wall_shape = arbiter.shapes
-    player = player_shape.player
-    room = wall_shape.room
-    wall_index = wall_shape.wall_index
-    
-    
-    
-    # float maxPlayerFootLevel = player.pos.y+1.9;
-    
-    # Maximum height we can step up to
-    max_step_height = player.z_pos + MAX_STEP_HEIGHT
-    
-    if wall_index in room.shared_walls:
-        other_room = room.shared_walls[wall_index]
-        # Check if either of the floors are higher than the player's maximum
-        # step height
-        if (room.floor_height > max_step_height or
-            other_room.floor_height > max_step_height):
-            return True
-        
-        # Check if either of the ceilings are lower the player's head
-        if (room.ceiling_height < player.head_height or
-            other_room.ceiling_height < player.head_height):
-            return True
-        
-        # Check if either of the adjoining rooms are too short
-        if (room.ceiling_height - room.floor_height < player.tallness or
-            other_room.ceiling_height - other_room.floor_height < player.tallness):
-            return True
-        
-        # It's an adjoining room we can walk into; don't collide
-        return False
-    
-    # It's a solid wall; collide
+    player_shape.player.wall_contacts += 1
     return True
 
+def on_player_leave_wall(space, arbiter):
+    player_shape, wall_shape = arbiter.shapes
+    player = player_shape.player
+    player.wall_contacts = max(player.wall_contacts - 1, 0)
+
 class Player(object):
     def __init__(self, data):
         self.game = None
@@ -65,6 +45,8 @@ class Player(object):
         # Physical representation
         self.body = None
         self.radius = RADIUS
+        # Number of walls the player is touching
+        self.wall_contacts = 0
 
         # Position in space
         self.position = tuple(data["position"])
@@ -74,6 +56,13 @@ class Player(object):
         self.z_speed = 0.0
         self.tallness = self.z_pos + HEIGHT
         
+        # State at the start of the last simulation step, and how far the
+        # current frame is from there to the current state (0.0 - 1.0)
+        self.previous_position = None
+        self.previous_heading = None
+        self.previous_eye_height = None
+        self.interpolation = 1.0
+        
         # Keep track of input (use constants - FORWARDS etc.)
         self.input_states = set()
         # Player has to press space once for each jump
@@ -120,6 +109,47 @@ class Player(object):
         # Add the current z position to the eye height
         return self.tallness - (HEIGHT - EYE_HEIGHT) + self.z_pos
     
+    @property
+    def interpolated_position(self):
+        """2D position to draw the player at, between the last two steps.
+        
+        """
+        position = tuple(self.position)
+        if self.previous_position is None:
+            return position
+        return (utils.lerp(self.previous_position[0], position[0],
+                           self.interpolation),
+                utils.lerp(self.previous_position[1], position[1],
+                           self.interpolation))
+    
+    @property
+    def interpolated_heading(self):
+        """Heading to draw the player with, between the last two steps.
+        
+        """
+        if self.previous_heading is None:
+            return self.heading
+        return utils.lerp(self.previous_heading, self.heading,
+                          self.interpolation)
+    
+    @property
+    def interpolated_eye_height(self):
+        """Eye height to draw the player with, between the last two steps.
+        
+        """
+        if self.previous_eye_height is None:
+            return self.eye_height
+        return utils.lerp(self.previous_eye_height, self.eye_height,
+                          self.interpolation)
+    
+    def store_previous_state(self):
+        """Remember the state before a simulation step, to interpolate from.
+        
+        """
+        self.previous_position = tuple(self.position)
+        self.previous_heading = self.heading
+        self.previous_eye_height = self.eye_height
+    
     @property
     def current_room(self):
         """The current room that the player is in. Pass a list of all rooms
@@ -128,20 +158,31 @@ class Player(object):
         """
         return self._current_room
         
+    def place(self, position, heading, pitch=0.0):
+        """Move the player straight to the given 2D position and direction,
+        standing on the floor, without simulating (e.g. for a scripted
+        camera).
+        
+        """
+        self.position = tuple(position)
+        self.heading = heading
+        self.pitch = pitch
+        self._current_room = self.get_current_room()
+        if self._current_room is not None:
+            self.z_pos = self._current_room.floor_height
+        self.z_speed = 0.0
+        # Nothing to interpolate from
+        self.previous_position = None
+        self.previous_heading = None
+        self.previous_eye_height = None
+    
     def get_current_room(self):
-        distant_point = (0.0, 1e10)
-        player_to_distance = (tuple(self.position), distant_point)
-        for room in self.game.rooms:
-            # Count the times it crosses the room's boundary. Odd = inside.
-            cross_count = 0
-            for wall in room.walls:
-                if utils.lines_intersect(player_to_distance, wall):
-                    cross_count += 1
-            if cross_count % 2 == 1:
-                return room
-        
-        # Inside no room
-        return None
+        """Look up the room containing the player, starting with the room
+        they were in last time.
+        
+        """
+        return self.game.room_index.find_room(tuple(self.position),
+                                              self._current_room)
         
     def add_to_space(self, space):
         self.dragger = pymunk.Body(MASS, pymunk.inf)
@@ -155,12 +196,44 @@ class Player(object):
         self.shape = pymunk.Circle(self.body, self.radius)
         self.shape.friction = FRICTION
         self.shape.collision_type = PLAYER_COLLISION_TYPE
+        self.shape.layers = SOLID_WALL_LAYER
         self.shape.player = self
         space.add(self.shape)
         
         constraint = pymunk.PinJoint(self.body, self.dragger)
         space.add(constraint)
     
+    @property
+    def solver_iterations(self):
+        """Collision solver iterations needed for the walls being touched.
+        
+        """
+        return min(MIN_SOLVER_ITERATIONS +
+                   SOLVER_ITERATIONS_PER_CONTACT * self.wall_contacts,
+                   MAX_SOLVER_ITERATIONS)
+    
+    def update_wall_layers(self):
+        """Open the walls between rooms that the player fits through and
+        close the rest. Only walls around the player's room are checked, and
+        shapes are only changed when the result does.
+        
+        """
+        room = self.current_room
+        if room is None:
+            return
+        max_step_height = self.z_pos + MAX_STEP_HEIGHT
+        head_height = self.head_height
+        portals = self.game.portals
+        for nearby_room in [room] + portals.get_neighbours(room):
+            for portal in portals.get_portals(nearby_room):
+                if portal.fits(max_step_height, head_height, self.tallness):
+                    layers = OPEN_WALL_LAYER
+                else:
+                    layers = SOLID_WALL_LAYER
+                shape = nearby_room.wall_shapes[portal.wall_index]
+                if shape.layers != layers:
+                    shape.layers = layers
+    
     def input_changed(self, state, value):
         """Record the change in input on the player object.
         
@@ -290,6 +363,10 @@ class Player(object):
 
     def on_mouse_moved(self, dx, dy):
         self.heading -= dx / 100.0
+        # Looking around takes effect straight away rather than at the next
+        # step, so move the interpolation's start point too
+        if self.previous_heading is not None:
+            self.previous_heading -= dx / 100.0
         self.pitch += dy / 100.0
         if self.pitch< -math.pi / 2:
             self.pitch = -math.pi / 2
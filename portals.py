@@ -0,0 +1,121 @@
+"""The graph of rooms connected by shared walls (portals).
+
+Rooms are wound the same way, so a wall shared by two rooms runs in opposite
+directions in each. Every directed wall is hashed by its end points, and each
+wall's reverse is looked up in the same table, which finds all the portals in
+a single pass over the walls.
+
+"""
+
+class Portal(object):
+    """A wall shared by two rooms, seen from one of them.
+
+    """
+    def __init__(self, room, wall_index, other_room, other_wall_index):
+        self.room = room
+        self.wall_index = wall_index
+        self.other_room = other_room
+        self.other_wall_index = other_wall_index
+
+        # Precomputed limits on what can pass through: the highest floor, the
+        # lowest ceiling and the height of the shorter room
+        self.bottom = max(room.floor_height, other_room.floor_height)
+        self.top = min(room.ceiling_height, other_room.ceiling_height)
+        self.min_room_height = min(
+                        room.ceiling_height - room.floor_height,
+                        other_room.ceiling_height - other_room.floor_height)
+
+    @property
+    def wall(self):
+        """End points of the wall, in the room's winding order.
+
+        """
+        return self.room.walls[self.wall_index]
+
+    def fits(self, max_step_height, head_height, tallness):
+        """Whether something can pass through.
+
+        max_step_height: Highest floor it can step up to
+        head_height: Height of the top of its head
+        tallness: Its height (e.g. shorter when crouching)
+
+        """
+        return (self.bottom <= max_step_height and
+                self.top >= head_height and
+                self.min_room_height >= tallness)
+
+class PortalGraph(object):
+    def __init__(self, rooms):
+        """Find every wall shared between the given rooms.
+
+        """
+        self.rooms = list(rooms)
+
+        # Key: (start point, end point), value: (room, wall index)
+        directed_walls = {}
+        for room in self.rooms:
+            for wall_index, wall in enumerate(room.walls):
+                directed_walls[wall] = (room, wall_index)
+
+        # Portals leading out of each room, by wall index
+        self._portals = dict([(room, {}) for room in self.rooms])
+        for room in self.rooms:
+            for wall_index, wall in enumerate(room.walls):
+                match = directed_walls.get((wall[1], wall[0]))
+                if match is None or match[0] is room:
+                    continue
+                other_room, other_wall_index = match
+                self._portals[room][wall_index] = Portal(
+                            room, wall_index, other_room, other_wall_index)
+
+    @property
+    def portals(self):
+        """Every portal, once from each side.
+
+        """
+        portals = []
+        for room in self.rooms:
+            portals.extend(self.get_portals(room))
+        return portals
+
+    def get_portals(self, room):
+        """Portals leading out of the given room, in wall order.
+
+        """
+        room_portals = self._portals.get(room, {})
+        return [room_portals[i] for i in sorted(room_portals)]
+
+    def get_portal(self, room, wall_index):
+        """The portal through the given wall, or None if it isn't shared.
+
+        """
+        return self._portals.get(room, {}).get(wall_index)
+
+    def get_neighbours(self, room):
+        """Rooms sharing a wall with the given room.
+
+        """
+        neighbours = []
+        for portal in self.get_portals(room):
+            if portal.other_room not in neighbours:
+                neighbours.append(portal.other_room)
+        return neighbours
+
+    def get_rooms_within(self, room, hops):
+        """Rooms within the given number of portal hops of the room, nearest
+        first (including the room itself).
+
+        """
+        nearby_rooms = [room]
+        visited = set(nearby_rooms)
+        frontier = [room]
+        for hop in range(hops):
+            next_frontier = []
+            for frontier_room in frontier:
+                for other in self.get_neighbours(frontier_room):
+                    if other not in visited:
+                        visited.add(other)
+                        next_frontier.append(other)
+            nearby_rooms.extend(next_frontier)
+            frontier = next_frontier
+        return nearby_rooms
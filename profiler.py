@@ -0,0 +1,278 @@
+"""Frame profiler: scoped CPU timers, GL timer queries and an overlay.
+
+Call sites are wrapped in scopes:
+
+    with profiler.scope("space.step"):
+        space.step(dt)
+
+When the profiler is disabled, scope() and gpu_scope() hand back a shared
+do-nothing context manager, so leaving them in costs next to nothing.
+
+GPU scopes time render passes with GL_TIME_ELAPSED queries. Only one can run
+at a time, so nested GPU scopes are ignored. Results are read a frame or more
+later, once they're available, so measuring never stalls the pipeline.
+
+While a trace is being recorded, every scope is also kept as a Chrome
+trace event, which can be saved and opened in chrome://tracing or Perfetto.
+
+"""
+import json
+import timeit
+
+import pyglet
+from pyglet.gl import *
+from pyglet.gl import gl_info
+
+# Weight of the newest frame in the overlay's running averages
+AVERAGE_WEIGHT = 0.1
+
+# Most trace events kept while recording (older ones are dropped)
+MAX_TRACE_EVENTS = 200000
+
+# Trace event thread IDs
+CPU_THREAD = 1
+GPU_THREAD = 2
+
+class _NullScope(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_scope = _NullScope()
+
+class _Scope(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._add_time(self.name, self.start,
+                                timeit.default_timer() - self.start,
+                                CPU_THREAD)
+        return False
+
+class _GPUScope(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.query = None
+
+    def __enter__(self):
+        self.query = self.profiler._begin_query(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.query is not None:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.profiler._query_active = False
+        return False
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+
+        # Key: scope name, value: running average of seconds per frame
+        self.cpu_averages = {}
+        self.gpu_averages = {}
+        self.frame_average = None
+
+        # Seconds spent in each scope this frame
+        self._cpu_totals = {}
+        self._gpu_totals = {}
+        self._frame_start = None
+
+        # Timer queries: (name, CPU start time, query) waiting for results,
+        # and spare query objects. None until it's known whether they're
+        # supported.
+        self._queries_supported = None
+        self._pending_queries = []
+        self._free_queries = []
+        self._query_active = False
+
+        # Chrome trace events, when recording
+        self.tracing = False
+        self._trace_events = []
+        self._trace_start = timeit.default_timer()
+
+        # Created when first drawn
+        self._label = None
+
+    def scope(self, name):
+        """Context manager timing the CPU work inside it.
+
+        """
+        if not self.enabled:
+            return _null_scope
+        return _Scope(self, name)
+
+    def gpu_scope(self, name):
+        """Context manager timing the GL work issued inside it.
+
+        """
+        if not self.enabled:
+            return _null_scope
+        return _GPUScope(self, name)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.cpu_averages = {}
+            self.gpu_averages = {}
+            self.frame_average = None
+            self._cpu_totals = {}
+            self._gpu_totals = {}
+            self._frame_start = None
+
+    def _add_time(self, name, start, duration, thread):
+        totals = self._cpu_totals if thread == CPU_THREAD else self._gpu_totals
+        totals[name] = totals.get(name, 0.0) + duration
+        if self.tracing:
+            if len(self._trace_events) >= MAX_TRACE_EVENTS:
+                del self._trace_events[:len(self._trace_events) // 2]
+            self._trace_events.append({
+                        "name": name,
+                        "cat": "cpu" if thread == CPU_THREAD else "gpu",
+                        "ph": "X",
+                        "ts": (start - self._trace_start) * 1e6,
+                        "dur": duration * 1e6,
+                        "pid": 1,
+                        "tid": thread})
+
+    def _begin_query(self, name):
+        """Start a timer query, or return None if one's already running or
+        they aren't supported.
+
+        """
+        if self._queries_supported is None:
+            self._queries_supported = (
+                            gl_info.have_version(3, 3) or
+                            gl_info.have_extension("GL_ARB_timer_query"))
+        if not self._queries_supported or self._query_active:
+            return None
+        if self._free_queries:
+            query = self._free_queries.pop()
+        else:
+            query = GLuint()
+            glGenQueries(1, query)
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self._query_active = True
+        self._pending_queries.append((name, timeit.default_timer(), query))
+        return query
+
+    def _collect_queries(self):
+        """Read the timer queries that have finished.
+
+        """
+        still_pending = []
+        for name, start, query in self._pending_queries:
+            available = GLint()
+            glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, available)
+            if not available.value:
+                still_pending.append((name, start, query))
+                continue
+            # Traced at the CPU time the work was issued
+            elapsed = GLuint64()
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, elapsed)
+            self._add_time(name, start, elapsed.value / 1e9, GPU_THREAD)
+            self._free_queries.append(query)
+        self._pending_queries = still_pending
+
+    def end_frame(self):
+        """Fold this frame's times into the running averages. Call once at
+        the end of each frame.
+
+        """
+        if not self.enabled:
+            return
+        now = timeit.default_timer()
+        if self._frame_start is not None:
+            self.frame_average = self._average(self.frame_average,
+                                               now - self._frame_start)
+        self._frame_start = now
+
+        self._collect_queries()
+        for totals, averages in ((self._cpu_totals, self.cpu_averages),
+                                 (self._gpu_totals, self.gpu_averages)):
+            for name in set(totals) | set(averages):
+                averages[name] = self._average(averages.get(name),
+                                               totals.get(name, 0.0))
+            totals.clear()
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + (value - average) * AVERAGE_WEIGHT
+
+    def start_trace(self):
+        self._trace_events = []
+        self.tracing = True
+
+    def save_trace(self, path):
+        """Stop recording and write the trace as Chrome trace-event JSON.
+
+        """
+        self.tracing = False
+        trace = {"traceEvents": self._trace_events +
+                    [{"name": "thread_name", "ph": "M", "pid": 1,
+                      "tid": CPU_THREAD, "args": {"name": "CPU"}},
+                     {"name": "thread_name", "ph": "M", "pid": 1,
+                      "tid": GPU_THREAD, "args": {"name": "GPU"}}],
+                 "displayTimeUnit": "ms"}
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file)
+        self._trace_events = []
+
+    def get_overlay_text(self):
+        lines = []
+        if self.frame_average is not None:
+            lines.append("frame  %6.2f ms" % (self.frame_average * 1000.0))
+        for label, averages in (("cpu", self.cpu_averages),
+                                ("gpu", self.gpu_averages)):
+            for name in sorted(averages):
+                lines.append("%s  %6.2f ms  %s" % (label,
+                                                    averages[name] * 1000.0,
+                                                    name))
+        if self.tracing:
+            lines.append("recording trace (%i events)" %
+                         len(self._trace_events))
+        return "\n".join(lines)
+
+    def draw_overlay(self, size, text=None):
+        """Draw the averages, or the given text, in the top left corner of a
+        window of the given size.
+
+        """
+        if self._label is None:
+            self._label = pyglet.text.Label(
+                            "", font_size=10, color=(255, 0, 0, 255),
+                            multiline=True, width=size[0],
+                            anchor_y="top")
+        if text is None:
+            text = self.get_overlay_text()
+        self._label.text = text
+        self._label.x = 8
+        self._label.y = size[1] - 8
+
+        glPushAttrib(GL_ENABLE_BIT | GL_VIEWPORT_BIT)
+        glDisable(GL_DEPTH_TEST)
+        glDisable(GL_CULL_FACE)
+        glViewport(0, 0, size[0], size[1])
+        for matrix_mode in GL_PROJECTION, GL_MODELVIEW:
+            glMatrixMode(matrix_mode)
+            glPushMatrix()
+            glLoadIdentity()
+        glMatrixMode(GL_PROJECTION)
+        glOrtho(0.0, size[0], 0.0, size[1], -1.0, 1.0)
+        glMatrixMode(GL_MODELVIEW)
+        self._label.draw()
+        for matrix_mode in GL_PROJECTION, GL_MODELVIEW:
+            glMatrixMode(matrix_mode)
+            glPopMatrix()
+        glPopAttrib()
+
+# The game's profiler
+profiler = Profiler()
@@ -5,6 +5,7 @@ Based on: http://freespace.virgin.net/hugo.elias/radiosity/radiosity.htm
 
 """
 import math
+import time
 
 from pyglet.gl import *
 from pyglet.gl.glext_arb import glGenerateMipmapEXT
@@ -12,6 +13,9 @@ import pyglet.image
 
 import view
 import utils
+import camera
+from profiler import profiler
+from gpumemory import gpu_memory, get_texture_bytes, RADIOSITY
 
 # Quadrant identifiers       0 1 2 3 4
 FRONT = "FRONT"         #  0   +---+  
@@ -34,7 +38,9 @@ class Radiosity(object):
     """
     def __init__(self, render_func, lightmaps, sample_size=256,
                  average_method=HARDWARE):
-        # Function we call to draw the scene
+        # Function we call to draw the scene (takes the camera position, the
+        # focal length in pixels, the projection and view matrices, the
+        # hemicube face and the lightmap being worked on)
         self.render_func = render_func
         
         # Lightmaps that need radiosity applied (list of tuples;
@@ -64,17 +70,65 @@ class Radiosity(object):
         self.sample_fbo = maps[0][1]
         self.sample_tex_b = maps[1][0]
         self.sample_fbo_b = maps[1][1]
+        # Depth buffers of the FBOs
+        self.depth_buffers = [maps[0][2], maps[1][2]]
         
         # Info about how to render the cubemaps
         self.view_setups = self._generate_view_setups()
         
         self.pass_index = 0
         
+    def add_lightmaps(self, lightmaps):
+        """Start working on more lightmaps (same format as the constructor's
+        list). They join the current pass, or start a new set of passes if
+        everything else is finished.
+        
+        """
+        self._lightmaps_info.extend(lightmaps)
+        if self.pass_index >= PASS_COUNT:
+            self.pass_index = 0
+            self._lightmap_index = 0
+            self._current_texel = (0, 0)
+    
+    def remove_lightmaps(self, lightmaps):
+        """Stop working on the given lightmaps, e.g. because their room has
+        been unloaded.
+        
+        """
+        # Work out where the next remaining lightmap ends up
+        new_index = 0
+        for index, lightmap_info in enumerate(self._lightmaps_info):
+            if lightmap_info in lightmaps:
+                if index == self._lightmap_index:
+                    # Removing the one in progress; move on to the next
+                    self._current_texel = (0, 0)
+                continue
+            if index < self._lightmap_index:
+                new_index += 1
+        self._lightmaps_info = [lightmap_info for lightmap_info in
+                                self._lightmaps_info
+                                if lightmap_info not in lightmaps]
+        self._lightmap_index = new_index
+    
+    def delete(self):
+        """Delete the sample FBOs, their textures and depth buffers, and the
+        multiplier map.
+        
+        """
+        for fbo in self.sample_fbo, self.sample_fbo_b:
+            glDeleteFramebuffersEXT(1, fbo)
+        for depth_buffer in self.depth_buffers:
+            glDeleteRenderbuffersEXT(1, depth_buffer)
+        for texture in self.sample_tex, self.sample_tex_b, self.multiplier_map:
+            utils.delete_texture(texture)
+        gpu_memory.remove(RADIOSITY, self)
+    
     def _generate_view_setups(self):
         """A list of views that we need to render.
         
         Dictionaries, with:
         
+            name: Face of the hemicube (FRONT, TOP etc.)
             viewport: Args needed for glViewport command
             pitch: Camera rotation about Y axis
             heading: Camera rotation about local X axis
@@ -83,23 +137,43 @@ class Radiosity(object):
         d = self.sample_size  # Just to be concise
         view_setups = [
                # Front
-               {"viewport": (d // 4, d // 4, d // 2, d // 2),
+               {"name": FRONT, "viewport": (d // 4, d // 4, d // 2, d // 2),
                "pitch": 0.0, "heading": 0.0},
                # Top         
-               {"viewport": (d // 4, 3 * d // 4, d // 2, d // 2),
+               {"name": TOP, "viewport": (d // 4, 3 * d // 4, d // 2, d // 2),
                "pitch": 90.0, "heading": 0.0},
                # Bottom      
-               {"viewport": (d // 4, -d // 4, d // 2, d // 2),
+               {"name": BOTTOM, "viewport": (d // 4, -d // 4, d // 2, d // 2),
                "pitch": -90.0, "heading": 0.0},
                # Left        
-               {"viewport": (-d // 4, d // 4, d // 2, d // 2),
+               {"name": LEFT, "viewport": (-d // 4, d // 4, d // 2, d // 2),
                "pitch": 0.0, "heading": 90.0},
                # Right       
-               {"viewport": (3 * d // 4, d // 4, d // 2, d // 2),
+               {"name": RIGHT,
+               "viewport": (3 * d // 4, d // 4, d // 2, d // 2),
                "pitch": 0.0, "heading": -90.0}
         ]
         return view_setups
 
+    @property
+    def finished(self):
+        """Whether every pass over every lightmap is done.
+        
+        """
+        return self._lightmap_index is None or self.pass_index >= PASS_COUNT
+    
+    def do_work_for(self, duration):
+        """Process lightmap texels until the given number of seconds have
+        passed (always at least one texel, unless everything's finished).
+        
+        """
+        end_time = time.time() + duration
+        while not self.finished:
+            with profiler.scope("radiosity.do_work"):
+                self.do_work()
+            if time.time() >= end_time:
+                break
+    
     def do_work(self):
         """Process one lightmap texel.
         
@@ -135,10 +209,15 @@ class Radiosity(object):
             # We've found a texel that needs work
             break
         else:
-            # Didn't find any texels that needed work; we're done
+            # Didn't find any texels that needed work; we're done. Regions of
+            # an atlas page are finished together, once per page.
+            finished_lightmaps = set()
             for lightmap_info in self._lightmaps_info:
                 lightmap, _ = lightmap_info
-                lightmap.update_from_in_progress()
+                base_lightmap = lightmap.base_lightmap
+                if base_lightmap not in finished_lightmaps:
+                    base_lightmap.update_from_in_progress()
+                    finished_lightmaps.add(base_lightmap)
             self._lightmap_index = 0
             self._current_texel = (0, 0)
             self.pass_index += 1
@@ -152,7 +231,7 @@ class Radiosity(object):
             glPushMatrix()
 
         try:
-            incident_value = self.sample(*camera_pos)
+            incident_value = self.sample(*camera_pos, lightmap=lightmap)
         finally:
             for matrix_mode in GL_PROJECTION, GL_MODELVIEW:
                 glMatrixMode(matrix_mode)
@@ -164,11 +243,14 @@ class Radiosity(object):
 
         lightmap.set_value(texel, incident_value)            
 
-    def sample(self, position, heading, pitch):
+    def sample(self, position, heading, pitch, lightmap=None):
         """Return the RGB value of the incident light at the given position.
         
         Renders the scene to a cubemap and gets the average of the pixels.
         
+        lightmap: Lightmap the sample is for, passed on to the render
+                  function
+        
         """
         # Bind the main, full-size FBO
         glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.sample_fbo)
@@ -179,22 +261,19 @@ class Radiosity(object):
         for setup in self.view_setups:
             # Setup matrix
             glViewport(*setup["viewport"])
-            glMatrixMode(GL_PROJECTION)
-            glLoadIdentity()
-            gluPerspective(90.0, 1.0, 0.001, 100.0)
-            glMatrixMode(GL_MODELVIEW)
-            glLoadIdentity()
+            projection = camera.perspective(90.0, 1.0, 0.001, 100.0)
+            view_matrix = camera.get_view_matrix(
+                            position,
+                            heading + utils.deg_to_rad(setup["heading"]),
+                            pitch + utils.deg_to_rad(setup["pitch"]))
+            camera.load_matrices(projection, view_matrix)
             glEnable(GL_DEPTH_TEST)
-            glRotatef(90.0, 0.0, 1.0, 0.0)
-            glRotatef(-90.0, 1.0, 0.0, 0.0)
-            glRotatef(utils.rad_to_deg(pitch) + setup["pitch"],
-                      0.0, 1.0, 0.0)
-            glRotatef(utils.rad_to_deg(heading) + setup["heading"],
-                      0.0, 0.0, -1.0)
-            glTranslatef(-position[0], -position[1], -position[2])
             
-            # Draw the scene
-            self.render_func()
+            # Draw the scene. Each face is half the sample size across with a
+            # 90 degree field of view.
+            self.render_func(position, self.sample_size / 4.0,
+                             (projection, view_matrix), setup["name"],
+                             lightmap)
 
         # Draw multiplier map on top. First, set the matrix
         glMatrixMode(GL_PROJECTION)
@@ -409,11 +488,15 @@ class Radiosity(object):
         # TODO: Remove
         multiplier_map = pyglet.image.load("textures/mult.png")
         
-        return multiplier_map.get_texture()
+        texture = multiplier_map.get_texture()
+        gpu_memory.add(RADIOSITY, self, ("texture", texture.id),
+                       get_texture_bytes(texture.width, texture.height))
+        return texture
         
 
     def _generate_incident_textures_and_fbos(self):
-        """Two FBOs used for lightmap generation.
+        """Two FBOs used for lightmap generation, as tuples of texture, FBO
+        and depth buffer.
         
         The first one gets the sample buffer drawn to it. The other one is
         4x4px and is used to work out the total incident light.
@@ -459,7 +542,12 @@ class Radiosity(object):
             glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
             glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
             glGenerateMipmapEXT(GL_TEXTURE_2D)
-
-            # Add a tuple of texture and FBO to the list
-            tex_fbo_list.append((tex, fbo))
+            gpu_memory.add(RADIOSITY, self, ("texture", tex.id),
+                           get_texture_bytes(size, size, mipmapped=True))
+            gpu_memory.add(RADIOSITY, self,
+                           ("renderbuffer", depth_buffer.value),
+                           get_texture_bytes(size, size))
+
+            # Add a tuple of texture, FBO and depth buffer to the list
+            tex_fbo_list.append((tex, fbo, depth_buffer))
         return tex_fbo_list
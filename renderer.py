@@ -0,0 +1,94 @@
+"""Drawing the 3D view with shaders instead of the fixed-function pipeline.
+
+Everything is drawn with one texture times lightmap program. The camera's
+matrices are uploaded once per view to a uniform buffer, meshes are moved with
+a model matrix uniform, and vertex data comes from vertex array objects, so
+there's no matrix stack, texture environment or client state to set up.
+Meshes don't have lightmaps, so they use a white one.
+
+"""
+import numpy
+
+import pyglet
+from pyglet.gl import *
+
+import camera
+import utils
+from shaders import ShaderProgram, CameraBuffer, CAMERA_BINDING
+from shaders import LIGHTMAPPED_VERTEX_SOURCE, LIGHTMAPPED_FRAGMENT_SOURCE
+from shaders import POSITION_ATTRIBUTE, TEX_COORD_ATTRIBUTE
+from shaders import LIGHTMAP_COORD_ATTRIBUTE
+from renderstats import frame_stats
+from gpumemory import gpu_memory, get_texture_bytes, VIEW
+
+class ShaderRenderer(object):
+    def __init__(self):
+        """Create the program and buffers. Needs a GL context that supports
+        GLSL 1.40 (OpenGL 3.1).
+
+        """
+        self.program = ShaderProgram(
+                            LIGHTMAPPED_VERTEX_SOURCE,
+                            LIGHTMAPPED_FRAGMENT_SOURCE,
+                            [(POSITION_ATTRIBUTE, "position"),
+                             (TEX_COORD_ATTRIBUTE, "tex_coord"),
+                             (LIGHTMAP_COORD_ATTRIBUTE, "lightmap_coord")])
+        self.program.bind_uniform_block("Camera", CAMERA_BINDING)
+        self.program.use()
+        self.program.set_int("texture_map", 0)
+        self.program.set_int("lightmap", 1)
+        glUseProgram(0)
+
+        self.camera_buffer = CameraBuffer(CAMERA_BINDING)
+        gpu_memory.add(VIEW, self, ("buffer", self.camera_buffer.id.value),
+                       CameraBuffer.SIZE)
+
+        # Lightmap for things without one
+        image = pyglet.image.create(1, 1)
+        image.set_data("RGBA", 4, "\xff\xff\xff\xff")
+        self.white_texture = image.get_texture()
+        gpu_memory.add(VIEW, self, ("texture", self.white_texture.id),
+                       get_texture_bytes(1, 1))
+
+    def draw(self, static_geometry, rooms, meshes, matrices,
+             in_progress_lightmaps=True):
+        """Draw the rooms' static geometry and the given meshes.
+
+        meshes: (mesh, level of detail) pairs
+        matrices: Projection and view matrices (see camera.py)
+
+        """
+        projection, view = matrices
+        self.camera_buffer.update(projection, view)
+        self.program.use()
+        frame_stats.state_changes += 2
+
+        # Rooms are already in world space
+        self.program.set_matrix("model", numpy.identity(4))
+        static_geometry.draw(rooms, in_progress_lightmaps, use_vaos=True)
+
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_2D, self.white_texture.id)
+        frame_stats.state_changes += 1
+        glActiveTexture(GL_TEXTURE0)
+        for mesh, lod in meshes:
+            glBindTexture(GL_TEXTURE_2D, mesh.texture.id)
+            self.program.set_matrix("model",
+                                    camera.translation(mesh.position))
+            mesh.bind_lod_vao(lod)
+            glDrawArrays(GL_TRIANGLES, 0, mesh.lod_counts[lod])
+            frame_stats.state_changes += 2
+            frame_stats.draw_calls += 1
+
+        # Reset the state
+        glBindVertexArray(0)
+        glUseProgram(0)
+
+    def delete(self):
+        """Delete the program, the camera's buffer and the white lightmap.
+
+        """
+        self.program.delete()
+        self.camera_buffer.delete()
+        utils.delete_texture(self.white_texture)
+        gpu_memory.remove(VIEW, self)
@@ -0,0 +1,23 @@
+"""Counts of the work each frame asks the GL to do.
+
+The drawing code adds to the counts as it goes; whoever's measuring (e.g. the
+benchmark) resets them at the start of a frame and reads them at the end.
+
+"""
+
+class RenderStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Calls that draw something (glDrawArrays, glMultiDrawArrays, glEnd)
+        self.draw_calls = 0
+        # Texture, buffer, vertex array and program binds
+        self.state_changes = 0
+
+    def as_dict(self):
+        return {"draw_calls": self.draw_calls,
+                "state_changes": self.state_changes}
+
+# Stats for the frame being drawn
+frame_stats = RenderStats()
@@ -1,14 +1,18 @@
 import math
 import random
-import itertools
+import numpy
 import pymunk
 import pyglet
 from pyglet.gl import *
 
 import utils
-from utils import WALL_COLLISION_TYPE
+import loader
+from utils import WALL_COLLISION_TYPE, SOLID_WALL_LAYER
+import mesh
 from mesh import Mesh
-from lightmap import Lightmap
+from lightmap import Lightmap, get_lightmap_bytes
+from portals import PortalGraph
+from batching import StaticGeometry
 
 # How to apply wall texture.
 # Overall: no seams, minimal distortion, texture can wrap over corners
@@ -17,6 +21,17 @@ from lightmap import Lightmap
 WALL_TEXTURE_FIT_OVERALL = "overall"
 WALL_TEXTURE_FIT_PER_WALL = "per_wall"
 
+# Lightmap texels per metre, unless the level or room says otherwise
+DEFAULT_LIGHTMAP_DENSITY = 4.0
+
+# Limits on the width and height of each lightmap. The maximum leaves space
+# for padding on the largest atlas page.
+MIN_LIGHTMAP_SIZE = 2
+MAX_LIGHTMAP_SIZE = 2046
+
+# Most point/wall pairs to test at once in Room.contains_points
+POINT_TEST_CHUNK_ELEMENTS = 1 << 20
+
 class InvalidRoomError(Exception):
     """Raised when the room data isn't valid.
     
@@ -26,24 +41,69 @@ class InvalidRoomError(Exception):
 def smoothed(x):
     return -0.5 * math.cos(math.pi * x) + 0.5    
 
+def update_shared_walls(rooms):
+    """Record the walls that each room shares with the others.
+    
+    Returns the PortalGraph of the rooms.
+    
+    """
+    graph = PortalGraph(rooms)
+    for portal in graph.portals:
+        portal.room.shared_walls[portal.wall_index] = portal.other_room
+    return graph
+
+def set_lightmap_densities(rooms, density=None, budget=None):
+    """Work out the lightmap texel density for each room.
+    
+    density: Texels per metre for rooms that don't give their own
+    budget: Most texels to use across all the rooms. Densities are scaled
+            down evenly to fit. Texels outside the room (e.g. in the corners
+            of an L-shaped floor's lightmap) don't count.
+    
+    Rooms can also have their own budget, which is applied first.
+    
+    """
+    if density is None:
+        density = DEFAULT_LIGHTMAP_DENSITY
+    
+    # Texel counts grow with the square of the density
+    total_texels = 0.0
+    for room in rooms:
+        room_density = room.requested_lightmap_density or density
+        area = room.get_lit_area()
+        if room.lightmap_budget and room_density ** 2 * area > \
+                room.lightmap_budget:
+            room_density = math.sqrt(room.lightmap_budget / area)
+        room.lightmap_density = room_density
+        total_texels += room_density ** 2 * area
+    
+    if budget and total_texels > budget:
+        scale = math.sqrt(budget / total_texels)
+        for room in rooms:
+            room.lightmap_density *= scale
+
 class Room(object):
-    def __init__(self, data):
+    def __init__(self, data, compiled=None):
+        """Create a room from its level file data.
+        
+        compiled: Data from get_compiled_data, if the level has been compiled.
+                  The vertices are taken from it without being checked, and
+                  load() uses its vertex data instead of generating it.
+        
+        """
         self.floor_height = data["floor_height"]
         self.ceiling_height = data["ceiling_height"]
         
-        # Floor texture.
-        floor_texture_path = data.get("floor_texture", "textures/default.png")
-        floor_texture_image = pyglet.image.load(floor_texture_path)
-        self.floor_texture = floor_texture_image.get_mipmapped_texture()
-        # Ceiling texture
-        ceiling_texture_path = data.get("ceiling_texture",
-                                        "textures/default.png")
-        ceiling_texture_image = pyglet.image.load(ceiling_texture_path)
-        self.ceiling_texture = ceiling_texture_image.get_mipmapped_texture()
-        # Wall texture.
-        wall_texture_path = data.get("wall_texture", "textures/default.png")
-        wall_texture_image = pyglet.image.load(wall_texture_path)
-        self.wall_texture = wall_texture_image.get_mipmapped_texture()
+        # Texture paths. The textures themselves are created by load().
+        self.floor_texture_path = data.get("floor_texture",
+                                           "textures/default.png")
+        self.ceiling_texture_path = data.get("ceiling_texture",
+                                             "textures/default.png")
+        self.wall_texture_path = data.get("wall_texture",
+                                          "textures/default.png")
+        self.floor_texture = None
+        self.ceiling_texture = None
+        self.wall_texture = None
         self.wall_texture_fit = data.get("wall_texture_fit",
                                          WALL_TEXTURE_FIT_PER_WALL)
         
@@ -62,81 +122,294 @@ class Room(object):
         # Light emission
         self.emit = data.get("emit", 0.0)
         
+        # Floor triangulation: "ear_clip" (default) or "delaunay" for better
+        # shaped triangles on large floors
+        self.floor_triangulation = data.get("floor_triangulation", "ear_clip")
+        
+        # Lightmap texels per metre and maximum texel count. The density
+        # actually used is set by set_lightmap_densities.
+        self.requested_lightmap_density = data.get("lightmap_density")
+        self.lightmap_budget = data.get("lightmap_budget")
+        self.lightmap_density = (self.requested_lightmap_density or
+                                 DEFAULT_LIGHTMAP_DENSITY)
+        # Number of times the lightmaps are halved to fit the GPU memory
+        # budget
+        self.lightmap_downscale = 0
+        
         # Wall vertex data, ordered clockwise
-        self.vertices = []
-        for vertex in data["vertices"]:
-            self.vertices.append(tuple(vertex))
-        # Correct incorrect winding
-        try:
-            self.check_winding()
-        except InvalidRoomError:
-            self.vertices.reverse()
-        # Check for other errors
-        self.check_walls()
+        self.compiled = compiled
+        if compiled:
+            # Already checked when the level was compiled
+            self.vertices = compiled["vertices"]
+        else:
+            self.vertices = data["vertices"]
+            # Correct incorrect winding
+            try:
+                self.check_winding()
+            except InvalidRoomError:
+                self.vertices = self.vertices[::-1]
+            # Check for other errors
+            self.check_walls()
+        # Data for load() worked out in advance by prepare() or the loader,
+        # in the same form as the compiled data
+        self.prepared_data = None
         # Walls shared with other rooms; key = wall index, value = other room
         self.shared_walls = {}
+        # Physics shape for each wall (created by add_to_space)
+        self.wall_shapes = []
         
         # Work out bounding box
-        min_x = max_x = self.vertices[0][0]
-        min_y = max_y = self.vertices[0][1]
-        for x, y in self.vertices:
-            min_x = min(min_x, x)
-            max_x = max(max_x, x)
-            min_y = min(min_y, y)
-            max_y = max(max_y, y)
-        self.bounding_box = (min_x, max_x, min_y, max_y)
-
-        # Texture coordinates for walls (uses same indexes as self.vertices)
+        min_x, min_y = self.vertex_array.min(axis=0)
+        max_x, max_y = self.vertex_array.max(axis=0)
+        self.bounding_box = (float(min_x), float(max_x),
+                             float(min_y), float(max_y))
+        # ...and the box in 3D (min xyz, max xyz), for culling
+        self.bounding_volume = ((float(min_x), float(min_y), self.floor_height),
+                                (float(max_x), float(max_y),
+                                 self.ceiling_height))
+
+        # Texture coordinates for walls (uses same indexes as self.vertices,
+        # plus one at the end for the far side of the last wall)
         self.wall_texture_vertices = None
         self.wall_lightmap_vertices = None
+        self.texture_walls = None
+        self.lightmap_walls = None
         self.wall_texture_floor_height = None
         self.wall_texture_ceiling_height = None
         self.wall_lightmap_floor_height = None
         self.wall_lightmap_ceiling_height = None
         
         # Triangulated data (generated later)
-        self.floor_data_vbo = GLuint()
-        self.ceiling_data_vbo = GLuint()
-        self.wall_data_vbo = GLuint()
-        self.floor_data_count = 0
-        self.ceiling_data_count = 0
-        self.wall_data_count = 0
-        glGenBuffers(1, self.floor_data_vbo)
-        glGenBuffers(1, self.ceiling_data_vbo)
-        glGenBuffers(1, self.wall_data_vbo)
-        
-        # Update texture and lightmap coords
-        self.generate_wall_tex_coords()
+        self.triangles = []
         
-        # Meshes
+        # Vertex data for the floor, ceiling and walls, as (texture, lightmap,
+        # data) tuples. It's drawn from the level's static geometry batches.
+        self.surfaces = []
+        self.static_geometry = None
+        
+        # Meshes (created by load())
+        self.mesh_data = data.get("meshes", [])
         self.meshes = []
-        for mesh_data in data.get("meshes", []):
-            self.meshes.append(Mesh(mesh_data, self))
+        
+        # Lightmaps (created by load()). If there's an atlas, the lightmaps
+        # are regions of it.
+        self.lightmap_atlas = None
+        # Whether lightmaps of the room's own keep their data only on the
+        # GPU (see Lightmap)
+        self.gpu_resident_lightmaps = False
+        self.lightmaps = []
+        self.floor_lightmap = None
+        self.ceiling_lightmap = None
+        self.wall_lightmap = None
+        
+        # Whether the GL resources needed to draw the room exist
+        self.resident = False
         
         # self.triangles = []
         self.wall_triangles = []
     
+    def prepare(self):
+        """Do the CPU side of loading: decode images, read meshes, triangulate
+        the floor and build the vertex data. Safe to call from a background
+        thread.
+        
+        Must be called after shared walls have been set.
+        
+        """
+        for path in (self.floor_texture_path, self.ceiling_texture_path,
+                     self.wall_texture_path):
+            utils.load_image(path)
+        for mesh_data in self.mesh_data:
+            mesh.get_lod_data(mesh_data["path"])
+            utils.load_image(mesh_data.get("texture", "textures/default.png"))
+        if not self.compiled and self.prepared_data is None:
+            self.prepared_data = self.get_compiled_data()
+    
+    def load(self):
+        """Create the textures, meshes, vertex buffers and lightmaps needed to
+        draw the room.
+        
+        Must be called after shared walls have been set.
+        
+        """
+        for step in self.get_load_steps():
+            pass
+    
+    def get_load_steps(self):
+        """Load the room (see load) a step at a time, so the uploads can be
+        spread over several frames. Each step creates a texture, a mesh, or
+        the lightmaps and vertex data. Once every step is done the room is
+        resident; until then it can't be unloaded.
+        
+        """
+        if self.resident:
+            return
+        
+        # Textures
+        self.floor_texture = utils.load_texture(self.floor_texture_path,
+                                                mipmapped=True)
+        yield
+        self.ceiling_texture = utils.load_texture(self.ceiling_texture_path,
+                                                  mipmapped=True)
+        yield
+        self.wall_texture = utils.load_texture(self.wall_texture_path,
+                                               mipmapped=True)
+        yield
+        
+        # Meshes
+        self.meshes = []
+        for mesh_data in self.mesh_data:
+            self.meshes.append(Mesh(mesh_data, self))
+            yield
+        
+        if self.compiled:
+            self.load_compiled_data(self.compiled)
+        else:
+            # Texture and lightmap coords, triangles and vertex data, unless
+            # they were prepared in advance
+            if self.prepared_data is None:
+                self.prepared_data = self.get_compiled_data()
+            self.load_compiled_data(self.prepared_data)
+            self.prepared_data = None
+        
+        # Only the room's ranges of the level's buffers are written
+        if self.static_geometry is None:
+            self.static_geometry = StaticGeometry()
+        self.static_geometry.add_room(self)
+        self.resident = True
+    
+    def get_compiled_data(self):
+        """Everything load() needs that can be worked out in advance, for
+        saving in a compiled level file.
+        
+        Must be called after shared walls have been set.
+        
+        """
+        self.generate_wall_tex_coords()
+        floor_data, ceiling_data, wall_data = self.get_vertex_data()
+        return {"vertices": self.vertices,
+                "triangles": self.triangles,
+                "wall_texture_vertices": self.wall_texture_vertices,
+                "wall_lightmap_vertices": self.wall_lightmap_vertices,
+                "wall_texture_ceiling_height":
+                    self.wall_texture_ceiling_height,
+                "lightmap_layout": self.get_lightmap_layout(),
+                "floor_data": floor_data.tostring(),
+                "ceiling_data": ceiling_data.tostring(),
+                "wall_data": wall_data.tostring()}
+    
+    def load_compiled_data(self, compiled):
+        """Use compiled or prepared data (see get_compiled_data) instead of
+        generating texture coordinates, triangles and vertex data.
+        
+        """
+        self.triangles = compiled["triangles"]
+        
+        # Wall texture and lightmap coords
+        self.set_wall_coords(compiled["wall_texture_vertices"],
+                             compiled["wall_lightmap_vertices"])
+        self.wall_texture_floor_height = 0.0
+        self.wall_texture_ceiling_height = \
+            compiled["wall_texture_ceiling_height"]
+        self.wall_lightmap_floor_height = 0.0
+        self.wall_lightmap_ceiling_height = 1.0
+        
+        # Vertex data
+        vertex_data = []
+        for key in "floor_data", "ceiling_data", "wall_data":
+            data = numpy.frombuffer(compiled[key], dtype=numpy.float32)
+            vertex_data.append(data.reshape(-1, 7))
+        
+        # Lightmaps first, so the vertex data can be mapped onto them
+        self.generate_lightmaps(self.get_lightmap_layout())
+        self.set_vertex_data(*vertex_data)
+    
+    def unload(self):
+        """Release everything created by load(). The room's outline stays, so
+        it still takes part in collisions and room lookups.
+        
+        """
+        if not self.resident:
+            return
+        self.static_geometry.remove_room(self)
+        self.surfaces = []
+        self.triangles = []
+        
+        for room_mesh in self.meshes:
+            room_mesh.delete()
+        self.meshes = []
+        
+        if self.lightmap_atlas:
+            self.lightmap_atlas.release(self)
+        else:
+            for lightmap, _ in self.lightmaps:
+                lightmap.delete()
+        self.lightmaps = []
+        self.floor_lightmap = None
+        self.ceiling_lightmap = None
+        self.wall_lightmap = None
+        
+        # Textures are shared with other rooms, so they stay in the cache
+        self.floor_texture = None
+        self.ceiling_texture = None
+        self.wall_texture = None
+        self.resident = False
+    
     def contains_point(self, point):
         """True if the room contains the given 2D or 3D point.
 
         """
-        # Three coords? Check Z first.
-        if len(point) > 2:
-            if not self.floor_height <= point[3] <= self.ceiling_height:
-                return False
-
-        # Check it's inside the boundaries
-        distant_point = (0.0, 1e10)
-        player_to_distance = ((point[0], point[1]), distant_point)
-        # Count the times it crosses the room's boundary. Odd = inside.
-        cross_count = 0
-        for wall in self.walls:
-            if utils.lines_intersect(player_to_distance, wall):
-                cross_count += 1
-        if cross_count % 2 == 1:
-            return True
-        else:
+        # Most points tested against a room aren't near it
+        min_x, max_x, min_y, max_y = self.bounding_box
+        if not (min_x <= point[0] <= max_x and min_y <= point[1] <= max_y):
             return False
+        return bool(self.contains_points([point])[0])
+
+    def contains_points(self, points):
+        """Which of the points the room contains.
+
+        points: (N, 2) or (N, 3) array (or sequence) of points. With three
+                coords, the z coord must also be between the floor and
+                ceiling.
+
+        Returns a boolean array of length N.
+
+        """
+        points = numpy.asarray(points, dtype=numpy.float64)
+        if points.ndim != 2 or points.shape[1] not in (2, 3):
+            raise ValueError("Points must be an (N, 2) or (N, 3) array")
+        x = points[:, 0]
+        y = points[:, 1]
+
+        # Only points within the bounding box (and between the floor and
+        # ceiling) need the full test
+        min_x, max_x, min_y, max_y = self.bounding_box
+        candidates = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        if points.shape[1] == 3:
+            z = points[:, 2]
+            candidates &= (z >= self.floor_height) & (z <= self.ceiling_height)
+        inside = numpy.zeros(len(points), dtype=bool)
+        indexes = numpy.flatnonzero(candidates)
+        if not len(indexes):
+            return inside
+
+        # Count the walls crossed by a ray from each point towards +x. Odd =
+        # inside. Done in chunks to limit the size of the points x walls
+        # arrays.
+        starts = self.wall_array[:, 0]
+        ends = self.wall_array[:, 1]
+        slopes = self.wall_slopes
+        chunk_size = max(1, POINT_TEST_CHUNK_ELEMENTS // len(starts))
+        for chunk_start in xrange(0, len(indexes), chunk_size):
+            chunk = indexes[chunk_start:chunk_start + chunk_size]
+            chunk_x = x[chunk][:, None]
+            chunk_y = y[chunk][:, None]
+            straddles = (starts[:, 1] > chunk_y) != (ends[:, 1] > chunk_y)
+            crossing_x = starts[:, 0] + (chunk_y - starts[:, 1]) * slopes
+            crossings = numpy.count_nonzero(straddles & (crossing_x > chunk_x),
+                                            axis=1)
+            inside[chunk] = crossings % 2 == 1
+        return inside
 
     def get_floor_ceiling_lm_coord(self, texel):
         """From a given texel, get the world space position.
@@ -149,21 +422,19 @@ class Room(object):
         # Sample from the centre if that's inside the room.
         # If that fails, we'll also try every corner to get a value.
         # (Inaccurate but better than having uncoloured texels showing)
-        center = (0.5, 0.5)
-        corners = [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0), (1.0, 1.0)]
-        for offset_x, offset_y in [center] + corners:
-            ts_x = (texel[0] + offset_x) / float(self.floor_lightmap.size[0])
-            ts_y = (texel[1] + offset_y) / float(self.floor_lightmap.size[1])
-            # Get world space position
-            x = (max_x - min_x) * ts_x + min_x
-            y = (max_y - min_y) * ts_y + min_y
-            if self.contains_point((x, y)):
-                break
-        else:
+        offsets = numpy.array([(0.5, 0.5), (0.0, 0.0), (1.0, 0.0),
+                               (0.0, 1.0), (1.0, 1.0)])
+        lightmap_size = numpy.array(self.floor_lightmap.size, dtype=float)
+        tex_space = (numpy.asarray(texel, dtype=float) + offsets) / lightmap_size
+        # Get world space positions
+        positions = tex_space * (max_x - min_x, max_y - min_y) + (min_x, min_y)
+        contained = numpy.flatnonzero(self.contains_points(positions))
+        if not len(contained):
             # None of the centre or corners map to a part of the room
             return None
 
-        return x, y
+        x, y = positions[contained[0]]
+        return float(x), float(y)
 
     def get_position_for_floor_lightmap_texel(self, texel):
         """
@@ -172,7 +443,7 @@ class Room(object):
         ws_coord = self.get_floor_ceiling_lm_coord(texel)
         if ws_coord is None:
             return None
-        x, y = self.get_floor_ceiling_lm_coord(texel)
+        x, y = ws_coord
         pos = (x, y, self.floor_height)
 
         heading = 0.0  # Flat floor
@@ -186,7 +457,7 @@ class Room(object):
         ws_coord = self.get_floor_ceiling_lm_coord(texel)
         if ws_coord is None:
             return None
-        x, y = self.get_floor_ceiling_lm_coord(texel)
+        x, y = ws_coord
         pos = (x, y, self.ceiling_height)
 
         heading = 0.0  # Flat floor
@@ -207,13 +478,14 @@ class Room(object):
                       (texel[1] + 0.5) / float(self.wall_lightmap.size[1]))
         
         # Find out which wall it's on
-        for i, lightmap_wall in enumerate(self.lightmap_walls):
-            if lightmap_wall[0] <= map_coords[0] < lightmap_wall[1]:
-                break
-        else:
+        i = numpy.searchsorted(self.wall_lightmap_vertices, map_coords[0],
+                               side="right") - 1
+        if not 0 <= i < len(self.lightmap_walls):
             # Texel isn't applied to any wall
             return None
-        wall = self.walls[i]
+        i = int(i)
+        lightmap_wall = self.lightmap_walls[i]
+        wall = self.wall_array[i]
         
         # Find out how far along the wall it is
         ratio = ((map_coords[0] - lightmap_wall[0]) /
@@ -240,57 +512,121 @@ class Room(object):
         return position, normal, pitch
     
     def add_to_space(self, space):
+        """Add a shape for each wall. Walls shared with other rooms start out
+        solid, until the player is found to fit through them.
+        
+        """
+        self.wall_shapes = []
         for i, wall in enumerate(self.walls):
             shape = pymunk.Segment(space.static_body, wall[0], wall[1], 0.0)
             shape.collision_type = WALL_COLLISION_TYPE
+            shape.layers = SOLID_WALL_LAYER
             shape.room = self
             shape.wall_index = i
             space.add(shape)
+            self.wall_shapes.append(shape)
     
-    def generate_floor_and_ceiling_lightmaps(self):
-        """Create lightmaps for the floor and ceiling.
-
+    def get_lightmap_layout(self):
+        """Sizes of the room's lightmaps.
+        
+        Returns a dictionary of (width, height) tuples with keys "floor",
+        "ceiling" and "wall".
+        
         """
-        width = 128.0
-        height = 128.0
-
-        self.floor_lightmap = Lightmap(width, height)
-        self.ceiling_lightmap = Lightmap(width, height)
-        self.lightmaps.append((self.floor_lightmap,
-                               self.get_position_for_floor_lightmap_texel))
-        self.lightmaps.append((self.ceiling_lightmap,
-                               self.get_position_for_ceiling_lightmap_texel))
-
-    def generate_wall_lightmap(self):
-        """Create a lightmap for the wall, and tex coords for it.
+        if self.compiled:
+            layout = self.compiled["lightmap_layout"]
+        else:
+            layout = self._get_full_lightmap_layout()
+        
+        # Halve the lightmaps to fit the budget
+        scale = 0.5 ** self.lightmap_downscale
+        return dict([(name, (self._get_lightmap_size(width * scale),
+                             self._get_lightmap_size(height * scale)))
+                     for name, (width, height) in layout.items()])
+    
+    def _get_full_lightmap_layout(self):
+        """Lightmap sizes at the room's lightmap density.
         
         """
-        height = 32.0
+        density = self.lightmap_density
+        
+        # Floor and ceiling cover the bounding box
+        min_x, max_x, min_y, max_y = self.bounding_box
+        floor_size = (self._get_lightmap_size((max_x - min_x) * density),
+                      self._get_lightmap_size((max_y - min_y) * density))
         
-        # Add up the wall lengths to find the width
-        total_wall_length = 0.0
-        for wall in self.walls:
-            total_wall_length += utils.get_length(wall[0], wall[1])
+        # Walls are laid out end to end, and reach from floor to ceiling
+        total_wall_length = float(self.wall_lengths.sum())
         room_height = self.ceiling_height - self.floor_height
-        width = (total_wall_length / room_height) * height
+        width = total_wall_length * density
+        height = room_height * density
+        if width > MAX_LIGHTMAP_SIZE:
+            height *= MAX_LIGHTMAP_SIZE / width
+            width = MAX_LIGHTMAP_SIZE
+        width = self._get_lightmap_size(width)
+        height = self._get_lightmap_size(height)
+        
+        return {"floor": floor_size,
+                "ceiling": floor_size,
+                "wall": (width, height)}
+    
+    def _get_lightmap_size(self, texels):
+        """Whole number of texels, within the size limits.
         
-        # Round width to next power of two
-        pot = 1
-        while pot <= 2048:
-            if width > pot:
-                pot *= 2
-            else:
-                width = float(pot)
-                break
+        """
+        texels = int(math.ceil(texels))
+        return min(max(texels, MIN_LIGHTMAP_SIZE), MAX_LIGHTMAP_SIZE)
+    
+    def get_lightmap_bytes(self):
+        """GPU memory used by lightmaps of the room's own (see
+        generate_lightmaps).
         
-        if width > 2048.0:
-            height *= 2048.0 / width
-            width = 2048.0
+        """
+        total = 0
+        for width, height in self.get_lightmap_layout().values():
+            total += get_lightmap_bytes(utils.next_power_of_two(width),
+                                        utils.next_power_of_two(height))
+        return total
+    
+    def get_lit_area(self):
+        """Total area of floor, ceiling and walls, in square metres.
         
-        # Create lightmap
-        self.wall_lightmap = Lightmap(width, height)
+        """
+        total_wall_length = float(self.wall_lengths.sum())
+        room_height = self.ceiling_height - self.floor_height
+        return (2.0 * utils.get_polygon_area(self.vertices) +
+                total_wall_length * room_height)
+    
+    def generate_lightmaps(self, layout):
+        """Create lightmaps for the floor, ceiling and walls with the sizes
+        from get_lightmap_layout, or get them from the atlas.
+        
+        """
+        if self.lightmap_atlas:
+            atlas = self.lightmap_atlas
+            self.floor_lightmap = atlas.get_lightmap(self, "floor")
+            self.ceiling_lightmap = atlas.get_lightmap(self, "ceiling")
+            self.wall_lightmap = atlas.get_lightmap(self, "wall")
+        else:
+            # Lightmaps of their own need power of two sizes
+            sizes = {}
+            for name, size in layout.items():
+                sizes[name] = [utils.next_power_of_two(size_component)
+                               for size_component in size]
+            resident = self.gpu_resident_lightmaps
+            self.floor_lightmap = Lightmap(*sizes["floor"],
+                                           gpu_resident=resident)
+            self.ceiling_lightmap = Lightmap(*sizes["ceiling"],
+                                             gpu_resident=resident)
+            self.wall_lightmap = Lightmap(*sizes["wall"],
+                                          gpu_resident=resident)
         
         # Info to generate radiosity
+        self.lightmaps = []
+        self.lightmaps.append((self.floor_lightmap,
+                               self.get_position_for_floor_lightmap_texel))
+        self.lightmaps.append((self.ceiling_lightmap,
+                               self.get_position_for_ceiling_lightmap_texel))
         self.lightmaps.append((self.wall_lightmap,
                                self.get_position_for_wall_lightmap_texel))
         
@@ -299,339 +635,326 @@ class Room(object):
         lightmap coordinates.
         
         """
+        # Texture dimensions
+        wall_image = utils.load_image(self.wall_texture_path)
+        
         # Y coords for textures
         self.wall_texture_floor_height = 0.0
         self.wall_texture_ceiling_height = 1.0 / self.wall_texture_scale
         self.wall_lightmap_floor_height = 0.0
         self.wall_lightmap_ceiling_height = 1.0
         
-        self.wall_texture_vertices = []
-        self.wall_lightmap_vertices = []
-        
-        # Always start at the left hand side
-        self.wall_texture_vertices.append(0.0)
-        self.wall_lightmap_vertices.append(0.0)
-        
         # Add up the lengths of all the walls
-        total_wall_length = 0.0
-        for wall in self.walls:
-            total_wall_length += utils.get_length(wall[0], wall[1])
+        wall_lengths = self.wall_lengths
+        wall_covered = numpy.cumsum(wall_lengths)
+        total_wall_length = wall_covered[-1]
 
         # Room height used to work out how many times we need to repeat
         # the texture
         room_height = self.ceiling_height - self.floor_height
-
-        # Keep track of the length of wall covered
-        wall_covered = 0.0
-        for i, wall in enumerate(self.walls):
-            # Get the texture x coords
-            wall_length = utils.get_length(wall[0], wall[1])
-            wall_covered += wall_length
-            
-            if self.wall_texture_fit == WALL_TEXTURE_FIT_PER_WALL:
-                # Ratio of room height to wall length determines how many 
-                # times the texture repeats.
-                repeat_count = round(wall_length / room_height)
-                
-                # Account for the texture's dimensions
-                repeat_count *= (float(self.wall_texture.height) /
-                                 float(self.wall_texture.width))
-                repeat_count /= self.wall_texture_scale
-                if repeat_count < 1.0:
-                    repeat_count = 1.0
-                tex_coord = repeat_count
-            elif self.wall_texture_fit == WALL_TEXTURE_FIT_OVERALL:
-                # Ratio of room height to total wall length determines how many 
-                # times the texture repeats.
-                repeat_count = round(total_wall_length / room_height)
-                
-                # Account for the texture's dimensions
-                repeat_count *= (float(self.wall_texture.height) /
-                                 float(self.wall_texture.width))
-                repeat_count /= self.wall_texture_scale
-                if repeat_count < 1.0:
-                    repeat_count = 1.0
-                tex_coord = ((wall_covered / total_wall_length) * repeat_count)
-            else:
-                raise ValueError("Unknown texture fit value: %s"
-                                 % self.wall_texture_fit)
-    
-            self.wall_texture_vertices.append(tex_coord)
-            
-            # Get lightmap coords
-            self.wall_lightmap_vertices.append(wall_covered / total_wall_length)
-        
-    
-    def generate_triangulated_data(self):
-        """Generate triangles to draw floor, ceiling and walls.
+        
+        # Get the texture x coords
+        if self.wall_texture_fit == WALL_TEXTURE_FIT_PER_WALL:
+            # Ratio of room height to wall length determines how many 
+            # times the texture repeats.
+            repeat_count = numpy.floor(wall_lengths / room_height + 0.5)
+        elif self.wall_texture_fit == WALL_TEXTURE_FIT_OVERALL:
+            # Ratio of room height to total wall length determines how many 
+            # times the texture repeats.
+            repeat_count = numpy.floor(total_wall_length / room_height + 0.5)
+        else:
+            raise ValueError("Unknown texture fit value: %s"
+                             % self.wall_texture_fit)
+        
+        # Account for the texture's dimensions
+        repeat_count = repeat_count * (float(wall_image.height) /
+                                       float(wall_image.width))
+        repeat_count /= self.wall_texture_scale
+        repeat_count = numpy.maximum(repeat_count, 1.0)
+        if self.wall_texture_fit == WALL_TEXTURE_FIT_PER_WALL:
+            tex_coords = repeat_count
+        else:
+            tex_coords = (wall_covered / total_wall_length) * repeat_count
+        
+        # Always start at the left hand side
+        self.set_wall_coords(numpy.concatenate(([0.0], tex_coords)),
+                             numpy.concatenate(([0.0], wall_covered /
+                                                       total_wall_length)))
+    
+    def set_wall_coords(self, texture_vertices, lightmap_vertices):
+        """Set the texture and lightmap x coords along the walls (one for the
+        start of each wall and one for the end of the last wall).
+        
+        """
+        self.wall_texture_vertices = numpy.asarray(texture_vertices,
+                                                   dtype=numpy.float64)
+        self.wall_lightmap_vertices = numpy.asarray(lightmap_vertices,
+                                                    dtype=numpy.float64)
+        # Start and end coords for each wall
+        self.texture_walls = numpy.column_stack(
+                   (self.wall_texture_vertices[:-1],
+                    self.wall_texture_vertices[1:]))
+        self.lightmap_walls = numpy.column_stack(
+                   (self.wall_lightmap_vertices[:-1],
+                    self.wall_lightmap_vertices[1:]))
+    
+    def set_vertex_data(self, floor_data, ceiling_data, wall_data):
+        """Set the room's surfaces from interleaved floor, ceiling and wall
+        data (float32 arrays with a row per vertex, as made by
+        get_vertex_data).
+        
+        Lightmap coords are mapped onto the lightmaps, which must have been
+        created already.
+        
+        """
+        self.surfaces = []
+        for data, texture, lightmap in (
+                    (floor_data, self.floor_texture, self.floor_lightmap),
+                    (ceiling_data, self.ceiling_texture, self.ceiling_lightmap),
+                    (wall_data, self.wall_texture, self.wall_lightmap)):
+            self.surfaces.append((texture, lightmap,
+                                  self._map_lightmap_coords(data, lightmap)))
+    
+    def _map_lightmap_coords(self, data, lightmap):
+        """Interleaved vertex data with the lightmap coords moved into the
+        part of the lightmap texture the lightmap uses (e.g. its region of an
+        atlas). Always contiguous float32, ready to upload.
+        
+        """
+        offset, scale = lightmap.tex_coord_transform
+        if offset == (0.0, 0.0) and scale == (1.0, 1.0):
+            return numpy.ascontiguousarray(data, dtype=numpy.float32)
+        data = numpy.array(data, dtype=numpy.float32)
+        data[:, 5:7] *= scale
+        data[:, 5:7] += offset
+        return data
+    
+    def get_vertex_data(self):
+        """Interleaved vertex data for the floor, ceiling and walls.
+        
+        Returns three float32 arrays with a row for every vertex: xyz
+        position, texture coords and lightmap coords. Also sets
+        self.triangles.
         
         Must be called after shared walls have been set.
         
-        """        
+        """
         # Get 2D triangles for the floor and ceiling
-        self.triangles = utils.triangulate(self.vertices)
-        # Put the vertex attributes in an interleaved array
-        floor_data = []
-        ceiling_data = []
-        for triangle in self.triangles:
-            for point in triangle:
-                # Floor data
-                # 3D vertex coords
-                floor_data.append(point[0])
-                floor_data.append(point[1])
-                floor_data.append(self.floor_height)
-                # 2D texture coords
-                # Take the longest dimension as 1m
-                floor_texture_ratio = (float(self.floor_texture.width) /
-                                       float(self.floor_texture.height))
-                if floor_texture_ratio < 1.0:
-                    floor_texture_ratio = 1.0 / floor_texture_ratio
-                # Apply rotation
-                tex_x = (point[0] * math.cos(self.floor_texture_angle) -
-                         point[1] * math.sin(self.floor_texture_angle))
-                tex_y = (point[0] * math.sin(self.floor_texture_angle) +
-                         point[1] * math.cos(self.floor_texture_angle))
-                # Apply scale
-                tex_x /= self.floor_texture_scale
-                tex_y /= self.floor_texture_scale
-                # Correct ratio and add to list
-                floor_data.append(tex_x * floor_texture_ratio)
-                floor_data.append(tex_y)
-                # Lightmap coords
-                min_x, max_x, min_y, max_y = self.bounding_box
-                lm_x = (point[0] - min_x) / (max_x - min_x)
-                lm_y = (point[1] - min_y) / (max_y - min_y)
-                floor_data.extend([lm_x, lm_y])
-
-            # Ceiling triangles need to be reversed to get the correct winding
-            for point in reversed(triangle):
-                # Ceiling data
-                # 3D vertex coords
-                ceiling_data.append(point[0])
-                ceiling_data.append(point[1])
-                ceiling_data.append(self.ceiling_height)
-                # 2D texture coords
-                # Take the longest dimension as 1m
-                ceiling_texture_ratio = (float(self.ceiling_texture.width) /
-                                         float(self.ceiling_texture.height))
-                if ceiling_texture_ratio < 1.0:
-                    ceiling_texture_ratio = 1.0 / ceiling_texture_ratio
-                # Apply rotation
-                tex_x = (point[0] * math.cos(self.ceiling_texture_angle) -
-                         point[1] * math.sin(self.ceiling_texture_angle))
-                tex_y = (point[0] * math.sin(self.ceiling_texture_angle) +
-                         point[1] * math.cos(self.ceiling_texture_angle))
-                # Apply scale
-                tex_x /= self.ceiling_texture_scale
-                tex_y /= self.ceiling_texture_scale
-                # Correct ratio and add to list
-                ceiling_data.append(tex_x * ceiling_texture_ratio)
-                ceiling_data.append(tex_y)
-                # Lightmap coords
-                min_x, max_x, min_y, max_y = self.bounding_box
-                lm_x = (point[0] - min_x) / (max_x - min_x)
-                lm_y = (point[1] - min_y) / (max_y - min_y)
-                ceiling_data.extend([lm_x, lm_y])
-        
-        # Floor: put it in an array of GLfloats
-        self.floor_data_count = len(floor_data) / 7
-        floor_data = (GLfloat * len(floor_data))(*floor_data)
-        # Add the data to the FBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.floor_data_vbo)
-        glBufferData(GL_ARRAY_BUFFER, sizeof(floor_data), floor_data,
-                     GL_STATIC_DRAW)
-
-        # Ceiling: put it in an array of GLfloats
-        self.ceiling_data_count = len(ceiling_data) / 7
-        ceiling_data = (GLfloat * len(ceiling_data))(*ceiling_data)
-        # Add the data to the FBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.ceiling_data_vbo)
-        glBufferData(GL_ARRAY_BUFFER, sizeof(ceiling_data), ceiling_data,
-                     GL_STATIC_DRAW)
-        
-        # Now the walls. If we're okay with wraps around corners, we need to 
-        # know the total wall length first.
-        self.lightmaps = []
-        self.generate_floor_and_ceiling_lightmaps()
-        self.generate_wall_lightmap()
-        if self.wall_texture_fit == WALL_TEXTURE_FIT_OVERALL:
-            total_wall_length = 0.0
-            for wall in self.walls:
-                total_wall_length += utils.get_length(wall[0], wall[1])
-            # Also keep track of the length of wall covered
-            wall_covered = 0.0
-        
-        wall_data = []
-        # Triangulate each wall
-        for i, wall in enumerate(self.walls):
-            # Shared walls might need to draw wall above and/or below the
-            # other room.
-            if i in self.shared_walls:
-                other = self.shared_walls[i]
-                # Wall above the opening?
-                if other.ceiling_height < self.ceiling_height:
-                    quad_data = self.get_wall_triangle_data(
-                                   i, other.ceiling_height, self.ceiling_height)
-                    wall_data.extend(quad_data)
-                    
-                # Wall below the opening?
-                if other.floor_height > self.floor_height:
-                    quad_data = self.get_wall_triangle_data(
-                                   i, self.floor_height, other.floor_height)
-                    wall_data.extend(quad_data)
-            
-            else:
-                quad_data = self.get_wall_triangle_data(i)
-                wall_data.extend(quad_data)
-        
-        # Wall: put it in an array of GLfloats
-        self.wall_data_count = len(wall_data) // 5
-        wall_data = (GLfloat * len(wall_data))(*wall_data)
-        # Add the data to the FBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.wall_data_vbo)
-        glBufferData(GL_ARRAY_BUFFER, sizeof(wall_data), wall_data,
-                     GL_STATIC_DRAW)            
-    
-    def get_wall_triangle_data(self, wall_index, bottom=None, top=None):
-        """FBO data for the given wall. Includes, vertex, tex coords and
-        lightmap tex coords.
+        self.triangles = loader.get_triangles(
+                        self.vertices, self.floor_triangulation == "delaunay")
+        triangle_points = numpy.array(self.triangles,
+                                      dtype=numpy.float64).reshape(-1, 3, 2)
+        
+        floor_data = self.get_flat_data(
+                triangle_points.reshape(-1, 2), self.floor_height,
+                utils.load_image(self.floor_texture_path),
+                self.floor_texture_angle, self.floor_texture_scale)
+        # Ceiling triangles need to be reversed to get the correct winding
+        ceiling_data = self.get_flat_data(
+                triangle_points[:, ::-1].reshape(-1, 2), self.ceiling_height,
+                utils.load_image(self.ceiling_texture_path),
+                self.ceiling_texture_angle, self.ceiling_texture_scale)
+        
+        # Now the walls: a quad per wall, from the floor to the ceiling
+        wall_count = len(self.wall_array)
+        plain_walls = numpy.ones(wall_count, dtype=bool)
+        plain_walls[self.shared_walls.keys()] = False
+        wall_indexes = [numpy.flatnonzero(plain_walls)]
+        bottoms = [numpy.repeat(self.floor_height, len(wall_indexes[0]))]
+        tops = [numpy.repeat(self.ceiling_height, len(wall_indexes[0]))]
+        
+        # Shared walls might need to draw wall above and/or below the other
+        # room.
+        for i, other in sorted(self.shared_walls.items()):
+            # Wall above the opening?
+            if other.ceiling_height < self.ceiling_height:
+                wall_indexes.append([i])
+                bottoms.append([other.ceiling_height])
+                tops.append([self.ceiling_height])
+            # Wall below the opening?
+            if other.floor_height > self.floor_height:
+                wall_indexes.append([i])
+                bottoms.append([self.floor_height])
+                tops.append([other.floor_height])
+        
+        wall_data = self.get_wall_quad_data(
+                                numpy.concatenate(wall_indexes).astype(int),
+                                numpy.concatenate(bottoms),
+                                numpy.concatenate(tops))
+        return floor_data, ceiling_data, wall_data
+    
+    def get_flat_data(self, points, height, image, angle, scale):
+        """Interleaved vertex data for a floor or ceiling.
+        
+        points: Triangle corners (array of xy rows)
+        image: Texture image, for its aspect ratio
+        angle: Texture rotation (radians)
+        scale: Texture scale
         
         """
-        # Vertex coordinates
-        wall = self.walls[wall_index]
-        left = wall[0]
-        right = wall[1]
-        if not bottom:
-            bottom = self.floor_height
-        if not top:
-            top = self.ceiling_height
-        
-        # We'll use the top and bottom values to get scaled texture coordinates.
+        # Take the longest dimension of the texture as 1m
+        texture_ratio = float(image.width) / float(image.height)
+        if texture_ratio < 1.0:
+            texture_ratio = 1.0 / texture_ratio
+        
+        data = numpy.empty((len(points), 7), dtype=numpy.float32)
+        x = points[:, 0]
+        y = points[:, 1]
+        # 3D vertex coords
+        data[:, 0] = x
+        data[:, 1] = y
+        data[:, 2] = height
+        # Rotated and scaled texture coords, corrected for the ratio
+        cos_angle = math.cos(angle)
+        sin_angle = math.sin(angle)
+        data[:, 3] = (x * cos_angle - y * sin_angle) / scale * texture_ratio
+        data[:, 4] = (x * sin_angle + y * cos_angle) / scale
+        # Lightmap coords
+        min_x, max_x, min_y, max_y = self.bounding_box
+        data[:, 5] = (x - min_x) / (max_x - min_x)
+        data[:, 6] = (y - min_y) / (max_y - min_y)
+        return data
+    
+    def get_wall_quad_data(self, wall_indexes, bottoms, tops):
+        """Interleaved vertex data (xyz, tex coords and lightmap coords) for
+        wall quads, two triangles each.
+        
+        wall_indexes: Index of the wall each quad is on
+        bottoms, tops: Heights of the bottom and top of each quad
+        
+        """
+        # We'll use the top and bottom values to get scaled texture
+        # coordinates.
         room_height = self.ceiling_height - self.floor_height
-        top_ratio = (top - self.floor_height) / room_height
-        bottom_ratio = (bottom - self.floor_height) / room_height
+        top_ratios = (tops - self.floor_height) / room_height
+        bottom_ratios = (bottoms - self.floor_height) / room_height
+        
+        # Whether each of a quad's six corners is on the right and the top
+        right = numpy.array([False, True, True, False, True, False])
+        top = numpy.array([True, True, False, True, False, False])
+        
+        def horizontal(left_values, right_values):
+            return numpy.where(right, right_values[:, None],
+                               left_values[:, None])
+        
+        def vertical(top_values, bottom_values):
+            return numpy.where(top, top_values[:, None],
+                               bottom_values[:, None])
+        
+        walls = self.wall_array[wall_indexes]
+        texture_walls = self.texture_walls[wall_indexes]
+        lightmap_walls = self.lightmap_walls[wall_indexes]
+        data = numpy.empty((len(wall_indexes), 6, 7), dtype=numpy.float32)
+        
+        # Vertex coordinates
+        data[:, :, 0] = horizontal(walls[:, 0, 0], walls[:, 1, 0])
+        data[:, :, 1] = horizontal(walls[:, 0, 1], walls[:, 1, 1])
+        data[:, :, 2] = vertical(tops, bottoms)
         
         # Texture coordinates
-        tex_wall = self.texture_walls[wall_index]
-        tex_left = tex_wall[0]
-        tex_right = tex_wall[1]
-        tex_top = utils.lerp(self.wall_texture_floor_height,
-                             self.wall_texture_ceiling_height, top_ratio)
-        tex_bottom = utils.lerp(self.wall_texture_floor_height,
-                                self.wall_texture_ceiling_height, bottom_ratio)
+        data[:, :, 3] = horizontal(texture_walls[:, 0], texture_walls[:, 1])
+        data[:, :, 4] = vertical(
+                utils.lerp(self.wall_texture_floor_height,
+                           self.wall_texture_ceiling_height, top_ratios),
+                utils.lerp(self.wall_texture_floor_height,
+                           self.wall_texture_ceiling_height, bottom_ratios))
         
         # Lightmap tex coords
-        lightmap_wall = self.lightmap_walls[wall_index]
-        lightmap_left = lightmap_wall[0]
-        lightmap_right = lightmap_wall[1]
-        lightmap_top = utils.lerp(self.wall_lightmap_floor_height,
-                                  self.wall_lightmap_ceiling_height, top_ratio)
-        lightmap_bottom = utils.lerp(self.wall_lightmap_floor_height,
-                             self.wall_lightmap_ceiling_height, bottom_ratio)
-
-        data = []
-        
-        # Two triangles. First:
-        data.extend((left[0], left[1], top))
-        data.extend((tex_left, tex_top))
-        data.extend((lightmap_left, lightmap_top))
-
-        data.extend((right[0], right[1], top))
-        data.extend((tex_right, tex_top))
-        data.extend((lightmap_right, lightmap_top))
-        
-        data.extend((right[0], right[1], bottom))
-        data.extend((tex_right, tex_bottom))
-        data.extend((lightmap_right, lightmap_bottom))
-        
-        # Second
-        data.extend((left[0], left[1], top))
-        data.extend((tex_left, tex_top))
-        data.extend((lightmap_left, lightmap_top))
-        
-        data.extend((right[0], right[1], bottom))
-        data.extend((tex_right, tex_bottom))
-        data.extend((lightmap_right, lightmap_bottom))
-
-        data.extend((left[0], left[1], bottom))
-        data.extend((tex_left, tex_bottom))
-        data.extend((lightmap_left, lightmap_bottom))
-        
-        return data
+        data[:, :, 5] = horizontal(lightmap_walls[:, 0], lightmap_walls[:, 1])
+        data[:, :, 6] = vertical(
+                utils.lerp(self.wall_lightmap_floor_height,
+                           self.wall_lightmap_ceiling_height, top_ratios),
+                utils.lerp(self.wall_lightmap_floor_height,
+                           self.wall_lightmap_ceiling_height, bottom_ratios))
+        return data.reshape(-1, 7)
     
     def update(self, dt):
         return        
     
-    def get_walls_from_vertices(self, vertices):
-        """Pairs of vertices making up each wall.
+    @property
+    def vertices(self):
+        """Wall vertex data, ordered clockwise (list of xy tuples).
         
         """
-        walls = []
-        for i, vertex_a in enumerate(vertices):
-            try:
-                vertex_b = vertices[i + 1]
-            except IndexError:  # Loop back to the start
-                vertex_b = vertices[0]
-            walls.append((vertex_a, vertex_b))
-        return walls
+        return self._vertices
+    
+    @vertices.setter
+    def vertices(self, vertices):
+        self._vertices = [tuple(vertex) for vertex in vertices]
+        # Wall data is built from the vertices when it's next needed
+        self._vertex_array = None
+        self._wall_array = None
+        self._wall_lengths = None
+        self._wall_slopes = None
+        self._walls = None
     
     @property
-    def walls(self):
-        """List of walls from the room's vertex data.
+    def vertex_array(self):
+        """The vertices as an (n, 2) array.
+        
+        """
+        if self._vertex_array is None:
+            self._vertex_array = numpy.array(self._vertices,
+                                             dtype=numpy.float64)
+        return self._vertex_array
+    
+    @property
+    def wall_array(self):
+        """Walls as an (n, 2, 2) array: the start and end point of each wall.
         
-        >>> a = 0.0, 0.0  # c
-        >>> b = 1.0, 0.0  # 
-        >>> c = 0.0, 1.0  # a    b
-        >>> Room((a, b, c)).walls == [(a, b), (b, c), (c, a)]
-        True
+        """
+        if self._wall_array is None:
+            vertices = self.vertex_array
+            self._wall_array = numpy.stack(
+                                (vertices, numpy.roll(vertices, -1, axis=0)),
+                                axis=1)
+        return self._wall_array
+    
+    @property
+    def wall_lengths(self):
+        """Length of each wall.
         
         """
-        return self.get_walls_from_vertices(self.vertices)
+        if self._wall_lengths is None:
+            offsets = self.wall_array[:, 1] - self.wall_array[:, 0]
+            self._wall_lengths = numpy.hypot(offsets[:, 0], offsets[:, 1])
+        return self._wall_lengths
     
     @property
-    def texture_walls(self):
-        """Walls in texture coordinate space.
+    def wall_slopes(self):
+        """Change in x per unit of y along each wall (0 for horizontal
+        walls, which never cross a horizontal ray).
         
         """
-        return self.get_walls_from_vertices(self.wall_texture_vertices)
+        if self._wall_slopes is None:
+            offsets = self.wall_array[:, 1] - self.wall_array[:, 0]
+            horizontal = offsets[:, 1] == 0.0
+            self._wall_slopes = offsets[:, 0] / numpy.where(horizontal, 1.0,
+                                                            offsets[:, 1])
+        return self._wall_slopes
     
     @property
-    def lightmap_walls(self):
-        """Walls in lightmap coordinate space.
+    def walls(self):
+        """List of walls from the room's vertex data, as pairs of vertex
+        tuples.
         
         """
-        return self.get_walls_from_vertices(self.wall_lightmap_vertices)
+        if self._walls is None:
+            vertices = self._vertices
+            self._walls = list(zip(vertices, vertices[1:] + vertices[:1]))
+        return self._walls
     
     def check_winding(self):
         """Raises InvalidRoomError if the vertices aren't wound clockwise.
         
         """
         # Add up the angles made by wall pairs
-        total_angle = 0
-        for i, wall_a in enumerate(self.walls):
-            try:
-                wall_b = self.walls[i + 1]
-            except IndexError:
-                wall_b = self.walls[0]
-            
-            for i, wall in enumerate([wall_a, wall_b]):
-                vertex_a = wall[0]
-                vertex_b = wall[1]
-                offset_x = vertex_b[0] - vertex_a[0]
-                offset_y = vertex_b[1] - vertex_a[1]
-                angle = math.atan2(offset_y, offset_x)
-                if i == 0:
-                    angle_a = angle
-                else:
-                    angle_b = angle
-            
-            angle = (angle_b - angle_a)
-            # angle = math.fmod(angle, math.pi)
-            if angle > math.pi:
-                angle -= math.pi * 2
-            if angle < -math.pi:
-                angle += math.pi * 2
-            total_angle += angle
+        offsets = self.wall_array[:, 1] - self.wall_array[:, 0]
+        angles = numpy.arctan2(offsets[:, 1], offsets[:, 0])
+        turns = numpy.roll(angles, -1) - angles
+        turns[turns > math.pi] -= math.pi * 2
+        turns[turns < -math.pi] += math.pi * 2
+        total_angle = turns.sum()
         if total_angle > 0.0:
             raise InvalidRoomError("Rooms must be wound clockwise")
     
@@ -651,11 +974,12 @@ class Room(object):
         if not len(set(self.vertices)) == len(self.vertices):
             raise InvalidRoomError("Vertices aren't unique.")
         
-        # Check for intersection. Loop over every pair of walls:
-        for wall_a, wall_b in itertools.combinations(self.walls, 2):
-            if utils.lines_intersect(wall_a, wall_b):
-                raise InvalidRoomError("Walls intersect: %s, %s" %
-                                       (wall_a, wall_b))
+        # Check for intersection, reporting every pair of walls that cross
+        walls = self.walls
+        pairs = utils.find_intersecting_segments(walls)
+        if pairs:
+            raise InvalidRoomError("Walls intersect: %s" % "; ".join(
+                    ["%s, %s" % (walls[a], walls[b]) for a, b in pairs]))
         
         # Check winding:
         self.check_winding()
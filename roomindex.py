@@ -0,0 +1,85 @@
+"""Fast lookup of the room containing a point.
+
+Rooms are put in a uniform grid by bounding box and tested with
+Room.contains_point, which works on the room's wall arrays. Lookups try a hint
+room (usually where the point was last time) and its portal neighbours
+before falling back to the grid, so following a moving player is O(1).
+
+Rooms' 3D bounding boxes are also kept in arrays, for culling them all against
+a view frustum at once.
+
+"""
+import numpy
+
+import visibility
+
+class RoomIndex(object):
+    def __init__(self, rooms, portals=None, cell_size=None):
+        """Index the given rooms.
+
+        portals: PortalGraph of the rooms, used to check a hint room's
+                 neighbours first
+        cell_size: Width of the grid cells (default: the average room size)
+
+        """
+        self.rooms = list(rooms)
+        self.portals = portals
+
+        # Bounding box corners for each room (min xyz, max xyz)
+        self._box_mins = numpy.array([room.bounding_volume[0]
+                                      for room in self.rooms]).reshape(-1, 3)
+        self._box_maxes = numpy.array([room.bounding_volume[1]
+                                       for room in self.rooms]).reshape(-1, 3)
+
+        if cell_size is None:
+            sizes = [max(room.bounding_box[1] - room.bounding_box[0],
+                         room.bounding_box[3] - room.bounding_box[2])
+                     for room in self.rooms]
+            cell_size = sum(sizes) / len(sizes) if sizes else 1.0
+        self.cell_size = max(cell_size, 1e-6)
+
+        # Key: (cell x, cell y), value: list of rooms overlapping the cell
+        self._cells = {}
+        for room in self.rooms:
+            min_x, max_x, min_y, max_y = room.bounding_box
+            min_cell = self._get_cell((min_x, min_y))
+            max_cell = self._get_cell((max_x, max_y))
+            for cell_x in xrange(min_cell[0], max_cell[0] + 1):
+                for cell_y in xrange(min_cell[1], max_cell[1] + 1):
+                    self._cells.setdefault((cell_x, cell_y), []).append(room)
+
+    def _get_cell(self, point):
+        return (int(point[0] // self.cell_size),
+                int(point[1] // self.cell_size))
+
+    def find_room(self, point, hint=None):
+        """The room containing the 2D point, or None if it's outside every
+        room.
+
+        hint: Room to try first, along with its neighbours (e.g. the room the
+              point was in last time)
+
+        """
+        checked = set()
+        if hint is not None:
+            candidates = [hint]
+            if self.portals is not None:
+                candidates.extend(self.portals.get_neighbours(hint))
+            for room in candidates:
+                if room.contains_point(point):
+                    return room
+            checked.update(candidates)
+
+        for room in self._cells.get(self._get_cell(point), ()):
+            if room not in checked and room.contains_point(point):
+                return room
+        return None
+
+    def get_rooms_in_frustum(self, planes):
+        """Rooms whose bounding boxes are at least partly inside the frustum
+        (see visibility.get_frustum_planes).
+
+        """
+        inside = visibility.boxes_in_frustum(planes, self._box_mins,
+                                             self._box_maxes)
+        return [self.rooms[i] for i in numpy.flatnonzero(inside)]
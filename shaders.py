@@ -0,0 +1,183 @@
+"""GLSL programs and the uniform buffer holding the camera matrices.
+
+"""
+import ctypes
+
+import numpy
+
+from pyglet.gl import *
+
+# Uniform buffer binding point for the camera block
+CAMERA_BINDING = 0
+
+# Vertex attribute locations, shared by every program
+POSITION_ATTRIBUTE = 0
+TEX_COORD_ATTRIBUTE = 1
+LIGHTMAP_COORD_ATTRIBUTE = 2
+
+# Texture times lightmap. The camera comes from a uniform buffer, so it's set
+# once per view rather than once per program; the model matrix moves meshes.
+LIGHTMAPPED_VERTEX_SOURCE = """
+#version 140
+
+layout(std140) uniform Camera {
+    mat4 projection;
+    mat4 view;
+};
+uniform mat4 model;
+
+in vec3 position;
+in vec2 tex_coord;
+in vec2 lightmap_coord;
+
+out vec2 frag_tex_coord;
+out vec2 frag_lightmap_coord;
+
+void main() {
+    frag_tex_coord = tex_coord;
+    frag_lightmap_coord = lightmap_coord;
+    gl_Position = projection * view * model * vec4(position, 1.0);
+}
+"""
+
+LIGHTMAPPED_FRAGMENT_SOURCE = """
+#version 140
+
+uniform sampler2D texture_map;
+uniform sampler2D lightmap;
+
+in vec2 frag_tex_coord;
+in vec2 frag_lightmap_coord;
+
+out vec4 colour;
+
+void main() {
+    colour = texture(texture_map, frag_tex_coord) *
+             texture(lightmap, frag_lightmap_coord);
+}
+"""
+
+class ShaderError(Exception):
+    """Raised when a shader doesn't compile or a program doesn't link.
+
+    """
+    pass
+
+def _compile_shader(shader_type, source):
+    shader = glCreateShader(shader_type)
+    source_buffer = ctypes.create_string_buffer(source)
+    source_pointer = ctypes.cast(ctypes.pointer(ctypes.pointer(source_buffer)),
+                                 ctypes.POINTER(ctypes.POINTER(GLchar)))
+    glShaderSource(shader, 1, source_pointer, None)
+    glCompileShader(shader)
+
+    status = GLint()
+    glGetShaderiv(shader, GL_COMPILE_STATUS, ctypes.byref(status))
+    if not status.value:
+        log_length = GLint()
+        glGetShaderiv(shader, GL_INFO_LOG_LENGTH, ctypes.byref(log_length))
+        log = ctypes.create_string_buffer(max(log_length.value, 1))
+        glGetShaderInfoLog(shader, len(log), None, log)
+        glDeleteShader(shader)
+        raise ShaderError("Shader didn't compile: %s" % log.value)
+    return shader
+
+class ShaderProgram(object):
+    def __init__(self, vertex_source, fragment_source, attributes=()):
+        """Compile and link a program.
+
+        attributes: (location, name) pairs to bind before linking
+
+        """
+        shaders = [_compile_shader(GL_VERTEX_SHADER, vertex_source),
+                   _compile_shader(GL_FRAGMENT_SHADER, fragment_source)]
+        self.id = glCreateProgram()
+        for shader in shaders:
+            glAttachShader(self.id, shader)
+        for location, name in attributes:
+            glBindAttribLocation(self.id, location,
+                                 ctypes.create_string_buffer(name))
+        glLinkProgram(self.id)
+        # The program keeps what it needs
+        for shader in shaders:
+            glDetachShader(self.id, shader)
+            glDeleteShader(shader)
+
+        status = GLint()
+        glGetProgramiv(self.id, GL_LINK_STATUS, ctypes.byref(status))
+        if not status.value:
+            log_length = GLint()
+            glGetProgramiv(self.id, GL_INFO_LOG_LENGTH,
+                           ctypes.byref(log_length))
+            log = ctypes.create_string_buffer(max(log_length.value, 1))
+            glGetProgramInfoLog(self.id, len(log), None, log)
+            glDeleteProgram(self.id)
+            raise ShaderError("Program didn't link: %s" % log.value)
+
+        # Key: uniform name, value: location
+        self._uniform_locations = {}
+
+    def use(self):
+        glUseProgram(self.id)
+
+    def get_uniform_location(self, name):
+        if name not in self._uniform_locations:
+            self._uniform_locations[name] = glGetUniformLocation(
+                                    self.id, ctypes.create_string_buffer(name))
+        return self._uniform_locations[name]
+
+    def set_int(self, name, value):
+        """Set an int (or sampler) uniform. The program must be in use.
+
+        """
+        glUniform1i(self.get_uniform_location(name), value)
+
+    def set_matrix(self, name, matrix):
+        """Set a mat4 uniform from a 4x4 array. The program must be in use.
+
+        """
+        # OpenGL matrices are column major
+        data = numpy.ascontiguousarray(numpy.asarray(matrix).T,
+                                       dtype=numpy.float32)
+        glUniformMatrix4fv(self.get_uniform_location(name), 1, GL_FALSE,
+                           data.ctypes.data_as(ctypes.POINTER(GLfloat)))
+
+    def bind_uniform_block(self, name, binding):
+        index = glGetUniformBlockIndex(self.id,
+                                       ctypes.create_string_buffer(name))
+        glUniformBlockBinding(self.id, index, binding)
+
+    def delete(self):
+        glDeleteProgram(self.id)
+
+class CameraBuffer(object):
+    """Uniform buffer with the projection and view matrices, read by every
+    program with a Camera block.
+
+    """
+    # Two std140 mat4s
+    SIZE = 2 * 16 * 4
+
+    def __init__(self, binding=CAMERA_BINDING):
+        self.binding = binding
+        self.id = GLuint()
+        glGenBuffers(1, self.id)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferData(GL_UNIFORM_BUFFER, self.SIZE, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def update(self, projection, view):
+        """Upload new matrices and bind the buffer to its binding point.
+
+        """
+        # Column major, one after the other
+        data = numpy.concatenate([numpy.asarray(projection).T.ravel(),
+                                  numpy.asarray(view).T.ravel()])
+        data = numpy.ascontiguousarray(data, dtype=numpy.float32)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, data.nbytes, data.ctypes.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.id)
+
+    def delete(self):
+        glDeleteBuffers(1, self.id)
@@ -0,0 +1,142 @@
+"""Keeps only the rooms near the player loaded.
+
+Rooms within a number of portal hops (shared walls) of the player's room are
+resident. The CPU side of loading a room happens on a background thread; the
+GL uploads and releases happen in update(). Uploads are done a step at a time
+(see Room.get_load_steps) until the frame's time budget is used up, so moving
+around doesn't cause hitches.
+
+"""
+import time
+from multiprocessing.pool import ThreadPool
+
+# Number of portal hops from the player's room to keep loaded
+DEFAULT_HOPS = 2
+
+# Seconds to spend uploading rooms in each update (always at least one step)
+LOAD_TIME_BUDGET = 0.002
+
+# Most rooms to release in a single update
+MAX_RELEASES_PER_UPDATE = 2
+
+class RoomStreamer(object):
+    def __init__(self, game, hops=DEFAULT_HOPS,
+                 load_time_budget=LOAD_TIME_BUDGET,
+                 max_releases=MAX_RELEASES_PER_UPDATE):
+        self.game = game
+        self.hops = hops
+        self.load_time_budget = load_time_budget
+        self.max_releases = max_releases
+
+        # Room that the wanted rooms were worked out from
+        self._room = None
+        # Rooms that should be resident, nearest first
+        self._wanted_rooms = []
+        # Loaded rooms
+        self._resident_rooms = set()
+        # Rooms being prepared in the background; value = AsyncResult
+        self._pending = {}
+        # Room being uploaded and its remaining load steps, or None
+        self._loading = None
+        self._pool = ThreadPool(1)
+
+    def get_nearby_rooms(self, room):
+        """Rooms within self.hops portal hops of the given room, nearest
+        first.
+
+        """
+        return self.game.portals.get_rooms_within(room, self.hops)
+
+    def load_now(self, room):
+        """Synchronously load everything near the given room. Use at startup,
+        before there's anything on screen to hitch.
+
+        """
+        self._room = room
+        self._wanted_rooms = self.get_nearby_rooms(room)
+        for nearby_room in self._wanted_rooms:
+            nearby_room.prepare()
+            self._load(nearby_room)
+
+    def update(self):
+        """Start loading rooms that have come into range, upload rooms
+        until the time budget is used up, and release a limited number of
+        rooms.
+
+        """
+        room = self.game.player.current_room
+        if room is not None and room is not self._room:
+            # Moved to a new room; work out what should be loaded now
+            self._room = room
+            self._wanted_rooms = self.get_nearby_rooms(room)
+            for nearby_room in self._wanted_rooms:
+                if (nearby_room.resident or nearby_room in self._pending or
+                        self._loading and self._loading[0] is nearby_room):
+                    continue
+                self._pending[nearby_room] = self._pool.apply_async(
+                                                        nearby_room.prepare)
+
+        # Upload rooms whose CPU work has finished, nearest first
+        end_time = time.time() + self.load_time_budget
+        while self._loading is not None or self._start_loading():
+            room, steps = self._loading
+            try:
+                next(steps)
+            except StopIteration:
+                self._finish_loading()
+            if time.time() >= end_time:
+                break
+
+        # Release rooms that are out of range
+        wanted_rooms = set(self._wanted_rooms)
+        release_count = 0
+        for resident_room in list(self._resident_rooms):
+            if release_count >= self.max_releases:
+                break
+            if resident_room not in wanted_rooms:
+                self._unload(resident_room)
+                release_count += 1
+
+    def _start_loading(self):
+        """Start uploading the nearest wanted room whose CPU work has
+        finished. Returns whether there was one.
+
+        """
+        for nearby_room in self._wanted_rooms:
+            result = self._pending.get(nearby_room)
+            if result is None or not result.ready():
+                continue
+            del self._pending[nearby_room]
+            result.get()  # Raise any error from the background thread
+            self._loading = (nearby_room, nearby_room.get_load_steps())
+            return True
+        return False
+
+    def _finish_loading(self):
+        room, steps = self._loading
+        for step in steps:
+            pass
+        self._loading = None
+        self._resident_rooms.add(room)
+        self.game.radiosity.add_lightmaps(room.lightmaps)
+
+    def _load(self, room):
+        room.load()
+        self._resident_rooms.add(room)
+        self.game.radiosity.add_lightmaps(room.lightmaps)
+
+    def _unload(self, room):
+        self.game.radiosity.remove_lightmaps(room.lightmaps)
+        room.unload()
+        self._resident_rooms.discard(room)
+
+    def close(self):
+        """Finish uploading the room in progress, so it can be unloaded, and
+        stop the background thread.
+
+        """
+        if self._loading is not None:
+            self._finish_loading()
+        self._pool.close()
+        self._pool.join()
+        self._pending = {}
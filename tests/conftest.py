@@ -0,0 +1,9 @@
+import os
+import sys
+
+import pyglet
+
+# The modules under test are at the top of the repository. Tests don't open
+# a window, so there's no need for a context when pyglet.gl is imported.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pyglet.options["shadow_window"] = False
@@ -0,0 +1,101 @@
+import itertools
+import random
+
+import numpy
+import pytest
+
+import atlas
+from lightmap import LightmapRegion, get_gutter_texels
+
+class CPULightmap(object):
+    """Lightmap page that keeps its texels in arrays instead of textures.
+
+    """
+    def __init__(self, size):
+        self.size = (size, size)
+        self.data = numpy.zeros((size, size, 3))
+        self.in_progress_data = numpy.zeros((size, size, 3))
+
+    def set_value(self, texel, value):
+        self.in_progress_data[texel[1], texel[0]] = value
+
+    def update_from_in_progress(self, rect):
+        x, y, width, height = rect
+        self.data[y:y + height, x:x + width] = \
+            self.in_progress_data[y:y + height, x:x + width]
+
+def get_padded_rect(placement, size, padding):
+    page, x, y = placement
+    return (page, x - padding, y - padding, size[0] + 2 * padding,
+            size[1] + 2 * padding)
+
+def overlaps(rect, other):
+    return (rect[0] == other[0] and
+            rect[1] < other[1] + other[3] and other[1] < rect[1] + rect[3] and
+            rect[2] < other[2] + other[4] and other[2] < rect[2] + rect[4])
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pack_places_padded_rects_on_pages_without_overlaps(seed):
+    rng = random.Random(seed)
+    sizes = [(rng.randint(1, 100), rng.randint(1, 100))
+             for i in range(rng.randint(1, 60))]
+    page_size = 256
+    placements = atlas.pack(sizes, page_size)
+
+    assert len(placements) == len(sizes)
+    rects = [get_padded_rect(placement, size, atlas.PADDING)
+             for placement, size in zip(placements, sizes)]
+    for rect in rects:
+        page, x, y, width, height = rect
+        assert x >= 0 and y >= 0
+        assert x + width <= page_size and y + height <= page_size
+    for rect, other in itertools.combinations(rects, 2):
+        assert not overlaps(rect, other)
+
+def test_pack_rejects_rects_bigger_than_a_page():
+    with pytest.raises(ValueError):
+        atlas.pack([(10, 10), (64, 8)], 64)
+
+def test_pack_uses_more_pages_when_needed():
+    placements = atlas.pack([(70, 70)] * 4, 128)
+    assert sorted(set([page for page, x, y in placements])) == [0, 1, 2, 3]
+
+def test_gutter_texels():
+    size = (4, 3)
+    assert get_gutter_texels((1, 1), size, 1) == []
+    assert sorted(get_gutter_texels((0, 1), size, 1)) == [(-1, 1)]
+    assert sorted(get_gutter_texels((3, 2), size, 2)) == [
+        (3, 3), (3, 4), (4, 2), (4, 3), (4, 4), (5, 2), (5, 3), (5, 4)]
+    # A one texel region fills its whole gutter
+    assert len(get_gutter_texels((0, 0), (1, 1), 1)) == 8
+
+def test_regions_copy_edge_texels_into_their_gutters():
+    sizes = [(5, 3), (1, 1), (8, 2), (3, 7), (2, 2)]
+    page_size = 32
+    padding = atlas.PADDING
+    placements = atlas.pack(sizes, page_size, padding)
+    pages = {}
+    regions = []
+    for (page, x, y), size in zip(placements, sizes):
+        if page not in pages:
+            pages[page] = CPULightmap(page_size)
+        regions.append(LightmapRegion(pages[page], (x, y), size, padding))
+
+    # Write a different value to every texel
+    rng = numpy.random.RandomState(0)
+    values = [rng.uniform(size=(size[1], size[0], 3)) for size in sizes]
+    for region, region_values in zip(regions, values):
+        for y, x in numpy.ndindex(*region.size[::-1]):
+            region.set_value((x, y), region_values[y, x])
+    for region in regions:
+        region.update_from_in_progress()
+
+    for region, region_values in zip(regions, values):
+        x, y = region.origin
+        width, height = region.size
+        padded = region.lightmap.data[y - padding:y + height + padding,
+                                      x - padding:x + width + padding]
+        # Each gutter texel has the value of the nearest edge texel
+        expected = numpy.pad(region_values, ((padding,), (padding,), (0,)),
+                             mode="edge")
+        assert numpy.array_equal(padded, expected)
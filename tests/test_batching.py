@@ -0,0 +1,57 @@
+import random
+
+import numpy
+
+from batching import GeometryBatch, VERTEX_SIZE
+
+def get_data(count):
+    return numpy.zeros((count, VERTEX_SIZE), dtype=numpy.float32)
+
+def check_ranges(batch):
+    """The rooms' ranges and the free ranges cover the used part of the
+    buffer exactly once.
+
+    """
+    ranges = sorted(batch.ranges.values() + batch._free_ranges)
+    end = 0
+    for first, count in ranges:
+        assert first == end
+        end += count
+    assert end == batch._end
+    for (first, count), (next_first, _) in zip(batch._free_ranges,
+                                               batch._free_ranges[1:]):
+        assert first + count < next_first
+
+def test_removed_ranges_are_reused():
+    batch = GeometryBatch(None, None)
+    for room, count in enumerate((6, 12, 6, 18)):
+        batch.add(room, get_data(count))
+    assert batch.ranges[2] == (18, 6)
+
+    batch.remove(1)
+    batch.remove(2)
+    assert batch._free_ranges == [(6, 18)]
+    batch.add(4, get_data(12))
+    assert batch.ranges[4] == (6, 12)
+    assert batch._free_ranges == [(18, 6)]
+    check_ranges(batch)
+
+def test_freeing_the_last_range_shrinks_the_end():
+    batch = GeometryBatch(None, None)
+    for room in range(3):
+        batch.add(room, get_data(3))
+    batch.remove(1)
+    batch.remove(2)
+    assert batch._free_ranges == []
+    assert batch._end == 3
+
+def test_random_adds_and_removes():
+    rng = random.Random(0)
+    batch = GeometryBatch(None, None)
+    for i in range(2000):
+        room = rng.randrange(30)
+        if rng.random() < 0.5:
+            batch.add(room, get_data(3 * rng.randint(1, 20)))
+        else:
+            batch.remove(room)
+        check_ranges(batch)
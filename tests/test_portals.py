@@ -0,0 +1,81 @@
+from room import Room
+from portals import PortalGraph
+
+def create_room(vertices, floor_height=0.0, ceiling_height=3.0):
+    return Room({"floor_height": floor_height,
+                 "ceiling_height": ceiling_height,
+                 "vertices": vertices})
+
+def create_row(count, size=2.0):
+    """Square rooms side by side along x.
+
+    """
+    return [create_room([(i * size, 0.0), (i * size, size),
+                         ((i + 1) * size, size), ((i + 1) * size, 0.0)])
+            for i in xrange(count)]
+
+def test_shared_walls_found_from_both_sides():
+    rooms = create_row(3)
+    graph = PortalGraph(rooms)
+    assert len(graph.portals) == 4
+    for portal in graph.portals:
+        back = graph.get_portal(portal.other_room, portal.other_wall_index)
+        assert back.other_room is portal.room
+        assert back.other_wall_index == portal.wall_index
+        assert back.wall == portal.wall[::-1]
+
+def test_matches_comparing_every_wall():
+    # Rooms in a grid with some missing, plus one whose wall only partly
+    # overlaps its neighbour's (which isn't a portal)
+    rooms = []
+    for x in xrange(4):
+        for y in xrange(4):
+            if (x + 2 * y) % 5 == 0:
+                continue
+            rooms.append(create_room([(x, y), (x, y + 1), (x + 1, y + 1),
+                                      (x + 1, y)]))
+    rooms.append(create_room([(4, 0), (4, 0.5), (5, 0.5), (5, 0)]))
+    graph = PortalGraph(rooms)
+    assert graph.portals
+    for room in rooms:
+        expected = []
+        for wall_index, wall in enumerate(room.walls):
+            for other in rooms:
+                if other is not room and wall[::-1] in other.walls:
+                    expected.append((wall_index, other,
+                                     other.walls.index(wall[::-1])))
+        found = [(portal.wall_index, portal.other_room,
+                  portal.other_wall_index)
+                 for portal in graph.get_portals(room)]
+        assert found == expected
+
+def test_get_neighbours_and_rooms_within():
+    rooms = create_row(5)
+    graph = PortalGraph(rooms)
+    assert graph.get_neighbours(rooms[0]) == [rooms[1]]
+    assert set(graph.get_neighbours(rooms[2])) == set([rooms[1], rooms[3]])
+    assert graph.get_rooms_within(rooms[0], 0) == [rooms[0]]
+    assert graph.get_rooms_within(rooms[0], 2) == rooms[:3]
+    within = graph.get_rooms_within(rooms[2], 1)
+    assert within[0] is rooms[2]
+    assert set(within) == set(rooms[1:4])
+    assert graph.get_rooms_within(rooms[4], 10) == rooms[::-1]
+
+def test_unshared_walls_have_no_portal():
+    rooms = create_row(2)
+    graph = PortalGraph(rooms)
+    shared = [portal.wall_index for portal in graph.get_portals(rooms[0])]
+    for wall_index in xrange(len(rooms[0].walls)):
+        if wall_index not in shared:
+            assert graph.get_portal(rooms[0], wall_index) is None
+
+def test_portal_fits():
+    low_room = create_room([(0, 0), (0, 2), (2, 2), (2, 0)], 0.0, 3.0)
+    high_room = create_room([(2, 0), (2, 2), (4, 2), (4, 0)], 0.5, 2.5)
+    portal = PortalGraph([low_room, high_room]).get_portals(low_room)[0]
+    assert (portal.bottom, portal.top, portal.min_room_height) == \
+           (0.5, 2.5, 2.0)
+    assert portal.fits(0.5, 2.5, 2.0)
+    assert not portal.fits(0.4, 2.5, 2.0)
+    assert not portal.fits(0.5, 2.6, 2.0)
+    assert not portal.fits(0.5, 2.5, 2.1)
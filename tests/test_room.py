@@ -0,0 +1,73 @@
+import random
+
+import numpy
+import pytest
+
+import room
+import utils
+from room import Room
+
+# Comb shape, with lots of walls crossed by rays along x and vertices in line
+# with the test points' rows
+COMB_VERTICES = [(0, 0), (0, 5), (1, 5), (1, 1), (2, 1), (2, 5), (3, 5),
+                 (3, 1), (4, 1), (4, 5), (5, 5), (5, 0)]
+
+def create_room(vertices, floor_height=0.0, ceiling_height=3.0):
+    return Room({"floor_height": floor_height,
+                 "ceiling_height": ceiling_height,
+                 "vertices": vertices})
+
+def in_triangles(triangles, point):
+    """Whether the point is strictly inside one of the clockwise triangles.
+
+    """
+    for a, b, c in triangles:
+        if (utils._cross(a, b, point) < 0.0 and
+            utils._cross(b, c, point) < 0.0 and
+            utils._cross(c, a, point) < 0.0):
+            return True
+    return False
+
+def get_random_points(rng, count, low, high):
+    # Round to a grid offset from the vertices, so no point is on a wall
+    return [(round(rng.uniform(low, high), 1) + 0.05,
+             round(rng.uniform(low, high), 1) + 0.05)
+            for i in xrange(count)]
+
+def test_contains_points_matches_triangles():
+    comb = create_room(COMB_VERTICES)
+    triangles = utils.triangulate(comb.vertices)
+    rng = random.Random(7)
+    points = get_random_points(rng, 5000, -1.0, 6.0)
+    inside = comb.contains_points(points)
+    assert inside.dtype == bool
+    assert inside.tolist() == [in_triangles(triangles, point)
+                               for point in points]
+    assert inside.any() and not inside.all()
+
+def test_contains_points_in_chunks(monkeypatch):
+    comb = create_room(COMB_VERTICES)
+    rng = random.Random(8)
+    points = get_random_points(rng, 500, -1.0, 6.0)
+    expected = comb.contains_points(points)
+    # A few points per chunk
+    monkeypatch.setattr(room, "POINT_TEST_CHUNK_ELEMENTS",
+                        len(COMB_VERTICES) * 3)
+    assert (comb.contains_points(points) == expected).all()
+
+def test_contains_points_3d():
+    square = create_room([(0, 0), (0, 1), (1, 1), (1, 0)], 1.0, 2.0)
+    points = [(0.5, 0.5, 1.5), (0.5, 0.5, 0.5), (0.5, 0.5, 2.5),
+              (2.0, 0.5, 1.5)]
+    assert square.contains_points(points).tolist() == [True, False, False,
+                                                       False]
+    assert square.contains_point((0.5, 0.5))
+    assert not square.contains_point((0.5, 0.5, 3.0))
+
+def test_contains_points_empty_and_invalid():
+    square = create_room([(0, 0), (0, 1), (1, 1), (1, 0)])
+    assert len(square.contains_points(numpy.zeros((0, 2)))) == 0
+    with pytest.raises(ValueError):
+        square.contains_points([1.0, 2.0])
+    with pytest.raises(ValueError):
+        square.contains_points([(1.0, 2.0, 3.0, 4.0)])
@@ -0,0 +1,73 @@
+import random
+
+import numpy
+
+from room import Room
+from portals import PortalGraph
+from roomindex import RoomIndex
+
+def create_room(vertices):
+    return Room({"floor_height": 0.0, "ceiling_height": 3.0,
+                 "vertices": vertices})
+
+def create_level():
+    """Rooms of different sizes around an L-shaped room, whose bounding box
+    overlaps the room in its corner.
+
+    """
+    rooms = [
+        # L shape
+        create_room([(0, 0), (0, 6), (2, 6), (2, 2), (6, 2), (6, 0)]),
+        # In the L's corner
+        create_room([(2, 2), (2, 6), (6, 6), (6, 2)]),
+        create_room([(6, 0), (6, 2), (7, 2), (7, 0)]),
+        create_room([(7, 0), (7, 2), (15, 2), (15, 0)]),
+        create_room([(0, 6), (0, 7), (2, 7), (2, 6)]),
+        # Not connected to anything
+        create_room([(20, 20), (20, 21), (21, 21), (21, 20)]),
+    ]
+    return rooms
+
+def find_room_linearly(rooms, point):
+    for room in rooms:
+        if room.contains_point(point):
+            return room
+    return None
+
+def test_find_room_matches_checking_every_room():
+    rooms = create_level()
+    rng = random.Random(5)
+    for cell_size in None, 0.5, 3.0, 100.0:
+        index = RoomIndex(rooms, cell_size=cell_size)
+        for trial in xrange(2000):
+            point = (rng.uniform(-1.0, 22.0), rng.uniform(-1.0, 22.0))
+            assert index.find_room(point) is find_room_linearly(rooms, point)
+
+def test_find_room_with_hint():
+    rooms = create_level()
+    index = RoomIndex(rooms, PortalGraph(rooms))
+    rng = random.Random(6)
+    hint = None
+    for trial in xrange(2000):
+        point = (rng.uniform(-1.0, 22.0), rng.uniform(-1.0, 22.0))
+        room = index.find_room(point, hint)
+        assert room is find_room_linearly(rooms, point)
+        # Wander about like a player, sometimes jumping far away
+        if room is not None:
+            hint = room
+
+def test_find_room_outside_hint():
+    rooms = create_level()
+    index = RoomIndex(rooms, PortalGraph(rooms))
+    assert index.find_room((-0.5, 3.0)) is None
+    assert index.find_room((10.0, 10.0), hint=rooms[0]) is None
+    # Inside the L's bounding box but not the L
+    assert index.find_room((4.0, 4.0), hint=rooms[0]) is rooms[1]
+    assert index.find_room((20.5, 20.5), hint=rooms[3]) is rooms[5]
+
+def test_get_rooms_in_frustum():
+    rooms = create_level()
+    index = RoomIndex(rooms)
+    # Planes keeping x between 5 and 8 (see visibility.get_frustum_planes)
+    planes = numpy.array([(1.0, 0.0, 0.0, -5.0), (-1.0, 0.0, 0.0, 8.0)])
+    assert set(index.get_rooms_in_frustum(planes)) == set(rooms[:4])
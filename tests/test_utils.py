@@ -0,0 +1,156 @@
+import math
+import random
+
+import pytest
+
+import utils
+
+def get_signed_area(a, b, c):
+    """Negative for a clockwise triangle.
+
+    """
+    return ((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])) / 2.0
+
+def get_random_polygon(rng, vertex_count):
+    """Random polygon with its vertices in order of angle around the origin,
+    wound clockwise.
+
+    """
+    angles = sorted(rng.uniform(0.0, 2.0 * math.pi)
+                    for i in xrange(vertex_count))
+    vertices = []
+    for angle in reversed(angles):
+        radius = rng.uniform(0.2, 1.0) * 10.0
+        vertices.append((round(math.cos(angle) * radius, 3),
+                         round(math.sin(angle) * radius, 3)))
+    # If the origin is outside the polygon, going round it clockwise can
+    # still wind the polygon anticlockwise
+    twice_area = sum(a[0] * b[1] - b[0] * a[1]
+                     for a, b in zip(vertices, vertices[1:] + vertices[:1]))
+    if twice_area > 0.0:
+        vertices.reverse()
+    return vertices
+
+def is_simple(vertices):
+    walls = zip(vertices, vertices[1:] + vertices[:1])
+    return (len(set(vertices)) == len(vertices) and
+            not utils.find_intersecting_segments(walls))
+
+def check_triangulation(vertices, triangles):
+    """The triangles are clockwise, there are n - 2 of them and they cover
+    the polygon's area exactly.
+
+    """
+    assert len(triangles) == len(vertices) - 2
+    total = 0.0
+    for triangle in triangles:
+        area = get_signed_area(*[vertices[i] for i in triangle])
+        assert area <= 1e-9
+        total -= area
+    assert abs(total - utils.get_polygon_area(vertices)) < 1e-6
+
+def get_interior_edges(triangles):
+    """Pairs of triangles sharing an edge, as (a, b, c, d) where a-b is the
+    shared edge and c and d are the opposite vertices.
+
+    """
+    owners = {}
+    for triangle in triangles:
+        for k in xrange(3):
+            owners[(triangle[k], triangle[(k + 1) % 3])] = triangle
+    for (a, b), triangle in owners.iteritems():
+        other = owners.get((b, a))
+        if other is None or a > b:
+            continue
+        c = [v for v in triangle if v not in (a, b)][0]
+        d = [v for v in other if v not in (a, b)][0]
+        yield a, b, c, d
+
+def test_triangulate_square():
+    vertices = [(0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0)]
+    triangles = utils.triangulate_indices(vertices)
+    check_triangulation(vertices, triangles)
+
+def test_triangulate_too_few_vertices():
+    with pytest.raises(ValueError):
+        utils.triangulate_indices([(0.0, 0.0), (0.0, 1.0)])
+
+def test_triangulate_concave():
+    # L shape, with a reflex corner at (1, 1)
+    vertices = [(0.0, 0.0), (0.0, 2.0), (1.0, 2.0), (1.0, 1.0), (2.0, 1.0),
+                (2.0, 0.0)]
+    for delaunay in False, True:
+        check_triangulation(vertices,
+                            utils.triangulate_indices(vertices, delaunay))
+
+def test_triangulate_random_polygons():
+    rng = random.Random(1)
+    tested = 0
+    while tested < 3000:
+        vertices = get_random_polygon(rng, rng.randint(3, 40))
+        if not is_simple(vertices):
+            continue
+        for delaunay in False, True:
+            check_triangulation(vertices,
+                                utils.triangulate_indices(vertices, delaunay))
+        tested += 1
+
+def test_flip_to_delaunay_convex_polygon():
+    # In a convex polygon every interior edge can be flipped, so none may
+    # have the opposite vertex inside its neighbour's circumcircle
+    rng = random.Random(2)
+    for trial in xrange(200):
+        angles = sorted(rng.uniform(0.0, 2.0 * math.pi)
+                        for i in xrange(rng.randint(4, 30)))
+        vertices = [(math.cos(angle) * 10.0, math.sin(angle) * 5.0)
+                    for angle in reversed(angles)]
+        triangles = utils.triangulate_indices(vertices)
+        utils._flip_to_delaunay(vertices, triangles)
+        check_triangulation(vertices, triangles)
+        for a, b, c, d in get_interior_edges(triangles):
+            assert not utils._in_circumcircle(vertices[a], vertices[b],
+                                              vertices[c], vertices[d])
+
+def get_intersecting_segments_brute_force(segments):
+    return [(i, j) for i in xrange(len(segments))
+            for j in xrange(i + 1, len(segments))
+            if utils.segments_intersect(segments[i], segments[j])]
+
+def test_segments_intersect():
+    assert utils.segments_intersect(((0, 0), (2, 0)), ((1, -1), (1, 1)))
+    # Joined end to end
+    assert not utils.segments_intersect(((0, 0), (1, 0)), ((1, 0), (1, 1)))
+    assert not utils.segments_intersect(((0, 0), (1, 0)), ((1, 0), (2, 0)))
+    # Folded back onto each other
+    assert utils.segments_intersect(((0, 0), (2, 0)), ((2, 0), (1, 0)))
+    # Overlapping in a line, and touching at one end
+    assert utils.segments_intersect(((0, 0), (2, 0)), ((1, 0), (3, 0)))
+    assert utils.segments_intersect(((0, 0), (2, 0)), ((1, 0), (1, 1)))
+    assert not utils.segments_intersect(((0, 0), (1, 0)), ((2, 0), (3, 0)))
+
+def test_find_intersecting_segments_matches_brute_force():
+    # Small integer grids make lots of touching, collinear and vertical
+    # walls
+    rng = random.Random(3)
+    for trial in xrange(20000):
+        grid_size = rng.choice((3, 5, 20))
+        vertices = [(rng.randint(0, grid_size), rng.randint(0, grid_size))
+                    for i in xrange(rng.randint(3, 9))]
+        if len(set(vertices)) < len(vertices):
+            continue
+        walls = zip(vertices, vertices[1:] + vertices[:1])
+        assert (utils.find_intersecting_segments(walls) ==
+                get_intersecting_segments_brute_force(walls))
+
+def test_find_intersecting_segments_random_segments():
+    # Unconnected segments rather than polygon walls
+    rng = random.Random(4)
+    for trial in xrange(2000):
+        segments = []
+        for i in xrange(rng.randint(1, 12)):
+            start = (rng.randint(0, 10), rng.randint(0, 10))
+            end = (rng.randint(0, 10), rng.randint(0, 10))
+            if start != end:
+                segments.append((start, end))
+        assert (utils.find_intersecting_segments(segments) ==
+                get_intersecting_segments_brute_force(segments))
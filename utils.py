@@ -1,10 +1,79 @@
 import math
+import pyglet
 from pyglet.gl import *
 
+from gpumemory import gpu_memory, get_texture_bytes, ROOM
+
 # Unique collision type identifiers
 PLAYER_COLLISION_TYPE = 1
 WALL_COLLISION_TYPE = 2
 
+# Collision layer bit masks. The player only collides with solid walls; walls
+# between rooms move to the open layer while the player fits through them.
+SOLID_WALL_LAYER = 1
+OPEN_WALL_LAYER = 2
+
+# Decoded images keyed by path. Filled in advance by the loader so decoding can
+# happen off the main thread.
+_image_cache = {}
+
+# Textures made from the cached images, keyed by path and whether they're
+# mipmapped. Shared by every room and mesh using the image.
+_texture_cache = {}
+
+def load_image(path):
+    """Load an image, reusing it if it's already been decoded.
+    
+    """
+    if path not in _image_cache:
+        _image_cache[path] = pyglet.image.load(path)
+    return _image_cache[path]
+
+def cache_image(path, image):
+    """Store an image decoded elsewhere so load_image can use it.
+    
+    """
+    _image_cache[path] = image
+
+def load_texture(path, mipmapped=False, owner_kind=ROOM):
+    """Get a texture of the image at the given path, reusing it if it's
+    already been uploaded.
+    
+    owner_kind: What to count the texture's memory as (see gpumemory.py)
+    
+    """
+    key = (path, mipmapped)
+    if key not in _texture_cache:
+        image = load_image(path)
+        if mipmapped:
+            texture = image.get_mipmapped_texture()
+        else:
+            texture = image.get_texture()
+        gpu_memory.add(owner_kind, path, ("texture", texture.id),
+                       get_texture_bytes(texture.width, texture.height,
+                                         mipmapped))
+        _texture_cache[key] = (texture, owner_kind)
+    return _texture_cache[key][0]
+
+def delete_texture(texture):
+    """Delete a texture now, instead of whenever pyglet garbage collects it.
+    
+    """
+    glDeleteTextures(1, GLuint(texture.id))
+    # pyglet deletes the ID again when the texture is collected, by which
+    # time it could belong to another texture
+    texture.id = 0
+
+def clear_image_cache():
+    """Forget the decoded images, and delete the textures made from them.
+    
+    """
+    for (path, mipmapped), (texture, owner_kind) in _texture_cache.items():
+        gpu_memory.remove(owner_kind, path, ("texture", texture.id))
+        delete_texture(texture)
+    _texture_cache.clear()
+    _image_cache.clear()
+
 def rad_to_deg(radians):
 	return radians * 57.2957795
 
@@ -96,6 +165,171 @@ def lines_intersect(line_one, line_two):
     else:
         return False
 
+def _orientation(a, b, c):
+    """1 if a, b, c turn left (anticlockwise), -1 if they turn right, 0 if
+    they're in a straight line.
+    
+    """
+    cross = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    if cross > 0:
+        return 1
+    elif cross < 0:
+        return -1
+    return 0
+
+def _on_segment(a, b, point):
+    """Whether a point known to be in line with a-b lies within its bounds.
+    
+    """
+    return (min(a[0], b[0]) <= point[0] <= max(a[0], b[0]) and
+            min(a[1], b[1]) <= point[1] <= max(a[1], b[1]))
+
+def segments_intersect(segment_a, segment_b):
+    """Whether the two segments touch or overlap anywhere other than a single
+    shared end point.
+    
+    Unlike lines_intersect, parallel segments that overlap count as
+    intersecting, and no divisions are done.
+    
+    >>> segments_intersect(((0, 0), (2, 0)), ((1, -1), (1, 1)))
+    True
+    >>> segments_intersect(((0, 0), (1, 0)), ((1, 0), (1, 1)))
+    False
+    >>> segments_intersect(((0, 0), (2, 0)), ((1, 0), (0, 0)))
+    True
+    
+    """
+    a, b = segment_a
+    c, d = segment_b
+    shared = set([a, b]) & set([c, d])
+    if len(shared) == 2:
+        # Same segment
+        return True
+    elif len(shared) == 1:
+        # Joined at one end; they only intersect if they fold back onto
+        # each other
+        point = shared.pop()
+        end_a = b if a == point else a
+        end_b = d if c == point else c
+        if _orientation(point, end_a, end_b) != 0:
+            return False
+        return ((end_a[0] - point[0]) * (end_b[0] - point[0]) +
+                (end_a[1] - point[1]) * (end_b[1] - point[1])) > 0
+    
+    o1 = _orientation(a, b, c)
+    o2 = _orientation(a, b, d)
+    o3 = _orientation(c, d, a)
+    o4 = _orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    # Touching or overlapping in a straight line
+    return ((o1 == 0 and _on_segment(a, b, c)) or
+            (o2 == 0 and _on_segment(a, b, d)) or
+            (o3 == 0 and _on_segment(c, d, a)) or
+            (o4 == 0 and _on_segment(c, d, b)))
+
+def _segment_below(segment_a, segment_b):
+    """Whether segment_a is below segment_b where they're both crossed by
+    the sweep line. Only meaningful for segments that don't intersect.
+    
+    """
+    if segment_a[0] >= segment_b[0]:
+        # Compare at segment_a's left end
+        side = _orientation(segment_b[0], segment_b[1], segment_a[0])
+        if side == 0:
+            side = _orientation(segment_b[0], segment_b[1], segment_a[1])
+        return side < 0
+    side = _orientation(segment_a[0], segment_a[1], segment_b[0])
+    if side == 0:
+        side = _orientation(segment_a[0], segment_a[1], segment_b[1])
+    return side > 0
+
+def _any_segments_intersect(segments):
+    """Shamos-Hoey sweep: whether any of the segments intersect, in
+    O(n log n).
+    
+    segments: List of (left point, right point) tuples, ordered with the
+              left point first
+    
+    """
+    # Events are sorted by point; at the same point, add segments before
+    # removing them so segments joined end to end get compared.
+    events = []
+    for index, segment in enumerate(segments):
+        events.append((segment[0], 0, index))
+        events.append((segment[1], 1, index))
+    events.sort()
+    
+    # Segments crossing the sweep line, bottom to top
+    active = []
+    
+    def find(segment):
+        low = 0
+        high = len(active)
+        while low < high:
+            middle = (low + high) // 2
+            if _segment_below(active[middle], segment):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    for point, event_type, index in events:
+        segment = segments[index]
+        if event_type == 0:
+            position = find(segment)
+            active.insert(position, segment)
+            for neighbour in position - 1, position + 1:
+                if (0 <= neighbour < len(active) and
+                    segments_intersect(segment, active[neighbour])):
+                    return True
+        else:
+            position = find(segment)
+            if position >= len(active) or active[position] is not segment:
+                position = active.index(segment)
+            del active[position]
+            # The segments either side are now next to each other
+            if (0 < position < len(active) and
+                segments_intersect(active[position - 1], active[position])):
+                return True
+    return False
+
+def find_intersecting_segments(segments):
+    """List of index pairs of the segments that intersect (see
+    segments_intersect).
+    
+    segments: List of segments, each a tuple of two points
+    
+    Checking for any intersection is a sweep that takes O(n log n); only if
+    there is one are the segments compared with each other (pruned to those
+    whose x ranges overlap) to find every pair.
+    
+    >>> square = [(0, 0), (0, 1), (1, 1), (1, 0)]
+    >>> find_intersecting_segments(zip(square, square[1:] + square[:1]))
+    []
+    >>> bow_tie = [(0, 0), (1, 1), (1, 0), (0, 1)]
+    >>> find_intersecting_segments(zip(bow_tie, bow_tie[1:] + bow_tie[:1]))
+    [(0, 2)]
+    
+    """
+    ordered = [tuple(sorted(segment)) for segment in segments]
+    if not _any_segments_intersect(ordered):
+        return []
+    
+    # Sweep and prune to find every pair
+    order = sorted(range(len(ordered)), key=lambda i: ordered[i][0])
+    pairs = []
+    for position, index_a in enumerate(order):
+        segment_a = ordered[index_a]
+        for index_b in order[position + 1:]:
+            segment_b = ordered[index_b]
+            if segment_b[0][0] > segment_a[1][0]:
+                break
+            if segments_intersect(segment_a, segment_b):
+                pairs.append((min(index_a, index_b), max(index_a, index_b)))
+    pairs.sort()
+    return pairs
+
 def get_length(point_a, point_b):
     """Distance between two 2D points.
     
@@ -104,6 +338,28 @@ def get_length(point_a, point_b):
     y_offset = point_b[1] - point_a[1]
     return math.sqrt(x_offset * x_offset + y_offset * y_offset)
 
+def get_polygon_area(vertices):
+    """Area of the polygon made by the given 2D points (either winding).
+    
+    >>> get_polygon_area([(0.0, 0.0), (0.0, 2.0), (3.0, 2.0), (3.0, 0.0)])
+    6.0
+    
+    """
+    area = 0.0
+    for i, vertex_a in enumerate(vertices):
+        vertex_b = vertices[(i + 1) % len(vertices)]
+        area += vertex_a[0] * vertex_b[1] - vertex_b[0] * vertex_a[1]
+    return abs(area) / 2.0
+
+def next_power_of_two(value):
+    """Smallest power of two (at least 2) that's no less than the value.
+    
+    """
+    power = 2
+    while power < value:
+        power *= 2
+    return power
+
 def is_power_of_two(value):
     """Whether the value is a power of two
     
@@ -120,71 +376,215 @@ def is_power_of_two(value):
     
     return False    
 
-def triangulate(vertices):
-    """List of triangles making up the given polygon.
+def _cross(o, a, b):
+    """Z component of the cross product of o->a and o->b. Negative means
+    o, a, b turn right (clockwise).
     
-    Vertices must be wound clockwise.
+    """
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+def _point_in_triangle(point, a, b, c):
+    """Whether the point is inside or on the edge of the clockwise triangle.
+    
+    """
+    return (_cross(a, b, point) <= 0.0 and _cross(b, c, point) <= 0.0 and
+            _cross(c, a, point) <= 0.0)
+
+def _in_circumcircle(a, b, c, d):
+    """Whether d is strictly inside the circumcircle of the clockwise
+    triangle a, b, c.
+    
+    """
+    adx, ady = a[0] - d[0], a[1] - d[1]
+    bdx, bdy = b[0] - d[0], b[1] - d[1]
+    cdx, cdy = c[0] - d[0], c[1] - d[1]
+    ad = adx * adx + ady * ady
+    bd = bdx * bdx + bdy * bdy
+    cd = cdx * cdx + cdy * cdy
+    det = (adx * (bdy * cd - bd * cdy) - ady * (bdx * cd - bd * cdx) +
+           ad * (bdx * cdy - bdy * cdx))
+    # Positive for anticlockwise triangles, so flip the sign
+    return -det > 1e-12
+
+class _ReflexGrid(object):
+    """Uniform grid of the polygon's reflex vertices, so ear tests only look
+    at the vertices near the candidate ear.
+    
+    """
+    def __init__(self, vertices, indices):
+        xs = [vertex[0] for vertex in vertices]
+        ys = [vertex[1] for vertex in vertices]
+        self.min_x = min(xs)
+        self.min_y = min(ys)
+        extent = max(max(xs) - self.min_x, max(ys) - self.min_y, 1e-9)
+        self.cell_size = extent / max(math.sqrt(len(vertices)), 1.0)
+        self.vertices = vertices
+        self.cells = {}
+        for index in indices:
+            self.cells.setdefault(self._get_cell(vertices[index]),
+                                  set()).add(index)
+    
+    def _get_cell(self, point):
+        return (int((point[0] - self.min_x) // self.cell_size),
+                int((point[1] - self.min_y) // self.cell_size))
+    
+    def remove(self, index):
+        self.cells[self._get_cell(self.vertices[index])].discard(index)
+    
+    def query(self, a, b, c):
+        """Reflex vertices in the cells overlapping the triangle's bounds.
+        
+        """
+        min_cell = self._get_cell((min(a[0], b[0], c[0]),
+                                   min(a[1], b[1], c[1])))
+        max_cell = self._get_cell((max(a[0], b[0], c[0]),
+                                   max(a[1], b[1], c[1])))
+        for cell_x in xrange(min_cell[0], max_cell[0] + 1):
+            for cell_y in xrange(min_cell[1], max_cell[1] + 1):
+                for index in self.cells.get((cell_x, cell_y), ()):
+                    yield index
+
+def triangulate_indices(vertices, delaunay=False):
+    """Triangles making up the given polygon, as tuples of three vertex
+    indexes (wound clockwise).
+    
+    Vertices must be wound clockwise. Uses ear clipping, only testing the
+    reflex vertices near each candidate ear. If delaunay is True, the
+    triangles are then improved by flipping interior edges until they're
+    constrained Delaunay (fewer thin slivers on big floors).
+    
+    >>> triangulate_indices([(0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0)])
+    [(3, 0, 1), (3, 1, 2)]
     
     """
-    if not len(vertices) >= 3:
+    vertex_count = len(vertices)
+    if not vertex_count >= 3:
         raise ValueError("Not enough vertices")
+    
+    # Doubly linked list of the remaining vertices
+    previous = [i - 1 for i in xrange(vertex_count)]
+    previous[0] = vertex_count - 1
+    following = [i + 1 for i in xrange(vertex_count)]
+    following[-1] = 0
+    
+    def is_convex(i):
+        return _cross(vertices[previous[i]], vertices[i],
+                      vertices[following[i]]) < 0.0
+    
+    # Only non-convex vertices can be inside an ear (straight corners count,
+    # since they'd end up on the ear's edge)
+    reflex = set([i for i in xrange(vertex_count) if not is_convex(i)])
+    grid = _ReflexGrid(vertices, reflex)
+    
+    def is_ear(i):
+        if i in reflex:
+            return False
+        a = previous[i]
+        c = following[i]
+        triangle = vertices[a], vertices[i], vertices[c]
+        for j in grid.query(*triangle):
+            if j in (a, i, c) or j not in reflex:
+                continue
+            if _point_in_triangle(vertices[j], *triangle):
+                return False
+        return True
+    
     triangles = []
-    # We're going to remove verts from this as they get added to triangles
-    vertices = list(vertices)
-
-    # Can be broken down into two fewer triangles than vertices
-    offset = 0
-    while len(vertices) > 3:
-        # Don't start at the same vertex every time (helps to avoid ugly thin
-        # triangles.)
-        offset = (offset + 1) % len(vertices)
-        indices = range(offset, len(vertices)) + range(0, offset)
+    remaining = vertex_count
+    i = 0
+    skipped = 0
+    while remaining > 3:
+        if not is_ear(i):
+            i = following[i]
+            skipped += 1
+            if skipped > remaining:
+                raise RuntimeError("No ears remaining")
+            continue
         
-        for i in indices:
-            vertex = vertices[i]
-            # Find out whether it's an ear
-            vertex_before = vertices[i - 1]
-            try:
-                vertex_after = vertices[i + 1]
-            except IndexError:
-                vertex_after = vertices[0]
-                        
-            # Internal corner? Not an ear
-            angle = get_angle(vertex_before, vertex, vertex_after)
-            if angle >= 0.0:
-                continue
-            
-            # Would a triangle made from the two adjacent points cross any
-            # other walls? Not an ear
-            test_edge = (vertex_before, vertex_after)
-            walls = []
-            is_ear = True
-            for j, vertex_a in enumerate(vertices):
-                try:
-                    vertex_b = vertices[j + 1]
-                except IndexError:  # Loop back to the start
-                    vertex_b = vertices[0]
-                wall = vertex_a, vertex_b
-                if lines_intersect(wall, test_edge):
-                    is_ear = False
-                    break
-            if not is_ear:
-                continue
-            
-            # The vertex is an ear; create a triangle from the adjacent points
-            # and remove the vertex from the list
-            triangle = vertex_before, vertex, vertex_after
-            triangles.append(triangle)
-            break
-        else:
-            # return triangles
-            raise RuntimeError("No ears remaining")
-        del vertices[i]
+        # The vertex is an ear; create a triangle from the adjacent points
+        # and remove the vertex from the list
+        a = previous[i]
+        c = following[i]
+        triangles.append((a, i, c))
+        following[a] = c
+        previous[c] = a
+        remaining -= 1
+        skipped = 0
+        
+        # The neighbours might not be reflex any more
+        for j in a, c:
+            if j in reflex and is_convex(j):
+                reflex.discard(j)
+                grid.remove(j)
         
+        # Carry on from the next vertex (helps to avoid fans of ugly thin
+        # triangles)
+        i = c
+    
     # Remaining vertices make up the last triangle
-    triangles.append(tuple(vertices))
+    triangles.append((previous[i], i, following[i]))
+    
+    if delaunay:
+        _flip_to_delaunay(vertices, triangles)
     return triangles
 
+def _flip_to_delaunay(vertices, triangles):
+    """Flip interior edges of the triangulation (in place) until every
+    triangle's circumcircle is empty of its neighbours' opposite vertices.
+    
+    """
+    # Directed edge -> index of the triangle it belongs to
+    owners = {}
+    for t, triangle in enumerate(triangles):
+        for k in xrange(3):
+            owners[(triangle[k], triangle[(k + 1) % 3])] = t
+    
+    pending = list(owners.keys())
+    while pending:
+        edge = pending.pop()
+        a, b = edge
+        reverse = (b, a)
+        if edge not in owners or reverse not in owners:
+            # Gone, or on the boundary (which is never flipped)
+            continue
+        t1 = owners[edge]
+        t2 = owners[reverse]
+        triangle_1 = triangles[t1]
+        triangle_2 = triangles[t2]
+        c = [v for v in triangle_1 if v != a and v != b][0]
+        d = [v for v in triangle_2 if v != a and v != b][0]
+        if not _in_circumcircle(vertices[a], vertices[b], vertices[c],
+                                vertices[d]):
+            continue
+        # Only flip if the new edge crosses the old one (convex quad)
+        if (_cross(vertices[c], vertices[d], vertices[a]) *
+            _cross(vertices[c], vertices[d], vertices[b]) >= 0.0):
+            continue
+        
+        # Replace ab with cd
+        for triangle in triangle_1, triangle_2:
+            for k in xrange(3):
+                del owners[(triangle[k], triangle[(k + 1) % 3])]
+        triangles[t1] = (c, a, d)
+        triangles[t2] = (c, d, b)
+        for t in t1, t2:
+            triangle = triangles[t]
+            for k in xrange(3):
+                owners[(triangle[k], triangle[(k + 1) % 3])] = t
+        
+        # The quad's outer edges might need flipping now
+        pending.extend([(a, d), (d, b), (b, c), (c, a)])
+
+def triangulate(vertices, delaunay=False):
+    """List of triangles making up the given polygon, as tuples of three
+    vertices.
+    
+    Vertices must be wound clockwise.
+    
+    """
+    return [tuple([vertices[i] for i in triangle])
+            for triangle in triangulate_indices(vertices, delaunay)]
+
 def draw_rect(origin=(0.0, 0.0), size=(1.0, 1.0),
               tex_origin=(0.0, 0.0), tex_size=(1.0, 1.0), mode=GL_TRIANGLES):
     """Use OpenGL commands to draw a rectangle with the given specifications.
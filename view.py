@@ -3,28 +3,69 @@ import random
 import pyglet
 from pyglet.gl import *
 
+import numpy
+
 import utils
+import visibility
+import camera
+from renderer import ShaderRenderer
+from renderstats import frame_stats
+from occlusion import OcclusionCuller
 from utils import rad_to_deg
 
-SHARED_WALL_COLOR = 0.7, 0.7, 0.7, 1.0
-WALL_COLOR = 0.0, 0.0, 0.0, 1.0
 PLAYER_COLOR = 0.0, 0.7, 0.1, 1.0
 
+# Vertical field of view of the 3D view, degrees
+FIELD_OF_VIEW = 45.0
+
+# Extra levels of detail to drop when rendering for the lightmaps. Incident
+# light is averaged over the whole hemicube, so mesh detail barely matters.
+LIGHTMAP_LOD_BIAS = 1
+
 # View modes
 VIEW_2D = "VIEW_2D"
 VIEW_3D = "VIEW_3D"
 VIEW_INCIDENT = "VIEW_INCIDENT"
 
+# Renderers for the 3D view: the fixed-function pipeline, or vertex array
+# objects with a texture times lightmap shader (see renderer.py)
+RENDERER_FIXED = "RENDERER_FIXED"
+RENDERER_SHADER = "RENDERER_SHADER"
+
 class View(object):
-    def __init__(self, game):
+    def __init__(self, game, renderer=RENDERER_FIXED):
         self.size = (0, 0)
         self.game = game
+        self.renderer = renderer
+        # Created when first used, once there's a GL context
+        self.shader_renderer = None
+        # Projection and view matrices of the 3D view (set by project_3d)
+        self.matrices = None
+        # Whether to skip rooms and meshes hidden last time (see
+        # occlusion.py). The culler is created when first used.
+        self.occlusion_culling = False
+        self.occlusion_culler = None
+        # Key: hemicube face, value: lightmap its occlusion results are from
+        self._occlusion_lightmaps = {}
         self.w_down = False
         self.a_down = False
         self.s_down = False
         self.d_down = False
         self.view_mode = VIEW_2D
             
+    def delete(self):
+        """Delete the GL objects the view has made for drawing. They're made
+        again when they're next needed.
+        
+        """
+        if self.shader_renderer is not None:
+            self.shader_renderer.delete()
+            self.shader_renderer = None
+        if self.occlusion_culler is not None:
+            self.occlusion_culler.delete()
+            self.occlusion_culler = None
+        self._occlusion_lightmaps = {}
+    
     def update_player_movement_from_keys(self):
         movement_speed = 3.0
         x_speed = 0
@@ -44,33 +85,34 @@ class View(object):
         glViewport(0, 0, self.size[0], self.size[1])
         glOrtho(0.0, 0.1, 0.0, 0.1, -1.0, 1.0)
     
+    def get_map_rect(self):
+        """Area of the level the 2D view covers (min x, min y, max x, max y),
+        worked out from the current matrices.
+        
+        """
+        inverse = numpy.linalg.inv(visibility.get_view_projection_matrix())
+        corners = numpy.dot(inverse, [[-1.0, 1.0, -1.0, 1.0],
+                                      [-1.0, -1.0, 1.0, 1.0],
+                                      [0.0, 0.0, 0.0, 0.0],
+                                      [1.0, 1.0, 1.0, 1.0]])
+        corners = corners[:2] / corners[3]
+        return (corners[0].min(), corners[1].min(),
+                corners[0].max(), corners[1].max())
+    
     def draw_2d(self):
         glDisable(GL_DEPTH_TEST)
         glDisable(GL_TEXTURE_2D)
-        for room in self.game.rooms:
-            glColor4f(0.8, 1.0, 0.9, 1.0)
-            for triangle in room.triangles:
-                glBegin(GL_LINE_LOOP)
-                for vertex in triangle:
-                    glVertex2f(vertex[0], vertex[1])
-                glEnd()
-
-            for i, wall in enumerate(room.walls):
-                if i in room.shared_walls:
-                    glColor4f(*SHARED_WALL_COLOR)
-                else:
-                    glColor4f(*WALL_COLOR)
-                glBegin(GL_LINES)
-                for vertex in wall:
-                    glVertex2f(*vertex)
-                glEnd()
+        
+        # Floor triangles and walls, skipping rooms that are out of view
+        self.game.level_map.draw(self.get_map_rect())
         
         # Draw player
         player = self.game.player
         glColor4f(*PLAYER_COLOR)
         glPushMatrix()
-        glTranslatef(player.position[0], player.position[1], 0.0)
-        glRotatef(rad_to_deg(player.heading), 0.0, 0.0, 1.0)
+        position = player.interpolated_position
+        glTranslatef(position[0], position[1], 0.0)
+        glRotatef(rad_to_deg(player.interpolated_heading), 0.0, 0.0, 1.0)
         # Circle
         point_count = 12
         radius = player.radius
@@ -85,126 +127,163 @@ class View(object):
         glVertex2f(0.0, -radius)
         glVertex2f(0.0, radius)
         glEnd()
+        frame_stats.draw_calls += 2
         glPopMatrix()
 
     def project_3d(self):
         glViewport(0, 0, self.size[0], self.size[1])
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        gluPerspective(45.0, float(self.size[0]) / float(self.size[1]),
-                       0.001, 100.0)
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
         player = self.game.player
-        glRotatef(90.0, 0.0, 1.0, 0.0)
-        glRotatef(-90.0, 1.0, 0.0, 0.0)
-        glRotatef(rad_to_deg(player.pitch), 0.0, 1.0, 0.0)
-        glRotatef(rad_to_deg(player.heading), 0.0, 0.0, -1.0)
-        glTranslatef(-player.position[0], -player.position[1],
-                     -player.eye_height)
+        position = player.interpolated_position
+        projection = camera.perspective(
+                                FIELD_OF_VIEW,
+                                float(self.size[0]) / float(self.size[1]),
+                                0.001, 100.0)
+        view = camera.get_view_matrix(
+                    (position[0], position[1], player.interpolated_eye_height),
+                    player.interpolated_heading, player.pitch)
+        self.matrices = (projection, view)
+        # The shader renderer takes the matrices as uniforms instead
+        if self.renderer == RENDERER_FIXED:
+            camera.load_matrices(projection, view)
 
-    def draw_for_lightmap(self):
+    def draw_for_lightmap(self, position, focal_length, matrices=None,
+                          face=None, lightmap=None):
         """Draw the scene but only use complete lightmaps.
         
+        position: Camera position, used to choose mesh detail
+        focal_length: Pixels per unit at a distance of one unit
+        matrices: Projection and view matrices (see draw_3d)
+        face: Which hemicube face is being drawn, for occlusion culling
+        lightmap: Lightmap being worked on. Occlusion results from another
+                  lightmap's texels aren't used.
+        
         """
-        self.draw_3d(in_progress_lightmaps=False)
+        occlusion_key = None
+        if face is not None:
+            occlusion_key = "lightmap " + face
+            if (self.occlusion_culler is not None and
+                    self._occlusion_lightmaps.get(face) is not lightmap):
+                self.occlusion_culler.forget(occlusion_key)
+            self._occlusion_lightmaps[face] = lightmap
+        self.draw_3d(in_progress_lightmaps=False, eye=position,
+                     focal_length=focal_length, lod_bias=LIGHTMAP_LOD_BIAS,
+                     matrices=matrices, occlusion_key=occlusion_key)
 
-    def draw_3d(self, in_progress_lightmaps=True):
+    def get_visible_rooms(self, eye, matrix):
+        """Rooms that can be seen from the eye with the given view projection
+        matrix, found by traversing portals from the room the eye is in.
+        
+        Returns None if the eye isn't in a room.
+        
+        """
+        game = self.game
+        start_room = game.room_index.find_room(eye, game.player.current_room)
+        if start_room is None:
+            return None
+        return visibility.find_visible_rooms(start_room, game.portals, eye,
+                                             matrix)
+    
+    def draw_3d(self, in_progress_lightmaps=True, eye=None, focal_length=None,
+                lod_bias=0, matrices=None, occlusion_key=None):
+        """Draw the rooms and meshes.
+        
+        matrices: Projection and view matrices (see camera.py). Needed by the
+                  shader renderer; the fixed-function renderer reads them
+                  from the matrix stack if they aren't given.
+        occlusion_key: Name of the view, if occlusion culling should be used
+                       (results are kept per view)
+        
+        """
+        # Only draw rooms and meshes inside the current camera's frustum
+        if matrices is None:
+            matrix = visibility.get_view_projection_matrix()
+        else:
+            matrix = numpy.dot(matrices[0], matrices[1])
+        planes = visibility.get_frustum_planes(matrix)
+        plane_list = planes.tolist()
+        
+        # Default to the player's camera, only drawing the rooms that can be
+        # seen through portals
+        rooms = None
+        if eye is None:
+            player = self.game.player
+            position = player.interpolated_position
+            eye = (position[0], position[1], player.interpolated_eye_height)
+            rooms = self.get_visible_rooms(eye, matrix)
+        if rooms is None:
+            rooms = self.game.room_index.get_rooms_in_frustum(planes)
+        else:
+            rooms = [room for room in rooms if
+                     visibility.box_in_frustum(plane_list,
+                                               room.bounding_volume)]
+        if focal_length is None:
+            half_fov = utils.deg_to_rad(FIELD_OF_VIEW / 2.0)
+            focal_length = self.size[1] / 2.0 / math.tan(half_fov)
+        
+        # Rooms that are streamed out have nothing to draw
+        rooms = [room for room in rooms if room.resident]
+        meshes = []
+        for room in rooms:
+            for mesh in room.meshes:
+                if visibility.box_in_frustum(plane_list, mesh.bounding_volume):
+                    meshes.append((mesh,
+                                   mesh.get_lod(eye, focal_length, lod_bias)))
+        
+        # Skip what was hidden last time, then test everything again
+        if self.occlusion_culling and occlusion_key is not None:
+            if self.occlusion_culler is None:
+                self.occlusion_culler = OcclusionCuller()
+            culler = self.occlusion_culler
+            culler.collect()
+            candidates = rooms + [mesh for mesh, lod in meshes]
+            rooms = [room for room in rooms
+                     if culler.is_visible(occlusion_key, room, eye)]
+            meshes = [(mesh, lod) for mesh, lod in meshes
+                      if culler.is_visible(occlusion_key, mesh, eye)]
+            self.draw_scene(rooms, meshes, matrices, in_progress_lightmaps)
+            culler.issue_queries(occlusion_key, candidates, eye, matrices)
+        else:
+            self.draw_scene(rooms, meshes, matrices, in_progress_lightmaps)
+    
+    def draw_scene(self, rooms, meshes, matrices, in_progress_lightmaps=True):
+        """Draw the given rooms and (mesh, level of detail) pairs with the
+        current renderer.
+        
+        """
         glEnable(GL_DEPTH_TEST)
+        if self.renderer == RENDERER_SHADER:
+            if self.shader_renderer is None:
+                self.shader_renderer = ShaderRenderer()
+            self.shader_renderer.draw(self.game.static_geometry, rooms, meshes,
+                                      matrices, in_progress_lightmaps)
+            return
+        
         glEnable(GL_TEXTURE_2D)
         glColor4f(1.0, 1.0, 1.0, 1.0)
         
-        for room in self.game.rooms:
-            # Room data geometry
-            geo_count_texture = [(room.floor_data_vbo,
-                                  room.floor_data_count,
-                                  room.floor_texture,
-                                  room.floor_lightmap),
-                                 (room.ceiling_data_vbo,
-                                  room.ceiling_data_count,
-                                  room.ceiling_texture,
-                                  room.ceiling_lightmap)]
-            # Setup the state
-            for geo_vbo, count, texture, lightmap in geo_count_texture:
-                # Draw the floor. First, setup the state
-                glActiveTexture(GL_TEXTURE0_ARB)
-                glBindTexture(GL_TEXTURE_2D, texture.id)
-                glActiveTexture(GL_TEXTURE1_ARB)
-                glEnable(GL_TEXTURE_2D)
-                if in_progress_lightmaps:
-                    glBindTexture(GL_TEXTURE_2D,
-                                  lightmap.in_progress_texture.id)
-                else:
-                    glBindTexture(GL_TEXTURE_2D, lightmap.texture.id)
-                glEnableClientState(GL_VERTEX_ARRAY)
-                glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-                # Draw the geometry
-                glBindBuffer(GL_ARRAY_BUFFER, geo_vbo)
-                glVertexPointer(3, GL_FLOAT, 7 * sizeof(GLfloat), 0)
-                glClientActiveTexture(GL_TEXTURE0_ARB)
-                glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-                glTexCoordPointer(2, GL_FLOAT, 7 * sizeof(GLfloat),
-                                  3 * sizeof(GLfloat))
-                glClientActiveTexture(GL_TEXTURE1_ARB)
-                glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-                glTexCoordPointer(2, GL_FLOAT, 7 * sizeof(GLfloat),
-                                  5 * sizeof(GLfloat))
-                glDrawArrays(GL_TRIANGLES, 0, count)
-                # Reset the state
-                glDisableClientState(GL_VERTEX_ARRAY)
-                glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-
-            # WALLS: Setup the state
-            glActiveTexture(GL_TEXTURE0_ARB)
-            glBindTexture(GL_TEXTURE_2D, room.wall_texture.id)
-            glActiveTexture(GL_TEXTURE1_ARB)
-            glEnable(GL_TEXTURE_2D)
-            if in_progress_lightmaps:
-                glBindTexture(GL_TEXTURE_2D,
-                              room.wall_lightmap.in_progress_texture.id)
-            else:
-                glBindTexture(GL_TEXTURE_2D, room.wall_lightmap.texture.id)
-            # Draw the geometry
+        # Room surfaces, batched by texture and lightmap
+        self.game.static_geometry.draw(rooms, in_progress_lightmaps)
+        
+        # Draw meshes
+        for mesh, lod in meshes:
+            # Setup state
+            glBindTexture(GL_TEXTURE_2D, mesh.texture.id)
+            glPushMatrix()
+            glTranslatef(*mesh.position)
             glEnableClientState(GL_VERTEX_ARRAY)
-            glBindBuffer(GL_ARRAY_BUFFER, room.wall_data_vbo)
-            glVertexPointer(3, GL_FLOAT, 7 * sizeof(GLfloat), 0)
-            glClientActiveTexture(GL_TEXTURE0_ARB)
             glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-            glTexCoordPointer(2, GL_FLOAT, 7 * sizeof(GLfloat),
+            # Draw the mesh
+            glBindBuffer(GL_ARRAY_BUFFER, mesh.lod_vbos[lod])
+            glVertexPointer(3, GL_FLOAT, 5 * sizeof(GLfloat), 0)
+            glTexCoordPointer(2, GL_FLOAT, 5 * sizeof(GLfloat),
                               3 * sizeof(GLfloat))
-            glClientActiveTexture(GL_TEXTURE1_ARB)
-            glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-            glTexCoordPointer(2, GL_FLOAT, 7 * sizeof(GLfloat),
-                              5 * sizeof(GLfloat))
-            glDrawArrays(GL_TRIANGLES, 0, room.wall_data_count)
+            glDrawArrays(GL_TRIANGLES, 0, mesh.lod_counts[lod])
+            frame_stats.state_changes += 2
+            frame_stats.draw_calls += 1
             # Reset the state
-            glActiveTexture(GL_TEXTURE1_ARB)
-            glDisable(GL_TEXTURE_2D)
-            glClientActiveTexture(GL_TEXTURE1_ARB)
-            glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-            glClientActiveTexture(GL_TEXTURE0_ARB)
             glDisableClientState(GL_VERTEX_ARRAY)
             glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-            glActiveTexture(GL_TEXTURE0_ARB)
-                                
-            # Draw meshes
-            for mesh in room.meshes:
-                # Setup state
-                glBindTexture(GL_TEXTURE_2D, mesh.texture.id)
-                glPushMatrix()
-                glTranslatef(*mesh.position)
-                glEnableClientState(GL_VERTEX_ARRAY)
-                glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-                # Draw the mesh
-                glBindBuffer(GL_ARRAY_BUFFER, mesh.data_vbo)
-                glVertexPointer(3, GL_FLOAT, 5 * sizeof(GLfloat), 0)
-                glTexCoordPointer(2, GL_FLOAT, 5 * sizeof(GLfloat),
-                                  3 * sizeof(GLfloat))
-                glDrawArrays(GL_TRIANGLES, 0, mesh.data_count)
-                # Reset the state
-                glDisableClientState(GL_VERTEX_ARRAY)
-                glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-                glPopMatrix()
+            glPopMatrix()
                     
     def draw_incident_fbo(self):
         glClearColor(0.0, 0.0, 0.0, 1.0)       
@@ -233,7 +312,7 @@ class View(object):
             self.draw_2d()
         elif self.view_mode == VIEW_3D:
             self.project_3d()
-            self.draw_3d()
+            self.draw_3d(matrices=self.matrices, occlusion_key=VIEW_3D)
         elif self.view_mode == VIEW_INCIDENT:
             self.project_2d()
             self.draw_incident_fbo()        
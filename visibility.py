@@ -0,0 +1,196 @@
+"""Working out which rooms the camera can see.
+
+Starting from the room the camera is in, portals (shared walls) are projected
+to the screen and the rooms behind them are only visited if the portal's
+screen rectangle overlaps what's visible of the portal leading to it. Rooms
+that aren't reached aren't drawn.
+
+Rooms and meshes are also tested against the camera's frustum, using their
+bounding boxes and planes taken from the view projection matrix.
+
+"""
+import numpy
+
+from pyglet.gl import *
+
+# Screen rectangle covering the whole view, in normalized device coords
+# (min x, min y, max x, max y)
+FULL_SCREEN_RECT = (-1.0, -1.0, 1.0, 1.0)
+
+# Portals closer to the eye than this are treated as covering the whole of
+# the current rectangle (e.g. when standing in a doorway, where the portal is
+# seen edge on)
+NEAR_PORTAL_DISTANCE = 0.5
+
+def get_view_projection_matrix():
+    """The current projection matrix times the current modelview matrix, as
+    a 4x4 array that transforms column vectors from world to clip space.
+
+    """
+    matrices = []
+    for matrix_name in GL_PROJECTION_MATRIX, GL_MODELVIEW_MATRIX:
+        matrix = (GLdouble * 16)()
+        glGetDoublev(matrix_name, matrix)
+        # OpenGL matrices are column major
+        matrices.append(numpy.array(matrix, dtype=numpy.float64)
+                        .reshape(4, 4).T)
+    return numpy.dot(matrices[0], matrices[1])
+
+def get_frustum_planes(matrix):
+    """The six planes bounding the view of the given view projection matrix,
+    as an array of (a, b, c, d) rows. Points inside have ax + by + cz + d >=
+    0 for every plane.
+
+    """
+    rows = matrix
+    planes = numpy.array([rows[3] + rows[0], rows[3] - rows[0],   # Left, right
+                          rows[3] + rows[1], rows[3] - rows[1],   # Bottom, top
+                          rows[3] + rows[2], rows[3] - rows[2]])  # Near, far
+    lengths = numpy.sqrt((planes[:, :3] ** 2).sum(axis=1))
+    return planes / numpy.maximum(lengths, 1e-12)[:, None]
+
+def box_in_frustum(planes, box):
+    """Whether any of the box (min xyz, max xyz) might be inside the frustum.
+
+    planes: Frustum planes as a sequence of (a, b, c, d) tuples
+
+    """
+    box_min, box_max = box
+    for a, b, c, d in planes:
+        # Corner of the box furthest along the plane's normal
+        x = box_max[0] if a >= 0.0 else box_min[0]
+        y = box_max[1] if b >= 0.0 else box_min[1]
+        z = box_max[2] if c >= 0.0 else box_min[2]
+        if a * x + b * y + c * z + d < 0.0:
+            return False
+    return True
+
+def boxes_in_frustum(planes, box_mins, box_maxes):
+    """Vectorized box_in_frustum for (N, 3) arrays of box corners. Returns a
+    boolean array.
+
+    """
+    normals = planes[:, None, :3]
+    furthest = numpy.where(normals >= 0.0, box_maxes[None], box_mins[None])
+    distances = (furthest * normals).sum(axis=2) + planes[:, 3][:, None]
+    return (distances >= 0.0).all(axis=0)
+
+def get_screen_rect(points, matrix):
+    """Screen rectangle (in normalized device coords) bounding the given
+    world space polygon, or None if it's entirely behind the camera.
+
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    homogeneous = numpy.column_stack((points, numpy.ones(len(points))))
+    clip = numpy.dot(homogeneous, matrix.T)
+
+    # Clip the polygon to the near plane (z >= -w)
+    distances = clip[:, 2] + clip[:, 3]
+    if (distances < 0.0).all():
+        return None
+    if (distances < 0.0).any():
+        clipped = []
+        for i in range(len(clip)):
+            j = (i + 1) % len(clip)
+            if distances[i] >= 0.0:
+                clipped.append(clip[i])
+            if (distances[i] >= 0.0) != (distances[j] >= 0.0):
+                ratio = distances[i] / (distances[i] - distances[j])
+                clipped.append(clip[i] + (clip[j] - clip[i]) * ratio)
+        clip = numpy.array(clipped)
+
+    w = numpy.maximum(clip[:, 3], 1e-9)
+    x = clip[:, 0] / w
+    y = clip[:, 1] / w
+    return (x.min(), y.min(), x.max(), y.max())
+
+def intersect_rects(rect_a, rect_b):
+    """Overlap of two screen rectangles, or None if they don't overlap.
+
+    """
+    rect = (max(rect_a[0], rect_b[0]), max(rect_a[1], rect_b[1]),
+            min(rect_a[2], rect_b[2]), min(rect_a[3], rect_b[3]))
+    if rect[0] >= rect[2] or rect[1] >= rect[3]:
+        return None
+    return rect
+
+def rect_contains(rect_a, rect_b):
+    """Whether rect_a completely covers rect_b.
+
+    """
+    return (rect_a[0] <= rect_b[0] and rect_a[1] <= rect_b[1] and
+            rect_a[2] >= rect_b[2] and rect_a[3] >= rect_b[3])
+
+def get_distance_to_segment(point, start, end):
+    """2D distance from the point to the nearest point on the segment.
+
+    """
+    offset_x = end[0] - start[0]
+    offset_y = end[1] - start[1]
+    length_squared = offset_x * offset_x + offset_y * offset_y
+    ratio = 0.0
+    if length_squared > 0.0:
+        ratio = ((point[0] - start[0]) * offset_x +
+                 (point[1] - start[1]) * offset_y) / length_squared
+        ratio = min(max(ratio, 0.0), 1.0)
+    nearest_x = start[0] + offset_x * ratio
+    nearest_y = start[1] + offset_y * ratio
+    return ((point[0] - nearest_x) ** 2 + (point[1] - nearest_y) ** 2) ** 0.5
+
+def find_visible_rooms(start_room, portals, eye, matrix):
+    """Rooms that can be seen from the eye, which is in start_room, found by
+    traversing portals.
+
+    portals: PortalGraph of the level
+    eye: Camera position (3D)
+    matrix: View projection matrix (see get_view_projection_matrix)
+
+    Returns the rooms in the order they were reached, nearest first.
+
+    """
+    visible_rooms = [start_room]
+    # Screen rectangles each room has been visited with
+    visited_rects = {start_room: [FULL_SCREEN_RECT]}
+    stack = [(start_room, FULL_SCREEN_RECT)]
+    while stack:
+        room, rect = stack.pop()
+        for portal in portals.get_portals(room):
+            if portal.top <= portal.bottom:
+                # Nothing to see through
+                continue
+            (start_x, start_y), (end_x, end_y) = portal.wall
+
+            # Rooms are wound clockwise, so the inside is on the right of
+            # each wall. Skip portals that face away from the eye.
+            side = ((end_x - start_x) * (eye[1] - start_y) -
+                    (end_y - start_y) * (eye[0] - start_x))
+            near = (get_distance_to_segment(eye, (start_x, start_y),
+                                            (end_x, end_y)) <
+                    NEAR_PORTAL_DISTANCE)
+            if side > 0.0 and not near:
+                continue
+
+            if near:
+                portal_rect = rect
+            else:
+                portal_rect = get_screen_rect(
+                                [(start_x, start_y, portal.bottom),
+                                 (end_x, end_y, portal.bottom),
+                                 (end_x, end_y, portal.top),
+                                 (start_x, start_y, portal.top)], matrix)
+                if portal_rect is None:
+                    continue
+                portal_rect = intersect_rects(rect, portal_rect)
+                if portal_rect is None:
+                    continue
+
+            # Don't go back over ground that's already been covered
+            other = portal.other_room
+            other_rects = visited_rects.setdefault(other, [])
+            if [r for r in other_rects if rect_contains(r, portal_rect)]:
+                continue
+            if not other_rects:
+                visible_rooms.append(other)
+            other_rects.append(portal_rect)
+            stack.append((other, portal_rect))
+    return visible_rooms
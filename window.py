@@ -1,15 +1,27 @@
+import os
+import tempfile
+
 import pyglet.window
 from pyglet.window import key
 
 from view import VIEW_2D, VIEW_3D, VIEW_INCIDENT
+from profiler import profiler
+from gpumemory import gpu_memory
 
 import inputstates
 
+# Where profiler traces are saved (Chrome trace-event JSON)
+TRACE_PATH = os.path.join(tempfile.gettempdir(), "frame_trace.json")
+
 class Window(pyglet.window.Window):
     def __init__(self, view, *args, **kwargs):
         pyglet.window.Window.__init__(self, *args, **kwargs)
         self.view = view
         self.view.size = (self.width, self.height)
+        # Whether the profiler's averages and the GPU memory report are
+        # shown in the overlay
+        self.show_profiler = False
+        self.show_gpu_memory = False
 
     def on_activate(self):
         # self.view.game.refresh_from_files()
@@ -42,6 +54,20 @@ class Window(pyglet.window.Window):
             self.view.view_mode = VIEW_3D
         elif symbol == key._4:
             self.view.view_mode = VIEW_INCIDENT
+        elif symbol == key.F8:
+            self.show_gpu_memory = not self.show_gpu_memory
+        elif symbol == key.F9:
+            self.show_profiler = not self.show_profiler
+            profiler.set_enabled(self.show_profiler or profiler.tracing)
+        elif symbol == key.F10:
+            # Start recording a trace, or save the one being recorded
+            if profiler.tracing:
+                profiler.save_trace(TRACE_PATH)
+                print "Saved profiler trace to %s" % TRACE_PATH
+                profiler.set_enabled(self.show_profiler)
+            else:
+                profiler.set_enabled(True)
+                profiler.start_trace()
         else:
             return
         self.view.update_player_movement_from_keys()
@@ -66,4 +92,15 @@ class Window(pyglet.window.Window):
         self.view.update_player_movement_from_keys()
     
     def on_draw(self):        
-        self.view.draw()
+        with profiler.scope("View.draw"):
+            with profiler.gpu_scope("View.draw"):
+                self.view.draw()
+        overlay_text = []
+        if self.show_profiler:
+            overlay_text.append(profiler.get_overlay_text())
+        if self.show_gpu_memory:
+            overlay_text.append(gpu_memory.get_report())
+        if overlay_text:
+            profiler.draw_overlay((self.width, self.height),
+                                  "\n\n".join(overlay_text))
+        profiler.end_frame()
@@ -0,0 +1,21 @@
+"""Worker processes for the loader.
+
+Importing pyglet.gl creates pyglet's hidden window and its GL context, and
+processes forked after that inherit them. So the pool has to be started before
+anything imports pyglet.gl, which is why this module doesn't import anything
+from the game.
+
+"""
+import multiprocessing
+
+def _init_worker():
+    # The workers only do CPU work, so they don't need a hidden window of
+    # their own when they import the game's modules
+    import pyglet
+    pyglet.options["shadow_window"] = False
+
+def create_pool(processes=None):
+    """Start the worker processes (default: one per core).
+
+    """
+    return multiprocessing.Pool(processes, _init_worker)